@@ -7,23 +7,56 @@
 
 # Here are Iroha dependencies.
 # Python library generally consists of 3 parts:
-# Iroha, IrohaCrypto and IrohaGrpc which we need to import:
+# Iroha, IrohaCrypto and IrohaGrpc. The peers are reached through a
+# PeerPool (peerpool.py), so only the first two are imported:
 import os
-import re
 import binascii
+import time
+import json
+import concurrent.futures
 from iroha import IrohaCrypto
-from iroha import Iroha, IrohaGrpc
+from iroha import Iroha
 from iroha import primitive_pb2
-from flask import Flask, request
+from flask import Flask, Response, request, stream_with_context
 
-# The following line is actually about the permissions
-# you might be using for the transaction.
-# You can find all the permissions here:
-# https://iroha.readthedocs.io/en/main/develop/api/permissions.html
-from iroha.primitive_pb2 import can_set_my_account_detail
 import sys
 
+try:
+    from .batcher import DetailBatcher
+    from .bulkimport import FORMATS, guess_format, import_rows, read_rows, with_progress
+    from .consent import ConsentBook, ConsentError
+    from .detailcache import DetailCache, watch_blocks
+    from .detailpages import DetailQueryError, details_response, wants_pages
+    from .events import EventHub, parse_position, sse
+    from .idempotency import HEADER, IdempotentWrites, KeyReuseError
+    from .metrics import VERBOSE, count_status, instrument_app, observe_phase, phase, trace
+    from .peerpool import MAX_BATCH_SIZE, PeerPool
+    from .provision import ManifestWriter, provision_accounts, read_accounts
+    from .responses import respond, respond_detail, status_document
+    from .signers import Signer
+    from .signpool import SigningPool
+    from .statusresolver import StatusResolver, StatusTimeout, committed
+    from .txtracker import tx_hash_hex
+except ImportError:
+    from batcher import DetailBatcher
+    from bulkimport import FORMATS, guess_format, import_rows, read_rows, with_progress
+    from consent import ConsentBook, ConsentError
+    from detailcache import DetailCache, watch_blocks
+    from detailpages import DetailQueryError, details_response, wants_pages
+    from events import EventHub, parse_position, sse
+    from idempotency import HEADER, IdempotentWrites, KeyReuseError
+    from metrics import VERBOSE, count_status, instrument_app, observe_phase, phase, trace
+    from peerpool import MAX_BATCH_SIZE, PeerPool
+    from provision import ManifestWriter, provision_accounts, read_accounts
+    from responses import respond, respond_detail, status_document
+    from signers import Signer
+    from signpool import SigningPool
+    from statusresolver import StatusResolver, StatusTimeout, committed
+    from txtracker import tx_hash_hex
+
 app = Flask(__name__)
+# Route timings and the /metrics endpoint
+instrument_app(app)
 
 if sys.version_info[0] < 3:
     raise Exception('Python 3 or a more recent version is required.')
@@ -33,63 +66,222 @@ if sys.version_info[0] < 3:
 # Iroha peers
 IROHA_HOST_ADDR = os.getenv('IROHA_HOST_ADDR', '128.163.181.53')
 IROHA_PORT = os.getenv('IROHA_PORT', '50051')
-# IROHA_HOST_ADDR_2 = os.getenv('IROHA_HOST_ADDR', '128.163.181.54')
-# IROHA_PORT_2 = os.getenv('IROHA_PORT', '50051')
+# More peers can be listed in IROHA_PEERS, e.g. '128.163.181.53:50051,128.163.181.54:50051',
+# or read from a genesis block with IROHA_GENESIS=Network-Files/node1/genesis.block
 
 ADMIN_ACCOUNT_ID = os.getenv('ADMIN_ACCOUNT_ID', 'admin@test')
 ADMIN_PRIVATE_KEY = os.getenv(
     'ADMIN_PRIVATE_KEY', 'f101537e319568c765b2cc89698325604991dca57b9716b58016b253506cab70')
 print(ADMIN_ACCOUNT_ID)
 iroha = Iroha(ADMIN_ACCOUNT_ID)
+# The admin key is decoded once and reused for every signature
+admin_signer = Signer(ADMIN_PRIVATE_KEY)
 
-# Defining the nets for each node
-net = IrohaGrpc('{}:{}'.format(IROHA_HOST_ADDR, IROHA_PORT))
+# Defining the nets for each node, requests are spread over the pool
+net = PeerPool.from_env(IROHA_HOST_ADDR, IROHA_PORT)
 
-def trace(func):
-    """
-    A decorator for tracing methods' begin/end execution points
-    """
+# Final statuses of every transaction this service sends, polled in rounds
+# of Status calls, and no request waits longer than STATUS_TIMEOUT seconds.
+# The time to the first status a poll or block shows is the first_status
+# phase.
+resolver = StatusResolver(net, timeout=float(os.getenv('STATUS_TIMEOUT', '120')),
+                          poll_interval=float(os.getenv('STATUS_POLL_INTERVAL', '0.5')))
+resolver.on_first_status.append(
+    lambda transaction, seconds: observe_phase('first_status', seconds))
+
+# GetAccountDetail results, dropped when this service commits a change to
+# the account or after DETAIL_CACHE_TTL seconds at the latest
+detail_cache = DetailCache(max_entries=int(os.getenv('DETAIL_CACHE_SIZE', '10000')),
+                           ttl=float(os.getenv('DETAIL_CACHE_TTL', '5')))
+# One block stream per process feeds /events, started by the first
+# subscriber. With DETAIL_CACHE_BLOCKS it also keeps the cache fresh
+# against writes sent through other peers.
+event_hub = EventHub(net, iroha, admin_signer,
+                     queue_size=int(os.getenv('EVENTS_QUEUE_SIZE', '1000')))
+# once the stream runs, committed blocks resolve statuses before the next poll
+event_hub.on_block.append(resolver.resolve_block)
+# Retries of an /addehr write share the first transaction instead of
+# sending a new one, for IDEMPOTENCY_TTL seconds after it commits
+writes = IdempotentWrites(ttl=float(os.getenv('IDEMPOTENCY_TTL', '300')),
+                          max_entries=int(os.getenv('IDEMPOTENCY_SIZE', '100000')))
+# Longest a retried write waits for the first request's result, in seconds
+MAX_STATUS_WAIT = 60
+if os.getenv('DETAIL_CACHE_BLOCKS', '').lower() in ('1', 'true', 'yes'):
+    watch_blocks(detail_cache, event_hub)
+    event_hub.on_block.append(writes.invalidate_block)
+
+# Key generation and signing for bulk requests, on SIGNING_PROCESSES
+# processes (default 0: sign in the request thread)
+SIGNING_PROCESSES = int(os.getenv('SIGNING_PROCESSES', '0'))
+signing_pool = SigningPool(SIGNING_PROCESSES) if SIGNING_PROCESSES else None
+# Key manifests from /createaccount/bulk are encrypted with MANIFEST_KEY when set
+MANIFEST_KEY = os.getenv('MANIFEST_KEY')
 
-    def tracer(*args, **kwargs):
-        name = func.__name__
-        print('\tEntering "{}"'.format(name))
-        result = func(*args, **kwargs)
-        print('\tLeaving "{}"'.format(name))
-        return result
-    tracer.__name__ = func.__name__
-    return tracer
+# Multisig consent grants proposed by /cansetmydetails, with
+# co-signatures sent every CONSENT_FLUSH_INTERVAL seconds. Grants leave
+# the book once the resolver sees them final.
+consents = ConsentBook(net, flush_interval=float(os.getenv('CONSENT_FLUSH_INTERVAL', '0.2')),
+                       resolver=resolver)
 
+# Writes sent to /addehr with ?batch=1 are collected and sent together
+ehr_batcher = DetailBatcher(net, iroha, admin_signer,
+                            max_size=int(os.getenv('BATCH_MAX_SIZE', '100')),
+                            max_wait=float(os.getenv('BATCH_MAX_WAIT', '0.05')),
+                            mode=os.getenv('BATCH_MODE', 'transaction'),
+                            on_commit=detail_cache.invalidate_transaction,
+                            signing_pool=signing_pool, resolver=resolver)
 
 # Defining the commands:
 @trace
 def send_transaction_and_print_status(transaction):
-    hex_hash = binascii.hexlify(IrohaCrypto.hash(transaction))
-    print('Transaction hash = {}, creator = {}'.format(
-        hex_hash, transaction.payload.reduced_payload.creator_account_id))
-    net.send_tx(transaction)
-    result = "REJECTED\n"
-    for status in net.tx_status_stream(transaction):
-        print(status)
-        if re.search('COMMITTED', str(status)):
-            result = "COMMITTED\n"
+    if VERBOSE:
+        hex_hash = binascii.hexlify(IrohaCrypto.hash(transaction))
+        print('Transaction hash = {}, creator = {}'.format(
+            hex_hash, transaction.payload.reduced_payload.creator_account_id))
+    with phase('send'):
+        net.send_tx(transaction)
+    sent = time.perf_counter()
+    try:
+        status = resolver.wait(transaction)
+    except StatusTimeout:
+        result = "TIMEOUT\n"
+    else:
+        if VERBOSE:
+            print(status)
+        result = "COMMITTED\n" if committed(status) else "REJECTED\n"
+    observe_phase('commit', time.perf_counter() - sent)
+    count_status(result.strip())
+    if result == "COMMITTED\n":
+        detail_cache.invalidate_transaction(transaction)
     return result
 
+
+def send_transaction(transaction, **fields):
+    """
+    Send the transaction and answer {"hash", "status"} once it is final,
+    with `fields` added
+    """
+    result = send_transaction_and_print_status(transaction)
+    return respond(dict(fields, **status_document(result, tx_hash_hex(transaction))))
+
+
+def duplicate_response(write):
+    """
+    Answer a retried write with the result of the first request's
+    transaction, or with its hash and HTTP 202 if that takes longer than
+    MAX_STATUS_WAIT
+    """
+    try:
+        tx_hash = write.hash.result(timeout=MAX_STATUS_WAIT)
+        result = write.result.result(timeout=MAX_STATUS_WAIT)
+    except concurrent.futures.TimeoutError:
+        pending = {'duplicate': True}
+        if write.hash.done() and write.hash.exception() is None and write.hash.result():
+            pending['hash'] = write.hash.result()
+        return respond(pending, 202)
+    return respond(dict(status_document(result, tx_hash), duplicate=True))
+
+
+def signed_transaction(iroha, commands, signer, **kwargs):
+    """
+    Build and sign a transaction, timing both phases
+    """
+    with phase('build'):
+        tx = iroha.transaction(commands, **kwargs)
+    with phase('sign'):
+        signer.sign_transaction(tx)
+    return tx
+
         
 ### NEW COMMANDS ###
 @app.route('/getdetails/<acc_id>/<domain>')
 @trace
 def get_account_details(acc_id, domain):
     """
-    Get all the kv-storage entries for username@domain
+    Get all the kv-storage entries for username@domain as
+    {"account_id", "detail": {writer: {key: value}}}. ?page_size=,
+    ?stream=1, ?key= and ?writer= return paginated JSON instead.
     """
-    query = iroha.query('GetAccountDetail', account_id=acc_id+'@'+domain)
-    IrohaCrypto.sign_query(query, ADMIN_PRIVATE_KEY)
+    if wants_pages(request.args):
+        return details_response(request.args, net, iroha, admin_signer, acc_id + '@' + domain)
+
+    def load():
+        query = iroha.query('GetAccountDetail', account_id=acc_id+'@'+domain)
+        admin_signer.sign_query(query)
+        response = net.send_query(query)
+        if response.HasField('error_response'):
+            raise DetailQueryError(response.error_response.message
+                                   or str(response.error_response.reason))
+        # cached as the bytes sent back, not parsed
+        return response.account_detail_response.detail.encode('utf-8')
 
-    response = net.send_query(query)
-    data = response.account_detail_response
-    s = 'Account id = {}, details = {}'.format(acc_id, data.detail)
-    print(s)
-    return s
+    try:
+        detail = detail_cache.get_or_load(ADMIN_ACCOUNT_ID, acc_id+'@'+domain, load)
+    except DetailQueryError as e:
+        return {'account_id': acc_id + '@' + domain, 'error': str(e)}, 400
+    if VERBOSE:
+        print('Account id = {}, details = {}'.format(acc_id, detail.decode('utf-8')))
+    return respond_detail(acc_id + '@' + domain, detail)
+
+
+@app.route('/peerstats')
+def peer_stats():
+    """
+    Outstanding calls, latency and ejection state of each Iroha peer
+    """
+    return {'peers': net.stats()}
+
+
+@app.route('/statusstats')
+def status_stats():
+    """
+    Transactions waiting for a final status, and how they were resolved
+    """
+    return resolver.stats()
+
+
+@app.route('/cachestats')
+def cache_stats():
+    """
+    Hit and miss counters of the account detail cache
+    """
+    return detail_cache.stats()
+
+
+@app.route('/writestats')
+def write_stats():
+    """
+    Counters of /addehr writes sent, and of retries answered from them
+    """
+    return writes.stats()
+
+
+@app.route('/events')
+def events():
+    """
+    Server-Sent Events for committed SetAccountDetail and Grant/Revoke
+    Permission commands, filtered by ?account=<id@domain> and/or
+    ?domain=<domain>. ?since=<height> or the Last-Event-ID header resumes
+    after an earlier event.
+    """
+    try:
+        after = parse_position(request.headers.get('Last-Event-ID') or request.args.get('since'))
+    except ValueError:
+        return {'error': 'since must be a block height'}, 400
+    account = request.args.get('account')
+    subscription = event_hub.subscribe(accounts=[account] if account else None,
+                                       domain=request.args.get('domain'), after=after)
+    return Response(stream_with_context(sse(event_hub, subscription)),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/eventstats')
+def event_stats():
+    """
+    Block height, subscribers and dropped slow subscribers of /events
+    """
+    return event_hub.stats()
 
 
 @app.route('/newdomain/<domain>')
@@ -101,12 +293,9 @@ def create_specific_domain(domain):
     command = [
         iroha.command('CreateDomain', domain_id=domain, default_role='user')
     ]
-    print(command)
     # And sign the transaction using the keys from earlier:
-    tx = IrohaCrypto.sign_transaction(
-        iroha.transaction(command), ADMIN_PRIVATE_KEY)
-    result = send_transaction_and_print_status(tx)
-    return result
+    tx = signed_transaction(iroha, command, admin_signer)
+    return send_transaction(tx)
 
 
 @app.route('/newasset/<domain>/<asset>')
@@ -120,10 +309,8 @@ def create_specific_asset(domain, asset):
                       domain_id=domain, precision=2)
     ]
     # And sign the transaction using the keys from earlier:
-    tx = IrohaCrypto.sign_transaction(
-        iroha.transaction(command), ADMIN_PRIVATE_KEY)
-    result = send_transaction_and_print_status(tx)
-    return result
+    tx = signed_transaction(iroha, command, admin_signer)
+    return send_transaction(tx)
 
 
 # This account is created with the new admin under the healthcare domain
@@ -131,22 +318,50 @@ def create_specific_asset(domain, asset):
 @trace
 def create_account(username, acc_domain):
     """
-    Create an account in the form of 'username@domain'
+    Create an account in the form of 'username@domain' and answer its
+    new key pair with the transaction status
     """
     # Creating the user Keys for this account
     temp_private_key = IrohaCrypto.private_key()
     temp_public_key = IrohaCrypto.derive_public_key(temp_private_key)
 
-    tx = iroha.transaction([
+    tx = signed_transaction(iroha, [
         iroha.command('CreateAccount', account_name=username, domain_id=acc_domain,
                       public_key=temp_public_key)
-    ])
-    IrohaCrypto.sign_transaction(tx, ADMIN_PRIVATE_KEY)
-    result = send_transaction_and_print_status(tx)
-    print(temp_private_key, temp_public_key, result)
-    return  'Private Key: {} \nPublic Key: {} \nSuccess: {}'.format(temp_private_key, temp_public_key, result)
+    ], admin_signer)
+    return send_transaction(tx, account_id=username + '@' + acc_domain,
+                            private_key=temp_private_key.decode('ascii'),
+                            public_key=temp_public_key.decode('ascii'))
 
                         
+@app.route('/createaccount/bulk', methods=['POST'])
+@trace
+def create_accounts_bulk():
+    """
+    Create the accounts listed in a CSV or JSONL request body (account,
+    domain and optional role) and stream back the key manifest, one JSON
+    line per account, encrypted with MANIFEST_KEY when it is set.
+    ?role=<role> appends that role to every account.
+    """
+    fmt = request.args.get('format') or guess_format(request.content_type)
+    if fmt not in FORMATS:
+        return {'error': 'format must be one of {}'.format(FORMATS)}, 400
+    try:
+        batch_size = int(request.args.get('batch_size', MAX_BATCH_SIZE))
+    except ValueError:
+        return {'error': 'batch_size must be a number'}, 400
+    if not 1 <= batch_size <= MAX_BATCH_SIZE:
+        # a batch has to fit in one proposal
+        return {'error': 'batch_size must be between 1 and {}'.format(MAX_BATCH_SIZE)}, 400
+    writer = ManifestWriter(key=MANIFEST_KEY)
+    lines = (line.decode('utf-8') for line in request.stream)
+    results = with_progress(provision_accounts(
+        read_accounts(lines, fmt), net, iroha, admin_signer, signing_pool,
+        request.args.get('role'), batch_size, resolver=resolver))
+    return Response(stream_with_context(writer.line(result) for result in results),
+                    mimetype='application/x-ndjson')
+
+
 @app.route('/appendrole/<acc_id>/<acc_domain>/<role>')
 @trace
 def append_role(acc_id, acc_domain, role):
@@ -154,12 +369,10 @@ def append_role(acc_id, acc_domain, role):
     Create an account in the form of 'username@domain'
     """
     acc_id = acc_id + '@' + acc_domain
-    tx = iroha.transaction([
+    tx = signed_transaction(iroha, [
         iroha.command('AppendRole', account_id=acc_id, role_name=role)
-    ])
-    IrohaCrypto.sign_transaction(tx, ADMIN_PRIVATE_KEY)
-    result = send_transaction_and_print_status(tx)
-    return result
+    ], admin_signer)
+    return send_transaction(tx)
 
 
 @app.route('/addehr/<acc_id>/<domain>/<detail>/<ehr_reference>')
@@ -169,12 +382,51 @@ def add_ehr(acc_id, domain, detail, ehr_reference):
     Add the EHR reference number as an account detail (setting account detail)
     """
     acc_id = acc_id + '@' + domain
-    tx = iroha.transaction([
-        iroha.command('SetAccountDetail', account_id=acc_id, key=detail, value=ehr_reference)
-    ])
-    IrohaCrypto.sign_transaction(tx, ADMIN_PRIVATE_KEY)
-    result = send_transaction_and_print_status(tx)
-    return result
+    try:
+        write, first = writes.begin(ADMIN_ACCOUNT_ID, acc_id, detail, ehr_reference,
+                                    request.headers.get(HEADER))
+    except KeyReuseError as e:
+        return {'error': str(e)}, 422
+    if not first:
+        return duplicate_response(write)
+    try:
+        if request.args.get('batch', '').lower() in ('1', 'true', 'yes'):
+            writes.follow(write, ehr_batcher.add(acc_id, detail, ehr_reference))
+            try:
+                result = write.result.result(timeout=MAX_STATUS_WAIT)
+            except concurrent.futures.TimeoutError:
+                result = "TIMEOUT\n"
+            return respond(status_document(result))
+        tx = signed_transaction(iroha, [
+            iroha.command('SetAccountDetail', account_id=acc_id, key=detail, value=ehr_reference)
+        ], admin_signer)
+        result = send_transaction_and_print_status(tx)
+    except Exception as e:
+        writes.fail(write, e)
+        raise
+    writes.finish(write, result)
+    return respond(status_document(result, tx_hash_hex(tx)))
+
+
+@app.route('/addehr/bulk', methods=['POST'])
+@trace
+def add_ehr_bulk():
+    """
+    Import EHR references from a CSV or JSONL request body. The body is read
+    as a stream and one JSON line per row is streamed back as rows finish.
+    """
+    fmt = request.args.get('format') or guess_format(request.content_type)
+    if fmt not in FORMATS:
+        return {'error': 'format must be one of {}'.format(FORMATS)}, 400
+    try:
+        max_in_flight = int(request.args.get('max_in_flight', '1000'))
+    except ValueError:
+        return {'error': 'max_in_flight must be a number'}, 400
+    batcher = ehr_batcher
+    lines = (line.decode('utf-8') for line in request.stream)
+    results = with_progress(import_rows(read_rows(lines, fmt), batcher, max_in_flight))
+    return Response(stream_with_context(json.dumps(result) + '\n' for result in results),
+                    mimetype='application/x-ndjson')
 
 
 @app.route('/addpeer/<peerIP>/<peerport>/<peerkey>')
@@ -187,30 +439,78 @@ def add_peer(peerIP, peerport, peerkey):
     ip = peerIP + ":" + peerport
     peer0.address = ip
     peer0.peer_key = peerkey
-    tx = iroha.transaction([iroha.command('AddPeer', peer=peer0)])
     # And sign the transaction using the keys from earlier:
-    IrohaCrypto.sign_transaction(tx, ADMIN_PRIVATE_KEY)
-    result = send_transaction_and_print_status(tx)
-    return result
+    tx = signed_transaction(iroha, [iroha.command('AddPeer', peer=peer0)], admin_signer)
+    return send_transaction(tx)
 
 
 @app.route('/cansetmydetails/<acc_id>/<acc_dom>/<myacc_id>/<myacc_dom>')
 @trace
 def cansetmydetails(acc_id, acc_dom, myacc_id, myacc_dom):
     """
-    Give an account permission to set and get the user's account details
+    Propose a grant from myacc_id letting acc_id set its account details.
+    Only signatories of myacc_id can sign it, so it waits here for
+    ?quorum= signatures (default 1) from /consent/sign.
     """
-    # permission to set account details
     acc_id = acc_id + '@' + acc_dom
     myacc_id = myacc_id + '@' + myacc_dom
-    tx = iroha.transaction([
-        iroha.command('GrantPermission', account_id=acc_id, 
-                      permission=can_set_my_account_detail)
-    ], creator_account=myacc_id)
-    IrohaCrypto.sign_transaction(tx, ADMIN_PRIVATE_KEY)
-    result = send_transaction_and_print_status(tx)
-    print(result)
-    return result
+    try:
+        tx_hash = consents.propose(myacc_id, acc_id, ['set'],
+                                   int(request.args.get('quorum', '1')))
+    except ValueError:
+        return {'error': 'quorum must be a number'}, 400
+    except ConsentError as e:
+        return {'error': str(e)}, 400
+    return {'hash': tx_hash, 'account_id': myacc_id}, 202
+
+
+@app.route('/consent/pending')
+def consent_pending():
+    """
+    Grants proposed here that wait for signatures, for ?account=
+    """
+    return {'pending': consents.pending(request.args.get('account', ''))}
+
+
+@app.route('/consent/sign/<tx_hashes>/<user>/<userdomain>/<apikey>')
+@trace
+def consent_sign(tx_hashes, user, userdomain, apikey):
+    """
+    Co-sign comma separated pending grants with a signatory's key
+    """
+    hashes = [tx_hash.lower() for tx_hash in tx_hashes.split(',') if tx_hash]
+    try:
+        signed = consents.sign(hashes, Signer(apikey), user + '@' + userdomain)
+    except ConsentError as e:
+        return {'error': str(e)}, 400
+    return {'signed': signed}, 202
+
+
+@app.route('/consent/submit/<tx_hash>/<user>/<userdomain>/<apikey>')
+@trace
+def consent_submit(tx_hash, user, userdomain, apikey):
+    """
+    Co-sign a pending grant and send it once it has its quorum
+    """
+    try:
+        grant = consents.sign([tx_hash.lower()], Signer(apikey), user + '@' + userdomain)[0]
+        if 'error' in grant:
+            return grant, 404
+        if grant['signatures'] < grant['quorum']:
+            grant['error'] = 'needs {} more signatures'.format(grant['quorum'] - grant['signatures'])
+            return grant, 409
+        tx = consents.take(grant['hash'])
+    except ConsentError as e:
+        return {'error': str(e)}, 400
+    return send_transaction(tx)
+
+
+@app.route('/consentstats')
+def consent_stats():
+    """
+    Counters of proposed and co-signed grants and of bulk sends
+    """
+    return consents.stats()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+#
+# asyncio version of the peer pool, on grpc.aio channels.
+# Calls are coroutines, so a request waiting for consensus holds a
+# suspended coroutine instead of an OS thread. Routing follows PeerPool:
+# the peer with the fewest outstanding calls (or round robin), status
+# streams stay on the peer that received the transaction, and failing or
+# slow peers are skipped for `eject_for` seconds.
+#
+import binascii
+import itertools
+import os
+import time
+from collections import OrderedDict
+
+import grpc
+import grpc.aio
+from iroha import IrohaCrypto
+from iroha import endpoint_pb2, endpoint_pb2_grpc
+
+try:
+    from .peerpool import STRATEGIES, addresses_from_env
+except ImportError:
+    from peerpool import STRATEGIES, addresses_from_env
+
+
+class AioPeer:
+    """
+    One peer of the pool. The channel is opened on first use, inside the
+    running event loop.
+    """
+
+    def __init__(self, address, timeout):
+        self.address = address
+        self.timeout = timeout
+        self.outstanding = 0
+        self.failures = 0
+        self.latency = 0.0
+        self.ejected = False
+        self.ejected_at = 0.0
+        self._channel = None
+        self._command = None
+        self._query = None
+
+    def stubs(self):
+        if self._channel is None:
+            self._channel = grpc.aio.insecure_channel(self.address)
+            self._command = endpoint_pb2_grpc.CommandService_v1Stub(self._channel)
+            self._query = endpoint_pb2_grpc.QueryService_v1Stub(self._channel)
+        return self._command, self._query
+
+    async def close(self):
+        if self._channel is not None:
+            await self._channel.close()
+            self._channel = None
+
+    def stats(self):
+        return {
+            'address': self.address,
+            'outstanding': self.outstanding,
+            'failures': self.failures,
+            'latency': round(self.latency, 4),
+            'ejected': self.ejected,
+        }
+
+
+class AioPeerPool:
+    """
+    Spreads calls over several peers with coroutine versions of the
+    IrohaGrpc methods. Only for use from one event loop.
+    """
+
+    def __init__(self, addresses, timeout=None, strategy='least_outstanding',
+                 max_failures=3, slow_after=5.0, eject_for=30.0, sticky_size=100000):
+        if not addresses:
+            raise ValueError('at least one peer address is needed')
+        if strategy not in STRATEGIES:
+            raise ValueError('strategy must be one of {}'.format(STRATEGIES))
+        self.peers = [AioPeer(address, timeout) for address in addresses]
+        self.strategy = strategy
+        self.max_failures = max_failures
+        self.slow_after = slow_after
+        self.eject_for = eject_for
+        self.sticky_size = sticky_size
+        self._turn = itertools.count()
+        # transaction hash -> peer that received it, for status streams
+        self._sticky = OrderedDict()
+
+    @classmethod
+    def from_env(cls, default_host, default_port):
+        """
+        Pool of the peers named by addresses_from_env
+        """
+        return cls(addresses_from_env(default_host, default_port),
+                   strategy=os.getenv('IROHA_PEER_STRATEGY', 'least_outstanding'))
+
+    # IrohaGrpc methods
+
+    async def send_tx(self, transaction):
+        peer = await self._call(lambda command, query, timeout: command.Torii(
+            transaction, timeout=timeout))
+        self._stick(transaction, peer)
+        return True
+
+    async def send_txs(self, transactions):
+        tx_list = endpoint_pb2.TxList()
+        tx_list.transactions.extend(transactions)
+        peer = await self._call(lambda command, query, timeout: command.ListTorii(
+            tx_list, timeout=timeout))
+        for transaction in transactions:
+            self._stick(transaction, peer)
+        return True
+
+    async def send_query(self, query):
+        return (await self._run(lambda command, query_stub, timeout: query_stub.Find(
+            query, timeout=timeout), None))[1]
+
+    async def tx_status_stream(self, transaction):
+        """
+        (status name, status code, error code) for each status of the
+        transaction, like IrohaGrpc.tx_status_stream
+        """
+        tx_hash = binascii.hexlify(IrohaCrypto.hash(transaction))
+        request = endpoint_pb2.TxStatusRequest()
+        request.tx_hash = tx_hash
+        tried = set()
+        peer = self._sticky.get(tx_hash)
+        while True:
+            peer = peer if peer is not None and peer not in tried else self._pick(exclude=tried)
+            if peer is None:
+                raise grpc.RpcError('no peer left to follow the status stream')
+            tried.add(peer)
+            command, _ = peer.stubs()
+            try:
+                async for response in command.StatusStream(request):
+                    yield (endpoint_pb2.TxStatus.Name(response.tx_status),
+                           response.tx_status, response.error_code)
+                return
+            except grpc.RpcError:
+                self._failed(peer)
+                peer = None
+
+    def stats(self):
+        return [peer.stats() for peer in self.peers]
+
+    async def close(self):
+        for peer in self.peers:
+            await peer.close()
+
+    # routing
+
+    def _pick(self, exclude=()):
+        now = time.monotonic()
+        for peer in self.peers:
+            if peer.ejected and now - peer.ejected_at >= self.eject_for:
+                # no health thread here, ejected peers get another try later
+                peer.ejected = False
+                peer.failures = 0
+                peer.latency = 0.0
+        candidates = [p for p in self.peers if not p.ejected and p not in exclude]
+        if not candidates:
+            candidates = [p for p in self.peers if p not in exclude]
+        if not candidates:
+            return None
+        turn = next(self._turn)
+        if self.strategy == 'round_robin':
+            return candidates[turn % len(candidates)]
+        start = turn % len(candidates)
+        candidates = candidates[start:] + candidates[:start]
+        return min(candidates, key=lambda p: p.outstanding)
+
+    async def _call(self, call):
+        return (await self._run(call, None))[0]
+
+    async def _run(self, call, first):
+        tried = set()
+        error = None
+        peer = first
+        while True:
+            if peer is None or peer in tried:
+                peer = self._pick(exclude=tried)
+            if peer is None:
+                raise error
+            tried.add(peer)
+            peer.outstanding += 1
+            start = time.monotonic()
+            command, query = peer.stubs()
+            try:
+                result = await call(command, query, peer.timeout)
+            except grpc.RpcError as e:
+                error = e
+                self._failed(peer)
+                peer = None
+                continue
+            except BaseException:
+                peer.outstanding -= 1
+                raise
+            self._succeeded(peer, time.monotonic() - start)
+            return peer, result
+
+    def _succeeded(self, peer, elapsed):
+        peer.outstanding -= 1
+        peer.failures = 0
+        peer.latency = elapsed if not peer.latency else 0.8 * peer.latency + 0.2 * elapsed
+        if peer.latency > self.slow_after and not peer.ejected:
+            self._eject(peer, 'slow, {:.2f}s'.format(peer.latency))
+
+    def _failed(self, peer):
+        peer.outstanding = max(peer.outstanding - 1, 0)
+        peer.failures += 1
+        if peer.failures >= self.max_failures and not peer.ejected:
+            self._eject(peer, '{} failures in a row'.format(peer.failures))
+
+    def _eject(self, peer, reason):
+        peer.ejected = True
+        peer.ejected_at = time.monotonic()
+        print('Ejecting Iroha peer {} ({})'.format(peer.address, reason))
+
+    def _stick(self, transaction, peer):
+        tx_hash = binascii.hexlify(IrohaCrypto.hash(transaction))
+        self._sticky[tx_hash] = peer
+        while len(self._sticky) > self.sticky_size:
+            self._sticky.popitem(last=False)
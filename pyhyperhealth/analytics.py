@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+#
+# Offline analytics over Iroha block files, for audits such as "who
+# changed which patient record, and when" without querying a live peer.
+#
+# Blocks are read one file at a time from a genesis.block or a peer's
+# block_store_path, as plain JSON (no protobuf parsing), optionally on a
+# process pool with a bounded number of files in flight. Every command
+# becomes a row of a columnar table: height, created time, creator,
+# command type, target account and key. Strings are dictionary encoded,
+# so a column is an int32 array of codes, and rows are frozen into NumPy
+# chunks of `chunk_rows`. With a spill directory each chunk is written as
+# .npy files and memory-mapped back, so only one chunk and the string
+# dictionaries are held in memory however large the store is.
+# Aggregations run chunk by chunk. Reads are not recorded in blocks, so
+# the audit trail covers changes only.
+#
+# Needs NumPy: pip install pyhyperhealth[analytics]
+#
+# python3 analytics.py /tmp/block_store/ --by creator,command
+# python3 analytics.py /tmp/block_store/ --account patient1@healthcare --key ehr1 --history
+#
+import argparse
+import json
+import os
+import sys
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+
+# Columns of the command table; the string ones are dictionary encoded
+COLUMNS = ('height', 'time', 'creator', 'command', 'account', 'key')
+STRING_COLUMNS = ('creator', 'command', 'account', 'key')
+# Fields naming the target account and the key of each command, first match wins
+ACCOUNT_FIELDS = ('accountId', 'srcAccountId')
+KEY_FIELDS = ('key', 'roleName', 'permission', 'assetId', 'domainId')
+
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise RuntimeError('analytics need the numpy package, '
+                           'pip install pyhyperhealth[analytics]')
+    return numpy
+
+
+def block_files(path):
+    """
+    Block files in height order: a single file such as genesis.block, or
+    the zero padded height files of a block_store_path
+    """
+    if not os.path.isdir(path):
+        return [path]
+    heights = sorted(int(name) for name in os.listdir(path) if name.isdigit())
+    return [os.path.join(path, '{:016d}'.format(height)) for height in heights]
+
+
+def command_rows(block):
+    """
+    (height, time, creator, command, account, key) for every command of a
+    block parsed from JSON
+    """
+    payload = (block.get('block_v1') or block.get('blockV1') or block).get('payload', {})
+    height = int(payload.get('height', 0))
+    rows = []
+    for transaction in payload.get('transactions', ()):
+        reduced = transaction.get('payload', {}).get('reducedPayload', {})
+        creator = reduced.get('creatorAccountId', '')
+        created = int(reduced.get('createdTime', 0))
+        for command in reduced.get('commands', ()):
+            for name, body in command.items():
+                account = next((body[f] for f in ACCOUNT_FIELDS if f in body), '')
+                if not account and 'accountName' in body:
+                    account = '{}@{}'.format(body['accountName'], body.get('domainId', ''))
+                key = next((str(body[f]) for f in KEY_FIELDS if f in body), '')
+                rows.append((height, created, creator, name, account, key))
+    return rows
+
+
+def read_rows(paths):
+    """
+    Command rows of several block files, for a worker process
+    """
+    rows = []
+    for path in paths:
+        with open(path) as f:
+            rows.extend(command_rows(json.load(f)))
+    return rows
+
+
+def scan_rows(paths, workers=0, files_per_task=64):
+    """
+    Yield lists of command rows for the block files in order. With
+    workers, files are parsed on that many processes, at most
+    workers * 2 tasks of `files_per_task` files ahead of the caller.
+    """
+    tasks = [paths[i:i + files_per_task] for i in range(0, len(paths), files_per_task)]
+    if not workers:
+        for task in tasks:
+            yield read_rows(task)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        in_flight = deque()
+        for task in tasks:
+            in_flight.append(pool.submit(read_rows, task))
+            if len(in_flight) >= workers * 2:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
+
+
+class CommandTable:
+    """
+    Columnar table of command rows in NumPy chunks, in memory or spilled
+    to `spill_dir` and memory-mapped
+    """
+
+    def __init__(self, chunk_rows=1 << 16, spill_dir=None):
+        self.np = _numpy()
+        self.chunk_rows = chunk_rows
+        self.spill_dir = spill_dir
+        self.rows = 0
+        self._codes = {column: {} for column in STRING_COLUMNS}
+        self._values = {column: [] for column in STRING_COLUMNS}
+        self._chunks = []
+        self._pending = []
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def extend(self, rows):
+        for height, created, creator, command, account, key in rows:
+            self._pending.append((height, created, self._code('creator', creator),
+                                  self._code('command', command),
+                                  self._code('account', account), self._code('key', key)))
+            if len(self._pending) >= self.chunk_rows:
+                self._freeze()
+        self.rows += len(rows)
+
+    def chunks(self):
+        """
+        Yield each chunk as {column: array}, including unfrozen rows
+        """
+        for chunk in self._chunks:
+            if self.spill_dir:
+                yield {column: self.np.load(path, mmap_mode='r') for column, path in chunk.items()}
+            else:
+                yield chunk
+        if self._pending:
+            yield self._arrays(self._pending)
+
+    def code(self, column, value):
+        """
+        Code of a string value, or None if it never occurs
+        """
+        return self._codes[column].get(value)
+
+    def value(self, column, code):
+        if column in STRING_COLUMNS:
+            return self._values[column][code]
+        return int(code)
+
+    def count_by(self, columns, **equals):
+        """
+        Counter of rows by the values of `columns`, over the rows whose
+        string columns equal the given values
+        """
+        np = self.np
+        mask_codes = {}
+        for column, wanted in equals.items():
+            code = self.code(column, wanted)
+            if code is None:
+                return Counter()
+            mask_codes[column] = code
+        counts = Counter()
+        for chunk in self.chunks():
+            mask = np.ones(len(chunk['height']), dtype=bool)
+            for column, code in mask_codes.items():
+                mask &= chunk[column] == code
+            if not mask.any():
+                continue
+            keys = np.stack([np.asarray(chunk[column])[mask] for column in columns], axis=1)
+            unique, n = np.unique(keys, axis=0, return_counts=True)
+            for row, count in zip(unique.tolist(), n.tolist()):
+                counts[tuple(self.value(column, code)
+                             for column, code in zip(columns, row))] += count
+        return counts
+
+    def select(self, **equals):
+        """
+        Yield the rows whose string columns equal the given values, as
+        dicts in block order
+        """
+        np = self.np
+        mask_codes = {}
+        for column, wanted in equals.items():
+            code = self.code(column, wanted)
+            if code is None:
+                return
+            mask_codes[column] = code
+        for chunk in self.chunks():
+            mask = np.ones(len(chunk['height']), dtype=bool)
+            for column, code in mask_codes.items():
+                mask &= chunk[column] == code
+            for i in np.flatnonzero(mask).tolist():
+                yield {column: self.value(column, chunk[column][i]) for column in COLUMNS}
+
+    def time_range(self, **equals):
+        """
+        (first, last) created time of the matching rows, None if none match
+        """
+        first = last = None
+        for row in self.select(**equals):
+            first = row['time'] if first is None else min(first, row['time'])
+            last = row['time'] if last is None else max(last, row['time'])
+        return None if first is None else (first, last)
+
+    def stats(self):
+        return {
+            'rows': self.rows,
+            'chunks': len(self._chunks) + bool(self._pending),
+            'distinct': {column: len(self._values[column]) for column in STRING_COLUMNS},
+            'spilled': bool(self.spill_dir),
+        }
+
+    def _code(self, column, value):
+        codes = self._codes[column]
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(codes)
+            self._values[column].append(value)
+        return code
+
+    def _arrays(self, rows):
+        np = self.np
+        columns = list(zip(*rows))
+        return {
+            'height': np.array(columns[0], dtype=np.int64),
+            'time': np.array(columns[1], dtype=np.int64),
+            'creator': np.array(columns[2], dtype=np.int32),
+            'command': np.array(columns[3], dtype=np.int32),
+            'account': np.array(columns[4], dtype=np.int32),
+            'key': np.array(columns[5], dtype=np.int32),
+        }
+
+    def _freeze(self):
+        arrays = self._arrays(self._pending)
+        self._pending = []
+        if self.spill_dir:
+            paths = {}
+            for column, array in arrays.items():
+                path = os.path.join(self.spill_dir, '{:06d}-{}.npy'.format(len(self._chunks),
+                                                                          column))
+                self.np.save(path, array)
+                paths[column] = path
+            self._chunks.append(paths)
+        else:
+            self._chunks.append(arrays)
+
+
+def load(paths, workers=0, chunk_rows=1 << 16, spill_dir=None):
+    """
+    CommandTable of the commands in the given block files or block stores
+    """
+    files = [f for path in paths for f in block_files(path)]
+    table = CommandTable(chunk_rows, spill_dir)
+    for rows in scan_rows(files, workers):
+        table.extend(rows)
+    return table
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Offline analytics over Iroha block files')
+    parser.add_argument('blocks', nargs='+', help='genesis.block files or block_store_path directories')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='parse files on this many processes (default 0: in this one)')
+    parser.add_argument('--spill', help='write column chunks here instead of keeping them in memory')
+    parser.add_argument('--chunk-rows', type=int, default=1 << 16)
+    parser.add_argument('--by', default='command',
+                        help='comma separated columns to count by (default command)')
+    parser.add_argument('--account', help='only commands on this account')
+    parser.add_argument('--creator', help='only commands sent by this account')
+    parser.add_argument('--command', help='only this command type, e.g. setAccountDetail')
+    parser.add_argument('--key', help='only this detail key, role or permission')
+    parser.add_argument('--history', action='store_true',
+                        help='print the matching commands instead of counts')
+    args = parser.parse_args(argv)
+    # checked before the blocks are read, which can take a while
+    columns = [column.strip() for column in args.by.split(',') if column.strip()]
+    unknown = [column for column in columns if column not in COLUMNS]
+    if not args.history and (unknown or not columns):
+        parser.error('--by takes columns from {}'.format(', '.join(COLUMNS)))
+
+    table = load(args.blocks, args.workers, args.chunk_rows, args.spill)
+    equals = {column: getattr(args, column) for column in STRING_COLUMNS
+              if getattr(args, column)}
+    if args.history:
+        for row in table.select(**equals):
+            print(json.dumps(row))
+        return 0
+    for values, count in table.count_by(columns, **equals).most_common():
+        print('{}\t{}'.format(count, '\t'.join(str(value) for value in values)))
+    print(json.dumps(table.stats()), file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
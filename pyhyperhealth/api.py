@@ -7,14 +7,16 @@
 
 # Here are Iroha dependencies.
 # Python library generally consists of 3 parts:
-# Iroha, IrohaCrypto and IrohaGrpc which we need to import:
+# Iroha, IrohaCrypto and IrohaGrpc. The peers are reached through a
+# PeerPool (peerpool.py), so only the first two are imported:
 import os
-import re
 import binascii
+import time
+import json
 from iroha import IrohaCrypto
-from iroha import Iroha, IrohaGrpc
+from iroha import Iroha
 from iroha import primitive_pb2
-from flask import Flask, request
+from flask import Flask, Response, request, stream_with_context
 
 # The following line is actually about the permissions
 # you might be using for the transaction.
@@ -22,8 +24,53 @@ from flask import Flask, request
 # https://iroha.readthedocs.io/en/main/develop/api/permissions.html
 from iroha.primitive_pb2 import can_set_my_account_detail
 import sys
+import threading
+import concurrent.futures
+import contextlib
+from collections import OrderedDict
+
+try:
+    from .authcache import AuthCache, PermissionDenied
+    from .batcher import DetailBatcher
+    from .bulkimport import FORMATS, guess_format, import_rows, read_rows, with_progress
+    from .careteam import MODES as CHANGE_MODES, apply_changes, read_changes
+    from .consent import ConsentBook, ConsentError, NotSignatoryError
+    from .detailcache import DetailCache, watch_blocks
+    from .detailpages import DetailQueryError, detail_query, details_response, wants_pages
+    from .events import EventHub, parse_position, sse
+    from .idempotency import HEADER, IdempotentWrites, KeyReuseError
+    from .journal import TxJournal
+    from .metrics import VERBOSE, count_status, instrument_app, observe_phase, phase, trace
+    from .peerpool import MAX_BATCH_SIZE, PeerPool
+    from .provision import ManifestWriter, provision_accounts, read_accounts
+    from .responses import respond, respond_detail, status_document
+    from .signers import ClientCache, Signer, key_digest
+    from .signpool import SigningPool
+    from .statusresolver import StatusResolver, StatusTimeout, committed
+    from .txtracker import TxTracker, tx_hash_hex
+except ImportError:
+    from authcache import AuthCache, PermissionDenied
+    from batcher import DetailBatcher
+    from bulkimport import FORMATS, guess_format, import_rows, read_rows, with_progress
+    from careteam import MODES as CHANGE_MODES, apply_changes, read_changes
+    from consent import ConsentBook, ConsentError, NotSignatoryError
+    from detailcache import DetailCache, watch_blocks
+    from detailpages import DetailQueryError, detail_query, details_response, wants_pages
+    from events import EventHub, parse_position, sse
+    from idempotency import HEADER, IdempotentWrites, KeyReuseError
+    from journal import TxJournal
+    from metrics import VERBOSE, count_status, instrument_app, observe_phase, phase, trace
+    from peerpool import MAX_BATCH_SIZE, PeerPool
+    from provision import ManifestWriter, provision_accounts, read_accounts
+    from responses import respond, respond_detail, status_document
+    from signers import ClientCache, Signer, key_digest
+    from signpool import SigningPool
+    from statusresolver import StatusResolver, StatusTimeout, committed
+    from txtracker import TxTracker, tx_hash_hex
 
 app = Flask(__name__)
+# Route timings and the /metrics endpoint
+instrument_app(app)
 
 if sys.version_info[0] < 3:
     raise Exception('Python 3 or a more recent version is required.')
@@ -33,39 +80,313 @@ if sys.version_info[0] < 3:
 # Iroha peers
 IROHA_HOST_ADDR = os.getenv('IROHA_HOST_ADDR', '128.163.181.53')
 IROHA_PORT = os.getenv('IROHA_PORT', '50051')
+# More peers can be listed in IROHA_PEERS, e.g. '128.163.181.53:50051,128.163.181.54:50051',
+# or read from a genesis block with IROHA_GENESIS=Network-Files/node1/genesis.block
+
+# Defining the nets for each node, requests are spread over the pool
+net = PeerPool.from_env(IROHA_HOST_ADDR, IROHA_PORT)
+
+# Final statuses of every transaction this service sends, polled in rounds
+# of Status calls, and no request waits longer than STATUS_TIMEOUT seconds.
+# The time to the first status a poll or block shows is the first_status
+# phase.
+resolver = StatusResolver(net, timeout=float(os.getenv('STATUS_TIMEOUT', '120')),
+                          poll_interval=float(os.getenv('STATUS_POLL_INTERVAL', '0.5')))
+resolver.on_first_status.append(
+    lambda transaction, seconds: observe_phase('first_status', seconds))
+
+# GetAccountDetail results, dropped when this service commits a change to
+# the account or after DETAIL_CACHE_TTL seconds at the latest
+detail_cache = DetailCache(max_entries=int(os.getenv('DETAIL_CACHE_SIZE', '10000')),
+                           ttl=float(os.getenv('DETAIL_CACHE_TTL', '5')))
+# One block stream per process feeds /events and keeps the cache fresh
+# against writes sent through other peers. It needs an account with the
+# can_get_blocks permission.
+event_hub = None
+if os.getenv('BLOCK_STREAM_ACCOUNT_ID') and os.getenv('BLOCK_STREAM_PRIVATE_KEY'):
+    event_hub = EventHub(net, Iroha(os.getenv('BLOCK_STREAM_ACCOUNT_ID')),
+                         os.getenv('BLOCK_STREAM_PRIVATE_KEY'),
+                         queue_size=int(os.getenv('EVENTS_QUEUE_SIZE', '1000')),
+                         max_backfill=int(os.getenv('EVENTS_MAX_BACKFILL', '100')))
+    watch_blocks(detail_cache, event_hub)
+    # committed blocks resolve statuses before the next poll
+    event_hub.on_block.append(resolver.resolve_block)
+# Retries of an /addehr write share the first transaction instead of
+# sending a new one, for IDEMPOTENCY_TTL seconds after it commits
+writes = IdempotentWrites(ttl=float(os.getenv('IDEMPOTENCY_TTL', '300')),
+                          max_entries=int(os.getenv('IDEMPOTENCY_SIZE', '100000')))
+if event_hub is not None:
+    event_hub.on_block.append(writes.invalidate_block)
+# Roles and permissions from the genesis block (IROHA_GENESIS or the
+# bundled node1 block) and GetAccount/GetRolePermissions queries cached for
+# AUTH_CACHE_TTL seconds. A transaction certain to be rejected for a
+# missing role permission is answered with 403 before it is sent;
+# AUTH_PRECHECK=0 sends everything.
+auth = AuthCache(net, ttl=float(os.getenv('AUTH_CACHE_TTL', '300')))
+AUTH_GENESIS = os.getenv('IROHA_GENESIS') or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'Network-Files', 'node1', 'genesis.block')
+if os.path.exists(AUTH_GENESIS):
+    auth.load_genesis(AUTH_GENESIS)
+AUTH_PRECHECK = os.getenv('AUTH_PRECHECK', '1').lower() not in ('0', 'false', 'no')
+if event_hub is not None:
+    event_hub.on_block.append(auth.apply_block)
+# (account, key digest) pairs allowed to follow a watched account on
+# /events, checked again after EVENTS_READER_TTL seconds or as soon as a
+# committed permission or role change may have revoked the access
+event_readers = DetailCache(max_entries=int(os.getenv('EVENTS_READER_SIZE', '10000')),
+                            ttl=float(os.getenv('EVENTS_READER_TTL', '60')))
+
+
+def forget_event_readers(block):
+    """
+    Drop the /events read checks a committed block may have made stale
+    """
+    for transaction in block.block_v1.payload.transactions:
+        creator = transaction.payload.reduced_payload.creator_account_id
+        for command in transaction.payload.reduced_payload.commands:
+            name = command.WhichOneof('command')
+            if name in ('grant_permission', 'revoke_permission'):
+                event_readers.invalidate(creator)
+            elif name in ('append_role', 'detach_role', 'remove_signatory'):
+                # checks are by requester, these change what the requester may read
+                event_readers.clear()
+                return
+
 
-# Defining the nets for each node
-net = IrohaGrpc('{}:{}'.format(IROHA_HOST_ADDR, IROHA_PORT))
+if event_hub is not None:
+    event_hub.on_block.append(forget_event_readers)
+    event_hub.on_restart.append(event_readers.clear)
 
-def trace(func):
+
+# Journal of the transactions sent from here, in the TX_JOURNAL file when
+# set. Transactions an earlier process left pending are resolved or sent
+# again in the background at startup.
+journal = None
+if os.getenv('TX_JOURNAL'):
+    journal = TxJournal(os.getenv('TX_JOURNAL'),
+                        sync_interval=float(os.getenv('TX_JOURNAL_SYNC_INTERVAL', '0')))
+    threading.Thread(target=journal.recover, args=(net, resolver),
+                     name='journal-recover', daemon=True).start()
+
+
+def on_commit(transaction):
     """
-    A decorator for tracing methods' begin/end execution points
+    Keep the detail cache and the authorization cache current with a
+    transaction this service committed
     """
+    detail_cache.invalidate_transaction(transaction)
+    auth.apply_transaction(transaction)
+
+
+# Keeps the results of requests sent with ?async=1
+tracker = TxTracker(net, workers=int(os.getenv('TX_TRACKER_WORKERS', '64')),
+                    on_commit=on_commit, resolver=resolver, journal=journal)
+# Longest a /txstatus long-poll may hold a worker, in seconds
+MAX_STATUS_WAIT = 60
 
-    def tracer(*args, **kwargs):
-        name = func.__name__
-        print('\tEntering "{}"'.format(name))
-        result = func(*args, **kwargs)
-        print('\tLeaving "{}"'.format(name))
-        return result
-    tracer.__name__ = func.__name__
-    return tracer
+# Iroha builders and signers reused across requests from the same account
+clients = ClientCache(max_entries=int(os.getenv('SIGNER_CACHE_SIZE', '1000')),
+                      max_idle=float(os.getenv('SIGNER_CACHE_IDLE', '600')))
 
+# Key generation and signing for bulk requests, on SIGNING_PROCESSES
+# processes (default 0: sign in the request thread)
+SIGNING_PROCESSES = int(os.getenv('SIGNING_PROCESSES', '0'))
+signing_pool = SigningPool(SIGNING_PROCESSES) if SIGNING_PROCESSES else None
+# Key manifests from /createaccount/bulk are encrypted with MANIFEST_KEY when set
+MANIFEST_KEY = os.getenv('MANIFEST_KEY')
+
+# Multisig consent grants, with co-signatures sent every
+# CONSENT_FLUSH_INTERVAL seconds and pending lookups cached for
+# CONSENT_LOOKUP_TTL seconds. Grants leave the book once the resolver sees
+# them final.
+consents = ConsentBook(net, flush_interval=float(os.getenv('CONSENT_FLUSH_INTERVAL', '0.2')),
+                       lookup_ttl=float(os.getenv('CONSENT_LOOKUP_TTL', '2')),
+                       resolver=resolver)
+
+# One batcher per signing account for /addehr with ?batch=1 and
+# /addehr/bulk, for the BATCHERS_MAX most recently used (account, key)
+# pairs. An evicted batcher is closed once no request is using it.
+# (account, key digest) -> [batcher, requests using it]
+batchers = OrderedDict()
+batchers_lock = threading.Lock()
+MAX_BATCHERS = int(os.getenv('BATCHERS_MAX', '100'))
 
 # Defining the commands:
 @trace
 def send_transaction_and_print_status(transaction):
-    hex_hash = binascii.hexlify(IrohaCrypto.hash(transaction))
-    print('Transaction hash = {}, creator = {}'.format(
-        hex_hash, transaction.payload.reduced_payload.creator_account_id))
-    net.send_tx(transaction)
-    result = "REJECTED\n"
-    for status in net.tx_status_stream(transaction):
-        print(status)
-        if re.search('COMMITTED', str(status)):
-            result = "COMMITTED\n"
+    if VERBOSE:
+        hex_hash = binascii.hexlify(IrohaCrypto.hash(transaction))
+        print('Transaction hash = {}, creator = {}'.format(
+            hex_hash, transaction.payload.reduced_payload.creator_account_id))
+    if journal is not None:
+        with phase('journal'):
+            journal.submitted(transaction)
+    with phase('send'):
+        try:
+            net.send_tx(transaction)
+        except Exception:
+            if journal is not None:
+                # the request fails, so the next start must not resend it
+                journal.resolved(tx_hash_hex(transaction), 'SEND_FAILED')
+            raise
+    sent = time.perf_counter()
+    try:
+        status = resolver.wait(transaction)
+    except StatusTimeout:
+        # left pending in the journal, the next start looks it up
+        result = "TIMEOUT\n"
+    else:
+        if VERBOSE:
+            print(status)
+        if journal is not None:
+            journal.resolved(tx_hash_hex(transaction), status[0])
+        result = "COMMITTED\n" if committed(status) else "REJECTED\n"
+    observe_phase('commit', time.perf_counter() - sent)
+    count_status(result.strip())
+    if result == "COMMITTED\n":
+        on_commit(transaction)
     return result
 
+
+def signed_transaction(iroha, commands, signer, **kwargs):
+    """
+    Build and sign a transaction, timing both phases. Raises
+    PermissionDenied for one that is certain to be rejected.
+    """
+    with phase('build'):
+        tx = iroha.transaction(commands, **kwargs)
+    if AUTH_PRECHECK:
+        with phase('authorize'):
+            auth.check(tx, iroha, signer)
+    with phase('sign'):
+        signer.sign_transaction(tx)
+    return tx
+
+
+def wants_async():
+    """
+    True when the client asked to get the hash back without waiting
+    """
+    return request.args.get('async', '').lower() in ('1', 'true', 'yes')
+
+
+def send_transaction(transaction, **fields):
+    """
+    Send the transaction and answer {"hash", "status"} once it is final,
+    or with ?async=1 hand it to the tracker and answer the hash with HTTP
+    202. `fields` are added to the answer.
+    """
+    if wants_async():
+        tx_hash = tracker.submit(transaction)
+        return respond(dict(fields, hash=tx_hash, status_url='/txstatus/' + tx_hash), 202)
+    result = send_transaction_and_print_status(transaction)
+    return respond(dict(fields, **status_document(result, tx_hash_hex(transaction))))
+
+
+def close_batcher(batcher):
+    """
+    Send what the batcher still holds and stop it, without holding up the
+    request
+    """
+    threading.Thread(target=batcher.close, name='batcher-close', daemon=True).start()
+
+
+@contextlib.contextmanager
+def checkout_batcher(account_id, apikey):
+    """
+    Batcher that signs with the given account and key, created on first use
+    and not closed while the block runs
+    """
+    key = (account_id, key_digest(apikey))
+    idle = []
+    with batchers_lock:
+        entry = batchers.get(key)
+        if entry is None:
+            # the batcher keeps its own signer, it lives as long as the batcher
+            entry = batchers[key] = [DetailBatcher(
+                net, Iroha(account_id), Signer(apikey),
+                max_size=int(os.getenv('BATCH_MAX_SIZE', '100')),
+                max_wait=float(os.getenv('BATCH_MAX_WAIT', '0.05')),
+                mode=os.getenv('BATCH_MODE', 'transaction'),
+                on_commit=on_commit, signing_pool=signing_pool, resolver=resolver,
+                journal=journal), 0]
+        batchers.move_to_end(key)
+        entry[1] += 1
+        while len(batchers) > MAX_BATCHERS:
+            _, old = batchers.popitem(last=False)
+            if old[1] == 0:
+                idle.append(old[0])
+    for batcher in idle:
+        close_batcher(batcher)
+    try:
+        yield entry[0]
+    finally:
+        with batchers_lock:
+            entry[1] -= 1
+            evicted = entry[1] == 0 and batchers.get(key) is not entry
+        if evicted:
+            close_batcher(entry[0])
+
+
+def batch_result(write):
+    """
+    Result of a write sent in a shared batch, "TIMEOUT\n" if it is not
+    final within MAX_STATUS_WAIT
+    """
+    try:
+        return write.result.result(timeout=MAX_STATUS_WAIT)
+    except concurrent.futures.TimeoutError:
+        return "TIMEOUT\n"
+
+
+def duplicate_response(write):
+    """
+    Answer a retried write from the transaction of the first request:
+    its hash with ?async=1, otherwise its result once final. A retry that
+    outwaits MAX_STATUS_WAIT gets the hash to poll instead.
+    """
+    tx_hash = write.hash.result(timeout=MAX_STATUS_WAIT)
+    if tx_hash is None:
+        # sent in a shared batch, there is no hash of its own to hand back
+        return respond(dict(status_document(batch_result(write)), duplicate=True))
+    accepted = {'hash': tx_hash, 'status_url': '/txstatus/' + tx_hash, 'duplicate': True}
+    if wants_async():
+        return respond(accepted, 202)
+    try:
+        result = write.result.result(timeout=MAX_STATUS_WAIT)
+    except concurrent.futures.TimeoutError:
+        return respond(accepted, 202)
+    return respond(dict(status_document(result, tx_hash), duplicate=True))
+
+
+@app.errorhandler(PermissionDenied)
+def permission_denied(e):
+    """
+    A transaction refused by the authorization pre-check
+    """
+    return {'error': str(e), 'account_id': e.account_id, 'command': e.command,
+            'needed': list(e.needed)}, 403
+
+
+@app.route('/txstatus/<tx_hash>')
+def tx_status(tx_hash):
+    """
+    Status of a transaction sent with ?async=1. With ?wait=<seconds> the
+    request is held until the transaction is final or the wait runs out.
+    """
+    tx_hash = tx_hash.lower()
+    try:
+        wait = min(float(request.args.get('wait', '0')), MAX_STATUS_WAIT)
+    except ValueError:
+        return {'error': 'wait must be a number of seconds'}, 400
+    if wait > 0:
+        entry = tracker.wait(tx_hash, wait)
+    else:
+        entry = tracker.status(tx_hash)
+    if entry is None:
+        return {'hash': tx_hash, 'error': 'unknown transaction'}, 404
+    return respond(entry)
+
 # acc_id is the account ID without the domain
 # domain is the domain of the account
 # user is the account ID and the domain of the user submitting the request
@@ -75,18 +396,130 @@ def send_transaction_and_print_status(transaction):
 @trace
 def get_account_details(acc_id, domain, user, userdomain, apikey):
     """
-    Get all the kv-storage entries for username@domain
+    Get all the kv-storage entries for username@domain as
+    {"account_id", "detail": {writer: {key: value}}}. ?page_size=,
+    ?stream=1, ?key= and ?writer= return paginated JSON instead.
+    """
+    ACCOUNT_ID = user + "@" + userdomain
+    target = acc_id + '@' + domain
+    if wants_pages(request.args):
+        # a signer of its own, the stream can outlive the client cache entry
+        iroha, signer = Iroha(ACCOUNT_ID), Signer(apikey)
+        return details_response(request.args, net, iroha, signer, target)
+
+    def load():
+        with clients.get(ACCOUNT_ID, apikey) as (iroha, signer):
+            query = iroha.query('GetAccountDetail', account_id=target)
+            signer.sign_query(query)
+            response = net.send_query(query)
+            if response.HasField('error_response'):
+                raise DetailQueryError(response.error_response.message
+                                       or str(response.error_response.reason))
+            # cached as the bytes sent back, not parsed
+            return response.account_detail_response.detail.encode('utf-8')
+
+    # the key is part of the cache key, so only callers holding the same
+    # key as the first request are served from the cache
+    requester = (ACCOUNT_ID, key_digest(apikey))
+    try:
+        detail = detail_cache.get_or_load(requester, target, load)
+    except DetailQueryError as e:
+        return {'account_id': target, 'error': str(e)}, 400
+    if VERBOSE:
+        print('Account id = {}, details = {}'.format(acc_id, detail.decode('utf-8')))
+    return respond_detail(target, detail)
+
+
+@app.route('/peerstats')
+def peer_stats():
+    """
+    Outstanding calls, latency and ejection state of each Iroha peer
+    """
+    return {'peers': net.stats()}
+
+
+@app.route('/statusstats')
+def status_stats():
+    """
+    Transactions waiting for a final status, and how they were resolved
+    """
+    return resolver.stats()
+
+
+@app.route('/cachestats')
+def cache_stats():
+    """
+    Hit and miss counters of the account detail cache
+    """
+    return detail_cache.stats()
+
+
+@app.route('/writestats')
+def write_stats():
+    """
+    Counters of /addehr writes sent, and of retries answered from them
+    """
+    return writes.stats()
+
+
+@app.route('/authstats')
+def auth_stats():
+    """
+    Transactions checked against the cached roles and permissions, and
+    the transactions and commands refused without reaching the ledger
+    """
+    return auth.stats()
+
+
+@app.route('/journalstats')
+def journal_stats():
+    """
+    Size of the transaction journal, fsyncs, and what startup recovery did
     """
+    if journal is None:
+        return {'error': 'the journal needs TX_JOURNAL'}, 503
+    return journal.stats()
+
+
+@app.route('/events/<user>/<userdomain>/<apikey>')
+def events(user, userdomain, apikey):
+    """
+    Server-Sent Events for committed SetAccountDetail and Grant/Revoke
+    Permission commands on the user's account, or on ?account=<id@domain>
+    if the user may read that account's details. ?since=<height> or the
+    Last-Event-ID header resumes after an earlier event.
+    """
+    if event_hub is None:
+        return {'error': 'events need BLOCK_STREAM_ACCOUNT_ID and BLOCK_STREAM_PRIVATE_KEY'}, 503
     ACCOUNT_ID = user + "@" + userdomain
-    iroha = Iroha(ACCOUNT_ID)
-    query = iroha.query('GetAccountDetail', account_id=acc_id+'@'+domain)
-    IrohaCrypto.sign_query(query, apikey)
+    watched = request.args.get('account', ACCOUNT_ID)
+    try:
+        after = parse_position(request.headers.get('Last-Event-ID') or request.args.get('since'))
+    except ValueError:
+        return {'error': 'since must be a block height'}, 400
+    reader = (ACCOUNT_ID, key_digest(apikey))
+    if event_readers.get(reader, watched) is None:
+        # the peer decides whether this key may read the account
+        with clients.get(ACCOUNT_ID, apikey) as (iroha, signer):
+            query = detail_query(iroha, watched, page_size=1)
+            signer.sign_query(query)
+            if net.send_query(query).HasField('error_response'):
+                return {'error': 'not allowed to read {}'.format(watched)}, 403
+            event_readers.put(reader, watched, True)
+    subscription = event_hub.subscribe(accounts=[watched], after=after)
+    return Response(stream_with_context(sse(event_hub, subscription)),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
-    response = net.send_query(query)
-    data = response.account_detail_response
-    s = 'Account id = {}, details = {}'.format(acc_id, data.detail)
-    print(s)
-    return s
+
+@app.route('/eventstats')
+def event_stats():
+    """
+    Block height, subscribers and dropped slow subscribers of /events
+    """
+    if event_hub is None:
+        return {'error': 'events are not enabled'}, 503
+    return event_hub.stats()
 
 
 @app.route('/newdomain/<domain>/<user>/<userdomain>/<apikey>')
@@ -96,16 +529,13 @@ def create_specific_domain(domain, user, userdomain, apikey):
     Create domain and asset with precision 2 from given information
     """
     ACCOUNT_ID = user + "@" + userdomain
-    iroha = Iroha(ACCOUNT_ID)
-    command = [
-        iroha.command('CreateDomain', domain_id=domain, default_role='user')
-    ]
-    print(command)
-    # And sign the transaction using the keys from earlier:
-    tx = IrohaCrypto.sign_transaction(
-        iroha.transaction(command), apikey)
-    result = send_transaction_and_print_status(tx)
-    return result
+    with clients.get(ACCOUNT_ID, apikey) as (iroha, signer):
+        command = [
+            iroha.command('CreateDomain', domain_id=domain, default_role='user')
+        ]
+        # And sign the transaction using the keys from earlier:
+        tx = signed_transaction(iroha, command, signer)
+        return send_transaction(tx)
 
 
 @app.route('/newasset/<domain>/<asset>/<user>/<userdomain>/<apikey>')
@@ -115,16 +545,14 @@ def create_specific_asset(domain, asset, user, userdomain, apikey):
     Create domain and asset with precision 2 from given information
     """
     ACCOUNT_ID = user + "@" + userdomain
-    iroha = Iroha(ACCOUNT_ID)
-    command = [
-        iroha.command('CreateAsset', asset_name=asset,
-                      domain_id=domain, precision=2)
-    ]
-    # And sign the transaction using the keys from earlier:
-    tx = IrohaCrypto.sign_transaction(
-        iroha.transaction(command), apikey)
-    result = send_transaction_and_print_status(tx)
-    return result
+    with clients.get(ACCOUNT_ID, apikey) as (iroha, signer):
+        command = [
+            iroha.command('CreateAsset', asset_name=asset,
+                          domain_id=domain, precision=2)
+        ]
+        # And sign the transaction using the keys from earlier:
+        tx = signed_transaction(iroha, command, signer)
+        return send_transaction(tx)
 
 
 # This account is created with the new admin under the healthcare domain
@@ -132,24 +560,55 @@ def create_specific_asset(domain, asset, user, userdomain, apikey):
 @trace
 def create_account(newusername, acc_domain, user, userdomain, apikey):
     """
-    Create an account in the form of 'username@domain'
+    Create an account in the form of 'username@domain' and answer its
+    new key pair with the transaction status
     """
     ACCOUNT_ID = user + "@" + userdomain
-    iroha = Iroha(ACCOUNT_ID)
-    # Creating the user Keys for this account
-    temp_private_key = IrohaCrypto.private_key()
-    temp_public_key = IrohaCrypto.derive_public_key(temp_private_key)
-
-    tx = iroha.transaction([
-        iroha.command('CreateAccount', account_name=newusername, domain_id=acc_domain,
-                      public_key=temp_public_key)
-    ])
-    IrohaCrypto.sign_transaction(tx, apikey)
-    result = send_transaction_and_print_status(tx)
-    print(temp_private_key, temp_public_key, result)
-    return  'Private Key: {} \nPublic Key: {} \nSuccess: {}'.format(temp_private_key, temp_public_key, result)
+    with clients.get(ACCOUNT_ID, apikey) as (iroha, signer):
+        # Creating the user Keys for this account
+        temp_private_key = IrohaCrypto.private_key()
+        temp_public_key = IrohaCrypto.derive_public_key(temp_private_key)
+
+        tx = signed_transaction(iroha, [
+            iroha.command('CreateAccount', account_name=newusername, domain_id=acc_domain,
+                          public_key=temp_public_key)
+        ], signer)
+        return send_transaction(tx, account_id=newusername + '@' + acc_domain,
+                                private_key=temp_private_key.decode('ascii'),
+                                public_key=temp_public_key.decode('ascii'))
 
                         
+@app.route('/createaccount/bulk/<user>/<userdomain>/<apikey>', methods=['POST'])
+@trace
+def create_accounts_bulk(user, userdomain, apikey):
+    """
+    Create the accounts listed in a CSV or JSONL request body (account,
+    domain and optional role) and stream back the key manifest, one JSON
+    line per account, encrypted with MANIFEST_KEY when it is set.
+    ?role=<role> appends that role to every account.
+    """
+    fmt = request.args.get('format') or guess_format(request.content_type)
+    if fmt not in FORMATS:
+        return {'error': 'format must be one of {}'.format(FORMATS)}, 400
+    try:
+        batch_size = int(request.args.get('batch_size', MAX_BATCH_SIZE))
+    except ValueError:
+        return {'error': 'batch_size must be a number'}, 400
+    if not 1 <= batch_size <= MAX_BATCH_SIZE:
+        # a batch has to fit in one proposal
+        return {'error': 'batch_size must be between 1 and {}'.format(MAX_BATCH_SIZE)}, 400
+    # a signer of its own, the stream can outlive the client cache entry
+    account_id = user + "@" + userdomain
+    iroha, signer = Iroha(account_id), Signer(apikey)
+    writer = ManifestWriter(key=MANIFEST_KEY)
+    lines = (line.decode('utf-8') for line in request.stream)
+    results = with_progress(provision_accounts(
+        read_accounts(lines, fmt), net, iroha, signer, signing_pool,
+        request.args.get('role'), batch_size, resolver=resolver, journal=journal))
+    return Response(stream_with_context(writer.line(result) for result in results),
+                    mimetype='application/x-ndjson')
+
+
 @app.route('/appendrole/<acc_id>/<acc_domain>/<role>/<user>/<userdomain>/<apikey>')
 @trace
 def append_role(acc_id, acc_domain, role, user, userdomain, apikey):
@@ -157,14 +616,12 @@ def append_role(acc_id, acc_domain, role, user, userdomain, apikey):
     Create an account in the form of 'username@domain'
     """
     ACCOUNT_ID = user + "@" + userdomain
-    iroha = Iroha(ACCOUNT_ID)
-    acc_id = acc_id + "@" + acc_domain
-    tx = iroha.transaction([
-        iroha.command('AppendRole', account_id=acc_id, role_name=role)
-    ])
-    IrohaCrypto.sign_transaction(tx, apikey)
-    result = send_transaction_and_print_status(tx)
-    return result
+    with clients.get(ACCOUNT_ID, apikey) as (iroha, signer):
+        acc_id = acc_id + "@" + acc_domain
+        tx = signed_transaction(iroha, [
+            iroha.command('AppendRole', account_id=acc_id, role_name=role)
+        ], signer)
+        return send_transaction(tx)
 
 
 @app.route('/addehr/<acc_id>/<domain>/<detail>/<ehr_reference>/<user>/<userdomain>/<apikey>')
@@ -174,14 +631,62 @@ def add_ehr(acc_id, domain, detail, ehr_reference, user, userdomain, apikey):
     Add the EHR reference number as an account detail (setting account detail)
     """
     ACCOUNT_ID = user + "@" + userdomain
-    iroha = Iroha(ACCOUNT_ID)
     acc_id = acc_id + "@" + domain
-    tx = iroha.transaction([
-        iroha.command('SetAccountDetail', account_id=acc_id, key=detail, value=ehr_reference)
-    ])
-    IrohaCrypto.sign_transaction(tx, apikey)
-    result = send_transaction_and_print_status(tx)
-    return result
+    try:
+        write, first = writes.begin(ACCOUNT_ID, acc_id, detail, ehr_reference,
+                                    request.headers.get(HEADER), key_digest(apikey))
+    except KeyReuseError as e:
+        return {'error': str(e)}, 422
+    if not first:
+        return duplicate_response(write)
+    try:
+        if request.args.get('batch', '').lower() in ('1', 'true', 'yes'):
+            write.hash.set_result(None)
+            with checkout_batcher(ACCOUNT_ID, apikey) as batcher:
+                writes.follow(write, batcher.add(acc_id, detail, ehr_reference))
+            return respond(status_document(batch_result(write)))
+        with clients.get(ACCOUNT_ID, apikey) as (iroha, signer):
+            tx = signed_transaction(iroha, [
+                iroha.command('SetAccountDetail', account_id=acc_id, key=detail,
+                              value=ehr_reference)
+            ], signer)
+        write.hash.set_result(tx_hash_hex(tx))
+        if wants_async():
+            tx_hash = tracker.submit(tx, on_final=lambda entry: writes.finish(
+                write, "COMMITTED\n" if entry['status'] == 'COMMITTED' else "REJECTED\n"))
+            return respond({'hash': tx_hash, 'status_url': '/txstatus/' + tx_hash}, 202)
+        result = send_transaction_and_print_status(tx)
+    except Exception as e:
+        writes.fail(write, e)
+        raise
+    writes.finish(write, result)
+    return respond(status_document(result, tx_hash_hex(tx)))
+
+
+@app.route('/addehr/bulk/<user>/<userdomain>/<apikey>', methods=['POST'])
+@trace
+def add_ehr_bulk(user, userdomain, apikey):
+    """
+    Import EHR references from a CSV or JSONL request body. The body is read
+    as a stream and one JSON line per row is streamed back as rows finish.
+    """
+    fmt = request.args.get('format') or guess_format(request.content_type)
+    if fmt not in FORMATS:
+        return {'error': 'format must be one of {}'.format(FORMATS)}, 400
+    try:
+        max_in_flight = int(request.args.get('max_in_flight', '1000'))
+    except ValueError:
+        return {'error': 'max_in_flight must be a number'}, 400
+    account_id = user + "@" + userdomain
+    lines = (line.decode('utf-8') for line in request.stream)
+
+    def results():
+        with checkout_batcher(account_id, apikey) as batcher:
+            for result in with_progress(import_rows(read_rows(lines, fmt), batcher,
+                                                    max_in_flight)):
+                yield json.dumps(result) + '\n'
+
+    return Response(stream_with_context(results()), mimetype='application/x-ndjson')
 
 
 @app.route('/addpeer/<peerIP>/<peerport>/<peerkey>/<user>/<userdomain>/<apikey>')
@@ -191,34 +696,151 @@ def add_peer(peerIP, peerport, peerkey, user, userdomain, apikey):
     Add a peer to the network given an IP address
     """
     ACCOUNT_ID = user + "@" + userdomain
-    iroha = Iroha(ACCOUNT_ID)
-    peer0 = primitive_pb2.Peer()
-    peer0.address = peerIP + ":" + peerport
-    peer0.peer_key = peerkey
-    tx = iroha.transaction([iroha.command('AddPeer', peer=peer0)])
-    # And sign the transaction using the keys from earlier:
-    IrohaCrypto.sign_transaction(tx, apikey)
-    result = send_transaction_and_print_status(tx)
-    return result
+    with clients.get(ACCOUNT_ID, apikey) as (iroha, signer):
+        peer0 = primitive_pb2.Peer()
+        peer0.address = peerIP + ":" + peerport
+        peer0.peer_key = peerkey
+        # And sign the transaction using the keys from earlier:
+        tx = signed_transaction(iroha, [iroha.command('AddPeer', peer=peer0)], signer)
+        return send_transaction(tx)
 
 
 @app.route('/cansetmydetails/<acc_id>/<acc_domain>/<user>/<userdomain>/<apikey>')
 @trace
-def cansetmydetails(acc_id, myacc_id, user, userdomain, apikey):
+def cansetmydetails(acc_id, acc_domain, user, userdomain, apikey):
     """
-    Give an account permission to set and get the user's account details
+    Give an account permission to set the user's account details. The
+    grant is signed with the user's own key; an account with a quorum
+    above one grants through /consent instead.
     """
     acc_id = acc_id + "@" + acc_domain
     ACCOUNT_ID = user + "@" + userdomain
-    iroha = Iroha(ACCOUNT_ID)
-    tx = iroha.transaction([
-        iroha.command('GrantPermission', account_id=acc_id, 
-                      permission=can_set_my_account_detail)
-    ], creator_account=myacc_id)
-    IrohaCrypto.sign_transaction(tx, ADMIN_PRIVATE_KEY)
-    result = send_transaction_and_print_status(tx)
-    print(result)
-    return result
+    with clients.get(ACCOUNT_ID, apikey) as (iroha, signer):
+        tx = signed_transaction(iroha, [
+            iroha.command('GrantPermission', account_id=acc_id,
+                          permission=can_set_my_account_detail)
+        ], signer)
+        return send_transaction(tx)
+
+
+@app.route('/permissions/bulk/<user>/<userdomain>/<apikey>', methods=['POST'])
+@trace
+def change_permissions_bulk(user, userdomain, apikey):
+    """
+    Grant or revoke permissions for the (grantor, grantee, op, permission)
+    rows of a CSV or JSONL request body, for care team changes. The user's
+    key must be a signatory of each grantor. Rows are grouped by grantor
+    and sent together (?mode=batch or transaction, see careteam.py), and
+    one JSON line per row is streamed back as the results come in.
+    """
+    fmt = request.args.get('format') or guess_format(request.content_type)
+    if fmt not in FORMATS:
+        return {'error': 'format must be one of {}'.format(FORMATS)}, 400
+    mode = request.args.get('mode', 'batch')
+    if mode not in CHANGE_MODES:
+        return {'error': 'mode must be one of {}'.format(CHANGE_MODES)}, 400
+    # a signer of its own, the stream can outlive the client cache entry
+    account_id = user + "@" + userdomain
+    iroha, signer = Iroha(account_id), Signer(apikey)
+    lines = (line.decode('utf-8') for line in request.stream)
+    results = with_progress(apply_changes(
+        read_changes(lines, fmt), net, iroha, signer, mode,
+        on_commit=on_commit, resolver=resolver, journal=journal))
+    return Response(stream_with_context(json.dumps(result) + '\n' for result in results),
+                    mimetype='application/x-ndjson')
+
+
+@app.route('/consent/grant/<acc_id>/<acc_domain>/<user>/<userdomain>/<apikey>')
+@trace
+def consent_grant(acc_id, acc_domain, user, userdomain, apikey):
+    """
+    Propose a multisig grant of ?permissions= (comma separated names from
+    consent.PERMISSIONS, default set) on the
+    ?grantor= account (default the user) to acc_id, needing ?quorum=
+    signatures (default 2, at most 128). The user's key is the first
+    signature, and must be a signatory of the grantor.
+    """
+    ACCOUNT_ID = user + "@" + userdomain
+    with clients.get(ACCOUNT_ID, apikey) as (_, signer):
+        try:
+            quorum = int(request.args.get('quorum', '2'))
+            tx_hash = consents.propose(request.args.get('grantor', ACCOUNT_ID),
+                                       acc_id + "@" + acc_domain,
+                                       request.args.get('permissions', 'set').split(','),
+                                       quorum, signer)
+        except ValueError:
+            return {'error': 'quorum must be a number'}, 400
+        except NotSignatoryError as e:
+            return {'error': str(e)}, 403
+        except ConsentError as e:
+            return {'error': str(e)}, 400
+        return consents.sign([tx_hash], signer)[0], 202
+
+
+@app.route('/consent/pending/<user>/<userdomain>/<apikey>')
+@trace
+def consent_pending(user, userdomain, apikey):
+    """
+    Grants waiting for signatures on the user's account, or on ?account=
+    when the user's key is one of its signatories
+    """
+    ACCOUNT_ID = user + "@" + userdomain
+    account_id = request.args.get('account', ACCOUNT_ID)
+    with clients.get(ACCOUNT_ID, apikey) as (_, signer):
+        try:
+            return {'account_id': account_id, 'pending': consents.pending(account_id, signer)}
+        except ConsentError as e:
+            return {'error': str(e)}, 400
+
+
+@app.route('/consent/sign/<tx_hashes>/<user>/<userdomain>/<apikey>')
+@trace
+def consent_sign(tx_hashes, user, userdomain, apikey):
+    """
+    Co-sign one or more comma separated pending grants with the user's
+    key. The signatures are sent to the peers with the next flush, so the
+    request does not wait for them.
+    """
+    ACCOUNT_ID = user + "@" + userdomain
+    with clients.get(ACCOUNT_ID, apikey) as (_, signer):
+        hashes = [tx_hash.lower() for tx_hash in tx_hashes.split(',') if tx_hash]
+        try:
+            signed = consents.sign(hashes, signer, request.args.get('account', ACCOUNT_ID))
+        except ConsentError as e:
+            return {'error': str(e)}, 400
+        return {'signed': signed}, 202
+
+
+@app.route('/consent/submit/<tx_hash>/<user>/<userdomain>/<apikey>')
+@trace
+def consent_submit(tx_hash, user, userdomain, apikey):
+    """
+    Co-sign a pending grant and, once it has its quorum of signatures,
+    send it right away and wait for the result (or ?async=1)
+    """
+    ACCOUNT_ID = user + "@" + userdomain
+    with clients.get(ACCOUNT_ID, apikey) as (_, signer):
+        try:
+            account_id = request.args.get('account', ACCOUNT_ID)
+            grant = consents.sign([tx_hash.lower()], signer, account_id)[0]
+            if 'error' in grant:
+                return grant, 404
+            if grant['signatures'] < grant['quorum']:
+                grant['error'] = 'needs {} more signatures'.format(
+                    grant['quorum'] - grant['signatures'])
+                return grant, 409
+            tx = consents.take(grant['hash'])
+        except ConsentError as e:
+            return {'error': str(e)}, 400
+        return send_transaction(tx)
+
+
+@app.route('/consentstats')
+def consent_stats():
+    """
+    Counters of proposed and co-signed grants and of bulk sends
+    """
+    return consents.stats()
 
 
 if __name__ == '__main__':
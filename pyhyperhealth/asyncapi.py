@@ -0,0 +1,467 @@
+#!/usr/bin/env python3
+#
+# asyncio server mode of api.py.
+# Serves the same routes as an ASGI app, talking to Torii over grpc.aio,
+# so every request waiting on consensus is a suspended coroutine instead
+# of a blocked thread and one process can hold thousands of them.
+# Run it with any ASGI server, e.g.
+#
+#     uvicorn pyhyperhealth.asyncapi:app --port 5000
+#
+# or `python3 asyncapi.py`, which starts uvicorn itself. The bulk routes and
+# ?batch=1 stay in api.py, as they are built on threads.
+#
+import asyncio
+import json
+import os
+import sys
+import time
+from collections import OrderedDict
+from urllib.parse import parse_qsl
+
+from iroha import IrohaCrypto
+from iroha import primitive_pb2
+from iroha.primitive_pb2 import can_set_my_account_detail
+from werkzeug.exceptions import HTTPException
+from werkzeug.routing import Map, Rule
+
+try:
+    from .aiopeerpool import AioPeerPool
+    from .detailcache import DetailCache
+    from .metrics import (VERBOSE, count_request, count_status, observe_phase, phase,
+                          registry, sampled, trace)
+    from .responses import best_match, detail_body, encode, offered, status_document
+    from .signers import ClientCache, key_digest
+    from .txtracker import FINAL_STATUSES, tx_hash_hex
+except ImportError:
+    from aiopeerpool import AioPeerPool
+    from detailcache import DetailCache
+    from metrics import (VERBOSE, count_request, count_status, observe_phase, phase,
+                         registry, sampled, trace)
+    from responses import best_match, detail_body, encode, offered, status_document
+    from signers import ClientCache, key_digest
+    from txtracker import FINAL_STATUSES, tx_hash_hex
+
+
+class Request:
+    """
+    The parts of an ASGI request the routes use
+    """
+
+    def __init__(self, scope):
+        self.method = scope['method']
+        self.path = scope['path']
+        self.args = dict(parse_qsl(scope.get('query_string', b'').decode('latin-1')))
+        self.headers = {name.decode('latin-1').lower(): value.decode('latin-1')
+                        for name, value in scope.get('headers', ())}
+
+
+class AsyncApp:
+    """
+    Minimal ASGI application with Flask style routes. Route handlers are
+    coroutines taking the request and the URL variables, and return a
+    string, bytes, a dict (sent as JSON), a (body, status code) pair or a
+    (body, status code, content type) triple.
+    """
+
+    def __init__(self):
+        self.url_map = Map()
+        self.on_shutdown = []
+
+    def route(self, rule, methods=('GET',)):
+        def register(handler):
+            self.url_map.add(Rule(rule, endpoint=handler, methods=list(methods)))
+            return handler
+        return register
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                for callback in self.on_shutdown:
+                    await callback()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _http(self, scope, send):
+        start = time.perf_counter() if sampled() else None
+        request = Request(scope)
+        rule = 'unmatched'
+        content_type = None
+        adapter = self.url_map.bind('localhost')
+        try:
+            matched, kwargs = adapter.match(request.path, request.method, return_rule=True)
+        except HTTPException as e:
+            body, code = {'error': e.description}, e.code
+        else:
+            rule = matched.rule
+            try:
+                body, code, content_type = _split(await matched.endpoint(request, **kwargs))
+            except Exception as e:
+                print('Error serving {}: {!r}'.format(request.path, e))
+                body, code = {'error': str(e)}, 500
+        if isinstance(body, (dict, list)):
+            payload = json.dumps(body).encode('utf-8')
+            content_type = content_type or 'application/json'
+        elif isinstance(body, bytes):
+            payload = body
+            content_type = content_type or 'application/octet-stream'
+        else:
+            payload = str(body).encode('utf-8')
+            content_type = content_type or 'text/html; charset=utf-8'
+        await send({'type': 'http.response.start', 'status': code,
+                    'headers': [(b'content-type', content_type.encode('latin-1')),
+                                (b'content-length', str(len(payload)).encode('ascii'))]})
+        await send({'type': 'http.response.body', 'body': payload})
+        count_request(rule, request.method, code, start)
+
+
+def _split(result):
+    if not isinstance(result, tuple):
+        return result, 200, None
+    if len(result) == 2:
+        return result[0], result[1], None
+    return result
+
+
+class AsyncTxTracker:
+    """
+    TxTracker for the event loop: follows each status stream in a task for
+    at most `timeout` seconds and keeps the last `keep` results for /txstatus
+    """
+
+    def __init__(self, net, keep=10000, on_commit=None, timeout=120.0):
+        self.net = net
+        self.keep = keep
+        self.timeout = timeout
+        self.on_commit = on_commit
+        self._entries = OrderedDict()
+        self._done = {}
+        self._tasks = set()
+
+    async def submit(self, transaction):
+        tx_hash = tx_hash_hex(transaction)
+        self._entries[tx_hash] = {
+            'hash': tx_hash,
+            'creator': transaction.payload.reduced_payload.creator_account_id,
+            'status': 'NOT_RECEIVED',
+            'error_code': 0,
+            'final': False,
+            'submitted': time.time(),
+        }
+        self._done[tx_hash] = asyncio.Event()
+        self._evict()
+        try:
+            await self.net.send_tx(transaction)
+        except Exception as e:
+            self._update(tx_hash, 'SEND_FAILED', 0, True, error=str(e))
+            return tx_hash
+        task = asyncio.ensure_future(self._follow(tx_hash, transaction))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return tx_hash
+
+    def status(self, tx_hash):
+        entry = self._entries.get(tx_hash)
+        return dict(entry) if entry is not None else None
+
+    async def wait(self, tx_hash, timeout):
+        done = self._done.get(tx_hash)
+        if done is None:
+            return None
+        try:
+            await asyncio.wait_for(done.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.status(tx_hash)
+
+    async def _follow(self, tx_hash, transaction):
+        try:
+            final = await asyncio.wait_for(self._stream(tx_hash, transaction), self.timeout)
+        except asyncio.TimeoutError:
+            self._update(tx_hash, 'STATUS_TIMEOUT', 0, True,
+                         error='no final status within the timeout')
+            return
+        except Exception as e:
+            self._update(tx_hash, 'STREAM_FAILED', 0, True, error=str(e))
+            return
+        if not final:
+            self._update(tx_hash, None, None, True)
+
+    async def _stream(self, tx_hash, transaction):
+        final = False
+        async for name, _, error_code in self.net.tx_status_stream(transaction):
+            final = name in FINAL_STATUSES
+            if name == 'COMMITTED' and self.on_commit is not None:
+                self.on_commit(transaction)
+            self._update(tx_hash, name, error_code, final)
+        return final
+
+    def _update(self, tx_hash, name, error_code, final, error=None):
+        entry = self._entries.get(tx_hash)
+        if entry is None:
+            return
+        if name is not None:
+            entry['status'] = name
+            entry['error_code'] = error_code
+        if error is not None:
+            entry['error'] = error
+        entry['final'] = final
+        entry['updated'] = time.time()
+        if final:
+            self._done[tx_hash].set()
+
+    def _evict(self):
+        if len(self._entries) <= self.keep:
+            return
+        for tx_hash in list(self._entries):
+            if len(self._entries) <= self.keep:
+                break
+            if self._entries[tx_hash]['final']:
+                del self._entries[tx_hash]
+                del self._done[tx_hash]
+
+
+app = AsyncApp()
+
+if sys.version_info[0] < 3:
+    raise Exception('Python 3 or a more recent version is required.')
+
+# Iroha peers, set up the same way as api.py
+IROHA_HOST_ADDR = os.getenv('IROHA_HOST_ADDR', '128.163.181.53')
+IROHA_PORT = os.getenv('IROHA_PORT', '50051')
+net = AioPeerPool.from_env(IROHA_HOST_ADDR, IROHA_PORT)
+app.on_shutdown.append(net.close)
+
+detail_cache = DetailCache(max_entries=int(os.getenv('DETAIL_CACHE_SIZE', '10000')),
+                           ttl=float(os.getenv('DETAIL_CACHE_TTL', '5')))
+# No request follows a status stream longer than STATUS_TIMEOUT seconds
+STATUS_TIMEOUT = float(os.getenv('STATUS_TIMEOUT', '120'))
+tracker = AsyncTxTracker(net, on_commit=detail_cache.invalidate_transaction,
+                         timeout=STATUS_TIMEOUT)
+MAX_STATUS_WAIT = 60
+clients = ClientCache(max_entries=int(os.getenv('SIGNER_CACHE_SIZE', '1000')),
+                      max_idle=float(os.getenv('SIGNER_CACHE_IDLE', '600')))
+
+
+@trace
+async def send_transaction_and_print_status(transaction):
+    if VERBOSE:
+        print('Transaction hash = {}, creator = {}'.format(
+            tx_hash_hex(transaction), transaction.payload.reduced_payload.creator_account_id))
+    send_start = time.perf_counter()
+    await net.send_tx(transaction)
+    sent = time.perf_counter()
+    observe_phase('send', sent - send_start)
+
+    async def follow():
+        first = True
+        result = "REJECTED\n"
+        async for status in net.tx_status_stream(transaction):
+            if first:
+                observe_phase('first_status', time.perf_counter() - sent)
+                first = False
+            if VERBOSE:
+                print(status)
+            if status[0] == 'COMMITTED':
+                result = "COMMITTED\n"
+        return result
+
+    try:
+        result = await asyncio.wait_for(follow(), STATUS_TIMEOUT)
+    except asyncio.TimeoutError:
+        result = "TIMEOUT\n"
+    observe_phase('commit', time.perf_counter() - sent)
+    count_status(result.strip())
+    if result == "COMMITTED\n":
+        detail_cache.invalidate_transaction(transaction)
+    return result
+
+
+def signed_transaction(iroha, commands, signer, **kwargs):
+    """
+    Build and sign a transaction, timing both phases
+    """
+    with phase('build'):
+        tx = iroha.transaction(commands, **kwargs)
+    with phase('sign'):
+        signer.sign_transaction(tx)
+    return tx
+
+
+def respond(request, document, code=200):
+    """
+    The document in the format the request accepts
+    """
+    media_type = best_match(request.headers.get('accept'), offered())
+    return encode(document, media_type), code, media_type
+
+
+async def send_transaction(request, transaction, **fields):
+    """
+    Answer {"hash", "status"} once final, or with ?async=1 the hash with
+    HTTP 202. `fields` are added to the answer.
+    """
+    if request.args.get('async', '').lower() in ('1', 'true', 'yes'):
+        tx_hash = await tracker.submit(transaction)
+        return respond(request, dict(fields, hash=tx_hash, status_url='/txstatus/' + tx_hash),
+                       202)
+    result = await send_transaction_and_print_status(transaction)
+    return respond(request, dict(fields, **status_document(result, tx_hash_hex(transaction))))
+
+
+@app.route('/txstatus/<tx_hash>')
+async def tx_status(request, tx_hash):
+    """
+    Status of a transaction sent with ?async=1, ?wait=<seconds> long-polls
+    """
+    tx_hash = tx_hash.lower()
+    try:
+        wait = min(float(request.args.get('wait', '0')), MAX_STATUS_WAIT)
+    except ValueError:
+        return {'error': 'wait must be a number of seconds'}, 400
+    if wait > 0:
+        entry = await tracker.wait(tx_hash, wait)
+    else:
+        entry = tracker.status(tx_hash)
+    if entry is None:
+        return {'hash': tx_hash, 'error': 'unknown transaction'}, 404
+    return respond(request, entry)
+
+
+@app.route('/getdetails/<acc_id>/<domain>/<user>/<userdomain>/<apikey>')
+@trace
+async def get_account_details(request, acc_id, domain, user, userdomain, apikey):
+    """
+    Get all the kv-storage entries for username@domain as
+    {"account_id", "detail": {writer: {key: value}}}
+    """
+    ACCOUNT_ID = user + "@" + userdomain
+    target = acc_id + '@' + domain
+    requester = (ACCOUNT_ID, key_digest(apikey))
+    detail = detail_cache.get(requester, target)
+    if detail is None:
+        with clients.get(ACCOUNT_ID, apikey) as (iroha, signer):
+            query = iroha.query('GetAccountDetail', account_id=target)
+            signer.sign_query(query)
+            response = await net.send_query(query)
+            if response.HasField('error_response'):
+                return {'account_id': target, 'error': response.error_response.message
+                        or str(response.error_response.reason)}, 400
+            # cached as the bytes sent back, not parsed
+            detail = response.account_detail_response.detail.encode('utf-8')
+            detail_cache.put(requester, target, detail)
+    if VERBOSE:
+        print('Account id = {}, details = {}'.format(acc_id, detail.decode('utf-8')))
+    media_type = best_match(request.headers.get('accept'), offered(protobuf=True))
+    return detail_body(target, detail, media_type), 200, media_type
+
+
+@app.route('/peerstats')
+async def peer_stats(request):
+    return {'peers': net.stats()}
+
+
+@app.route('/cachestats')
+async def cache_stats(request):
+    return detail_cache.stats()
+
+
+@app.route('/metrics')
+async def metrics(request):
+    return registry.render(), 200, 'text/plain; version=0.0.4'
+
+
+@app.route('/newdomain/<domain>/<user>/<userdomain>/<apikey>')
+@trace
+async def create_specific_domain(request, domain, user, userdomain, apikey):
+    with clients.get(user + "@" + userdomain, apikey) as (iroha, signer):
+        tx = signed_transaction(iroha, [
+            iroha.command('CreateDomain', domain_id=domain, default_role='user')
+        ], signer)
+        return await send_transaction(request, tx)
+
+
+@app.route('/newasset/<domain>/<asset>/<user>/<userdomain>/<apikey>')
+@trace
+async def create_specific_asset(request, domain, asset, user, userdomain, apikey):
+    with clients.get(user + "@" + userdomain, apikey) as (iroha, signer):
+        tx = signed_transaction(iroha, [
+            iroha.command('CreateAsset', asset_name=asset, domain_id=domain, precision=2)
+        ], signer)
+        return await send_transaction(request, tx)
+
+
+@app.route('/createaccount/<newusername>/<acc_domain>/<user>/<userdomain>/<apikey>')
+@trace
+async def create_account(request, newusername, acc_domain, user, userdomain, apikey):
+    with clients.get(user + "@" + userdomain, apikey) as (iroha, signer):
+        temp_private_key = IrohaCrypto.private_key()
+        temp_public_key = IrohaCrypto.derive_public_key(temp_private_key)
+        tx = signed_transaction(iroha, [
+            iroha.command('CreateAccount', account_name=newusername, domain_id=acc_domain,
+                          public_key=temp_public_key)
+        ], signer)
+        return await send_transaction(request, tx, account_id=newusername + '@' + acc_domain,
+                                      private_key=temp_private_key.decode('ascii'),
+                                      public_key=temp_public_key.decode('ascii'))
+
+
+@app.route('/appendrole/<acc_id>/<acc_domain>/<role>/<user>/<userdomain>/<apikey>')
+@trace
+async def append_role(request, acc_id, acc_domain, role, user, userdomain, apikey):
+    with clients.get(user + "@" + userdomain, apikey) as (iroha, signer):
+        tx = signed_transaction(iroha, [
+            iroha.command('AppendRole', account_id=acc_id + "@" + acc_domain, role_name=role)
+        ], signer)
+        return await send_transaction(request, tx)
+
+
+@app.route('/addehr/<acc_id>/<domain>/<detail>/<ehr_reference>/<user>/<userdomain>/<apikey>')
+@trace
+async def add_ehr(request, acc_id, domain, detail, ehr_reference, user, userdomain, apikey):
+    with clients.get(user + "@" + userdomain, apikey) as (iroha, signer):
+        tx = signed_transaction(iroha, [
+            iroha.command('SetAccountDetail', account_id=acc_id + "@" + domain, key=detail,
+                          value=ehr_reference)
+        ], signer)
+        return await send_transaction(request, tx)
+
+
+@app.route('/addpeer/<peerIP>/<peerport>/<peerkey>/<user>/<userdomain>/<apikey>')
+@trace
+async def add_peer(request, peerIP, peerport, peerkey, user, userdomain, apikey):
+    with clients.get(user + "@" + userdomain, apikey) as (iroha, signer):
+        peer0 = primitive_pb2.Peer()
+        peer0.address = peerIP + ":" + peerport
+        peer0.peer_key = peerkey
+        tx = signed_transaction(iroha, [iroha.command('AddPeer', peer=peer0)], signer)
+        return await send_transaction(request, tx)
+
+
+@app.route('/cansetmydetails/<acc_id>/<acc_domain>/<user>/<userdomain>/<apikey>')
+@trace
+async def cansetmydetails(request, acc_id, acc_domain, user, userdomain, apikey):
+    """
+    Give an account permission to set the user's account details
+    """
+    with clients.get(user + "@" + userdomain, apikey) as (iroha, signer):
+        tx = signed_transaction(iroha, [
+            iroha.command('GrantPermission', account_id=acc_id + "@" + acc_domain,
+                          permission=can_set_my_account_detail)
+        ], signer)
+        return await send_transaction(request, tx)
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    uvicorn.run(app, host='0.0.0.0', port=int(os.getenv('PORT', '5000')))
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+#
+# Local view of roles and permissions, so a transaction that is certain to
+# be rejected is refused before it costs a consensus round.
+# Role definitions and domain default roles come from the genesis block,
+# account roles from GetAccount queries (cached for `ttl` seconds), and
+# unknown roles from GetRolePermissions. Committed transactions that append
+# or detach roles or create roles, accounts or domains keep the view
+# current; without a block stream only this process's own commits are seen.
+# A transaction is only refused when every role of its creator is known
+# and none of them has a permission a command needs, and cached roles are
+# queried again before refusing, so a role appended elsewhere is not
+# missed. Commands whose outcome also depends on grants or on the ledger
+# state are left to the peers.
+#
+import json
+import threading
+import time
+
+from iroha import primitive_pb2
+
+# Role permissions a command needs, any one of them will do
+ROLE_PERMISSIONS = {
+    'create_domain': ('can_create_domain',),
+    'create_asset': ('can_create_asset',),
+    'create_account': ('can_create_account',),
+    'create_role': ('can_create_role',),
+    'append_role': ('can_append_role',),
+    'detach_role': ('can_detach_role',),
+    'add_peer': ('can_add_peer',),
+    'remove_peer': ('can_remove_peer',),
+    'add_asset_quantity': ('can_add_asset_qty', 'can_add_domain_asset_qty'),
+    'subtract_asset_quantity': ('can_subtract_asset_qty', 'can_subtract_domain_asset_qty'),
+}
+# Commands on the creator's own account and the role permission they need
+OWN_ACCOUNT_PERMISSIONS = {
+    'add_signatory': ('can_add_signatory',),
+    'remove_signatory': ('can_remove_signatory',),
+    'set_account_quorum': ('can_set_quorum',),
+}
+
+
+class PermissionDenied(Exception):
+    """
+    A command of the transaction needs a role permission its creator lacks
+    """
+
+    def __init__(self, account_id, command, needed):
+        super().__init__('{} lacks {} for {}'.format(account_id, ' or '.join(needed), command))
+        self.account_id = account_id
+        self.command = command
+        self.needed = needed
+
+
+def needed_permissions(creator, command):
+    """
+    Role permissions the command needs, any one of them will do, or None
+    when the role permissions alone do not decide it
+    """
+    name = command.WhichOneof('command')
+    if name in ROLE_PERMISSIONS:
+        return ROLE_PERMISSIONS[name]
+    if name in OWN_ACCOUNT_PERMISSIONS and getattr(command, name).account_id == creator:
+        return OWN_ACCOUNT_PERMISSIONS[name]
+    if name in ('grant_permission', 'revoke_permission'):
+        permission = primitive_pb2.GrantablePermission.Name(getattr(command, name).permission)
+        return ('can_grant_' + permission,)
+    return None
+
+
+class AuthCache:
+    """
+    Roles and role permissions as far as they are known here, with
+    counters of the transactions checked and refused
+    """
+
+    def __init__(self, net, ttl=300.0, max_accounts=100000):
+        self.net = net
+        self.ttl = ttl
+        self.max_accounts = max_accounts
+        self.checked = 0
+        self.allowed = 0
+        self.unknown = 0
+        self.denied = 0
+        self.denied_commands = 0
+        self.queries = 0
+        self.rechecked = 0
+        self._lock = threading.Lock()
+        self._roles = {}
+        # account -> (expiry, frozenset of roles, or None if not known)
+        self._accounts = {}
+        self._default_roles = {}
+        # roles GetRolePermissions could not be asked about, until expiry
+        self._role_misses = {}
+
+    def load_genesis(self, path):
+        """
+        Roles and domain default roles created in a genesis.block file.
+        Account roles are looked up, they may have changed since genesis.
+        """
+        with open(path) as f:
+            block = json.load(f)
+        with self._lock:
+            for transaction in block['block_v1']['payload']['transactions']:
+                for command in transaction['payload']['reducedPayload']['commands']:
+                    if 'createRole' in command:
+                        c = command['createRole']
+                        self._roles[c['roleName']] = set(c.get('permissions', ()))
+                    elif 'createDomain' in command:
+                        c = command['createDomain']
+                        self._default_roles[c['domainId']] = c['defaultRole']
+        return self
+
+    def check(self, transaction, iroha, signer):
+        """
+        Raise PermissionDenied when the transaction is certain to be
+        rejected. Returns True when every command is known to be allowed
+        and None when some are left to the peers.
+        """
+        creator = transaction.payload.reduced_payload.creator_account_id
+        commands = transaction.payload.reduced_payload.commands
+        with self._lock:
+            entry = self._accounts.get(creator)
+            cached = entry is not None and entry[0] > time.monotonic()
+        try:
+            outcome = self._verdict(creator, commands, iroha, signer)
+        except PermissionDenied:
+            if not cached:
+                self._count(False, len(commands))
+                raise
+            # the roles may have changed through another peer or service
+            with self._lock:
+                self.rechecked += 1
+            try:
+                outcome = self._verdict(creator, commands, iroha, signer, cached=False)
+            except PermissionDenied:
+                self._count(False, len(commands))
+                raise
+        self._count(outcome, 0)
+        return outcome
+
+    def _verdict(self, creator, commands, iroha, signer, cached=True):
+        needed = [(command.WhichOneof('command'), needed_permissions(creator, command))
+                  for command in commands]
+        certain = all(permissions is not None for _, permissions in needed)
+        if not any(permissions is not None for _, permissions in needed):
+            return None
+        held, complete = self.permissions(creator, iroha, signer, cached)
+        if 'root' in held:
+            return True
+        for name, permissions in needed:
+            if permissions is None or any(p in held for p in permissions):
+                continue
+            if not complete:
+                certain = False
+                continue
+            raise PermissionDenied(creator, name, permissions)
+        for command in commands:
+            if command.HasField('append_role'):
+                # a role can only be appended by an account holding all of
+                # its permissions
+                role = self.role_permissions(command.append_role.role_name, iroha, signer)
+                missing = sorted(role - held) if role is not None else []
+                if missing and complete:
+                    raise PermissionDenied(creator, 'append_role', tuple(missing))
+                if role is None:
+                    certain = False
+        return True if certain else None
+
+    def permissions(self, account_id, iroha, signer, cached=True):
+        """
+        (role permissions of the account, True if all of its roles are known)
+        """
+        roles = self.account_roles(account_id, iroha, signer, cached)
+        if roles is None:
+            return set(), False
+        held = set()
+        complete = True
+        for role in roles:
+            permissions = self.role_permissions(role, iroha, signer)
+            if permissions is None:
+                complete = False
+            else:
+                held |= permissions
+        return held, complete
+
+    def account_roles(self, account_id, iroha, signer, cached=True):
+        """
+        Roles of the account, from the cache or a GetAccount query signed
+        by `signer`, or None if the peer would not say. With cached=False
+        the peer is always asked.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._accounts.get(account_id)
+            if cached and entry is not None and entry[0] > now:
+                return entry[1]
+        query = iroha.query('GetAccount', account_id=account_id)
+        signer.sign_query(query)
+        response = self.net.send_query(query)
+        with self._lock:
+            self.queries += 1
+            # a refusal is remembered too, so it is not asked on every request
+            roles = None
+            if not response.HasField('error_response'):
+                roles = frozenset(response.account_response.account_roles)
+            self._put_roles(account_id, roles)
+        return roles
+
+    def role_permissions(self, role, iroha, signer):
+        """
+        Permissions of a role, asking the peer with a GetRolePermissions
+        query for roles not seen yet, or None if the peer would not say
+        """
+        now = time.monotonic()
+        with self._lock:
+            if role in self._roles:
+                return self._roles[role]
+            if self._role_misses.get(role, 0) > now:
+                return None
+        query = iroha.query('GetRolePermissions', role_id=role)
+        signer.sign_query(query)
+        response = self.net.send_query(query)
+        with self._lock:
+            self.queries += 1
+            if response.HasField('error_response'):
+                # the requester may lack can_get_roles, ask again later
+                self._role_misses[role] = now + self.ttl
+                return None
+            permissions = {primitive_pb2.RolePermission.Name(p)
+                           for p in response.role_permissions_response.permissions}
+            self._roles[role] = permissions
+            return permissions
+
+    def apply_transaction(self, transaction):
+        """
+        Update the view with a committed transaction
+        """
+        with self._lock:
+            for command in transaction.payload.reduced_payload.commands:
+                name = command.WhichOneof('command')
+                c = getattr(command, name)
+                if name in ('append_role', 'detach_role') and c.account_id in self._accounts:
+                    expiry, roles = self._accounts.pop(c.account_id)
+                    if roles is not None:
+                        if name == 'append_role':
+                            roles = roles | {c.role_name}
+                        else:
+                            roles = roles - {c.role_name}
+                        self._accounts[c.account_id] = (expiry, roles)
+                elif name == 'create_role':
+                    self._roles[c.role_name] = {primitive_pb2.RolePermission.Name(p)
+                                                for p in c.permissions}
+                    self._role_misses.pop(c.role_name, None)
+                elif name == 'create_domain':
+                    self._default_roles[c.domain_id] = c.default_role
+                elif name == 'create_account' and c.domain_id in self._default_roles:
+                    self._put_roles('{}@{}'.format(c.account_name, c.domain_id),
+                                    frozenset((self._default_roles[c.domain_id],)))
+
+    def apply_block(self, block):
+        for transaction in block.block_v1.payload.transactions:
+            self.apply_transaction(transaction)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'checked': self.checked,
+                'allowed': self.allowed,
+                'unknown': self.unknown,
+                'denied': self.denied,
+                'denied_commands': self.denied_commands,
+                'queries': self.queries,
+                'rechecked': self.rechecked,
+                'accounts': len(self._accounts),
+                'roles': len(self._roles),
+                'ttl': self.ttl,
+            }
+
+    def _put_roles(self, account_id, roles):
+        if len(self._accounts) >= self.max_accounts and account_id not in self._accounts:
+            now = time.monotonic()
+            for key in [k for k, entry in self._accounts.items() if entry[0] <= now]:
+                del self._accounts[key]
+            if len(self._accounts) >= self.max_accounts:
+                self._accounts.pop(next(iter(self._accounts)))
+        self._accounts[account_id] = (time.monotonic() + self.ttl, roles)
+
+    def _count(self, outcome, commands):
+        with self._lock:
+            self.checked += 1
+            if outcome is True:
+                self.allowed += 1
+            elif outcome is None:
+                self.unknown += 1
+            else:
+                self.denied += 1
+                self.denied_commands += commands
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+#
+# Client side batching of SetAccountDetail commands.
+# Writes that arrive within a short window are sent together, either as
+# one transaction holding all of the commands or as Iroha batches of
+# single command transactions. Each caller gets a future for its own write.
+#
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from iroha import IrohaCrypto
+
+try:
+    from .journal import send_journaled
+    from .peerpool import split_batches
+    from .signers import as_signer
+    from .statusresolver import committed, final_status, status_future
+except ImportError:
+    from journal import send_journaled
+    from peerpool import split_batches
+    from signers import as_signer
+    from statusresolver import committed, final_status, status_future
+
+# Modes for sending the collected writes:
+# 'transaction' packs all commands into one transaction. This uses a single
+#     slot of max_proposal_size, but the transaction is atomic, so one bad
+#     command rejects every write in it.
+# 'batch' sends one transaction per write in ordered Iroha batches, so
+#     every write is committed or rejected on its own. A batch must fit in
+#     one proposal, so a flush of more than max_proposal_size writes
+#     (peerpool.MAX_BATCH_SIZE) goes out as several batches.
+MODES = ('transaction', 'batch')
+
+
+class DetailBatcher:
+    """
+    Collects SetAccountDetail writes for up to `max_wait` seconds or
+    `max_size` writes and sends them signed by one account. private_key
+    may be a hex key or a Signer. In 'batch' mode a SigningPool can be
+    given to sign the transactions of each batch on several cores.
+    on_commit, if given, is called with each transaction that commits.
+    Statuses come from the StatusResolver if one is given, otherwise from
+    a status stream per transaction on `status_workers` threads. With a
+    TxJournal the transactions are journaled like single requests.
+    """
+
+    def __init__(self, net, iroha, private_key, max_size=100, max_wait=0.05,
+                 mode='transaction', status_workers=8, on_commit=None,
+                 signing_pool=None, resolver=None, journal=None):
+        if mode not in MODES:
+            raise ValueError('mode must be one of {}'.format(MODES))
+        self.net = net
+        self.iroha = iroha
+        self.signer = as_signer(private_key)
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self.mode = mode
+        self.on_commit = on_commit
+        self.signing_pool = signing_pool
+        self.resolver = resolver
+        self.journal = journal
+        self._queue = queue.Queue()
+        self._status_pool = ThreadPoolExecutor(max_workers=status_workers,
+                                               thread_name_prefix='batcher')
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def add(self, account_id, key, value):
+        """
+        Queue a detail write and return a future for its result,
+        "COMMITTED\\n" or "REJECTED\\n" like send_transaction_and_print_status
+        """
+        future = Future()
+        self._queue.put((account_id, key, value, future))
+        return future
+
+    def close(self):
+        """
+        Send whatever is still queued and stop the batching thread
+        """
+        self._queue.put(None)
+        self._thread.join()
+        self._status_pool.shutdown(wait=True)
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is None:
+                break
+            items = [item]
+            deadline = time.monotonic() + self.max_wait
+            while len(items) < self.max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                items.append(item)
+            self._flush(items)
+
+    def _flush(self, items):
+        futures = [item[3] for item in items]
+        try:
+            commands = [
+                self.iroha.command('SetAccountDetail', account_id=account_id,
+                                   key=key, value=value)
+                for account_id, key, value, _ in items
+            ]
+            if self.mode == 'transaction':
+                tx = self.iroha.transaction(commands)
+                self.signer.sign_transaction(tx)
+                send_journaled(self.journal, [tx], lambda: self.net.send_tx(tx))
+                self._follow(tx, futures)
+            else:
+                txs = [self.iroha.transaction([command]) for command in commands]
+                batches = split_batches(txs)
+                for batch in batches:
+                    self.iroha.batch(batch, atomic=False)
+                if self.signing_pool is not None:
+                    self.signing_pool.sign_transactions(self.signer, txs)
+                else:
+                    for tx in txs:
+                        self.signer.sign_transaction(tx)
+                sent = 0
+                for batch in batches:
+                    try:
+                        send_journaled(self.journal, batch,
+                                       lambda: self.net.send_txs(batch))
+                    except Exception as e:
+                        for future in futures[sent:sent + len(batch)]:
+                            future.set_exception(e)
+                    else:
+                        for tx, future in zip(batch, futures[sent:sent + len(batch)]):
+                            self._follow(tx, [future])
+                    sent += len(batch)
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+
+    def _follow(self, tx, futures):
+        status = status_future(self.net, tx, self.resolver, self._status_pool, self.journal)
+        status.add_done_callback(lambda done: self._resolve(tx, futures, done))
+
+    def _resolve(self, tx, futures, done):
+        if done.exception() is not None:
+            for future in futures:
+                future.set_exception(done.exception())
+            return
+        result = "COMMITTED\n" if committed(done.result()) else "REJECTED\n"
+        if result == "COMMITTED\n" and self.on_commit is not None:
+            self.on_commit(tx)
+        for future in futures:
+            future.set_result(result)
+
+
+def benchmark(net, iroha, private_key, account_id, count, mode='transaction',
+              max_size=100):
+    """
+    Write `count` details one transaction at a time and then through a
+    DetailBatcher, returning commits per second for each path
+    """
+    from concurrent.futures import wait
+
+    def single(i):
+        tx = iroha.transaction([
+            iroha.command('SetAccountDetail', account_id=account_id,
+                          key='bench{}'.format(i), value=str(i))
+        ])
+        IrohaCrypto.sign_transaction(tx, private_key)
+        net.send_tx(tx)
+        return committed(final_status(net, tx))
+
+    # The single path gets as many threads as the batcher has writes in
+    # flight, so the difference comes from batching and not concurrency
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max_size) as pool:
+        single_commits = sum(pool.map(single, range(count)))
+    single_time = time.monotonic() - start
+
+    batcher = DetailBatcher(net, iroha, private_key, max_size=max_size, mode=mode)
+    start = time.monotonic()
+    futures = [batcher.add(account_id, 'bench{}'.format(i), str(count + i))
+               for i in range(count)]
+    wait(futures)
+    batched_time = time.monotonic() - start
+    batcher.close()
+    batched_commits = sum(1 for f in futures
+                          if f.exception() is None and f.result() == "COMMITTED\n")
+
+    return {
+        'writes': count,
+        'single_commits': single_commits,
+        'single_commits_per_sec': single_commits / single_time,
+        'batched_commits': batched_commits,
+        'batched_commits_per_sec': batched_commits / batched_time,
+        'mode': mode,
+    }
+
+
+# Benchmark against a running network, using the same settings as adminapi.py:
+# python3 batcher.py [writes] [transaction|batch]
+if __name__ == '__main__':
+    from iroha import Iroha, IrohaGrpc
+
+    IROHA_HOST_ADDR = os.getenv('IROHA_HOST_ADDR', '128.163.181.53')
+    IROHA_PORT = os.getenv('IROHA_PORT', '50051')
+    ADMIN_ACCOUNT_ID = os.getenv('ADMIN_ACCOUNT_ID', 'admin@test')
+    ADMIN_PRIVATE_KEY = os.getenv(
+        'ADMIN_PRIVATE_KEY', 'f101537e319568c765b2cc89698325604991dca57b9716b58016b253506cab70')
+
+    writes = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    mode = sys.argv[2] if len(sys.argv) > 2 else 'transaction'
+    net = IrohaGrpc('{}:{}'.format(IROHA_HOST_ADDR, IROHA_PORT))
+    results = benchmark(net, Iroha(ADMIN_ACCOUNT_ID), ADMIN_PRIVATE_KEY,
+                        ADMIN_ACCOUNT_ID, writes, mode=mode)
+    for name, value in results.items():
+        print('{}: {}'.format(name, value))
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+#
+# Streaming import of EHR references from CSV or JSONL files.
+# Rows are read lazily, handed to a DetailBatcher, and at most
+# `max_in_flight` rows are waiting on the ledger at any time, so memory
+# stays bounded no matter how big the file is.
+#
+# Each row needs the fields account, domain, key and reference. CSV files
+# must start with a header naming those columns.
+#
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from collections import deque
+
+FIELDS = ('account', 'domain', 'key', 'reference')
+FORMATS = ('csv', 'jsonl')
+
+
+def guess_format(name):
+    """
+    File format from a file name or content type, defaulting to csv
+    """
+    name = (name or '').lower()
+    if name.endswith('.jsonl') or name.endswith('.ndjson') or 'json' in name:
+        return 'jsonl'
+    return 'csv'
+
+
+def read_rows(lines, fmt, fields=FIELDS, optional=()):
+    """
+    Yield (row number, row dict or None, error or None) for each record in
+    an iterable of text lines. Every row needs `fields`; `optional` fields
+    are passed on when present.
+    """
+    if fmt not in FORMATS:
+        raise ValueError('format must be one of {}'.format(FORMATS))
+    if fmt == 'csv':
+        records = csv.DictReader(lines)
+    else:
+        records = iter(lines)
+    number = 0
+    while True:
+        try:
+            record = next(records)
+            if fmt == 'jsonl':
+                if not record.strip():
+                    continue
+                record = json.loads(record)
+        except StopIteration:
+            return
+        except (ValueError, csv.Error) as e:
+            number += 1
+            yield number, None, 'invalid row: {}'.format(e)
+            continue
+        number += 1
+        if not isinstance(record, dict):
+            yield number, None, 'invalid row: expected an object'
+            continue
+        missing = [field for field in fields if not record.get(field)]
+        if missing:
+            yield number, None, 'missing {}'.format(', '.join(missing))
+            continue
+        row = {field: str(record[field]) for field in fields}
+        row.update((field, str(record[field])) for field in optional if record.get(field))
+        yield number, row, None
+
+
+def import_rows(rows, batcher, max_in_flight=1000):
+    """
+    Send rows from read_rows through the batcher and yield one result dict
+    per row, in file order
+    """
+    in_flight = deque()
+
+    def finish(number, row, future, error):
+        if error is not None:
+            return {'row': number, 'result': 'INVALID', 'error': error}
+        result = {'row': number, 'account': row['account'] + '@' + row['domain'],
+                  'key': row['key']}
+        try:
+            result['result'] = future.result().strip()
+        except Exception as e:
+            result['result'] = 'ERROR'
+            result['error'] = str(e)
+        return result
+
+    for number, row, error in rows:
+        future = None
+        if error is None:
+            future = batcher.add(row['account'] + '@' + row['domain'],
+                                 row['key'], row['reference'])
+        # invalid rows wait in line too, so results come out in file order
+        in_flight.append((number, row, future, error))
+        if len(in_flight) >= max_in_flight:
+            yield finish(*in_flight.popleft())
+    while in_flight:
+        yield finish(*in_flight.popleft())
+
+
+def with_progress(results, every=1000, out=sys.stderr):
+    """
+    Pass results through, printing a progress line every `every` rows
+    """
+    start = time.monotonic()
+    counts = {}
+    total = 0
+    for result in results:
+        total += 1
+        counts[result['result']] = counts.get(result['result'], 0) + 1
+        if total % every == 0:
+            elapsed = time.monotonic() - start
+            print('{} rows, {:.1f} rows/sec, {}'.format(
+                total, total / elapsed if elapsed else 0.0, counts), file=out)
+        yield result
+    elapsed = time.monotonic() - start
+    print('done: {} rows in {:.1f}s, {}'.format(total, elapsed, counts), file=out)
+
+
+def import_file(path, batcher, fmt=None, max_in_flight=1000, results_path=None,
+                progress_every=1000):
+    """
+    Import a CSV/JSONL file, writing per-row results as JSON lines to
+    results_path (or nowhere) and returning the count of each result
+    """
+    fmt = fmt or guess_format(path)
+    counts = {}
+    results_file = open(results_path, 'w') if results_path else None
+    try:
+        with open(path, newline='') as f:
+            results = import_rows(read_rows(f, fmt), batcher, max_in_flight)
+            for result in with_progress(results, progress_every):
+                counts[result['result']] = counts.get(result['result'], 0) + 1
+                if results_file is not None:
+                    results_file.write(json.dumps(result) + '\n')
+    finally:
+        if results_file is not None:
+            results_file.close()
+    return counts
+
+
+def main(argv=None):
+    """
+    Console script: import a file as the admin account from adminapi.py
+    """
+    parser = argparse.ArgumentParser(
+        description='Import EHR references from a CSV or JSONL file')
+    parser.add_argument('path', help='file with account, domain, key, reference rows')
+    parser.add_argument('--format', choices=FORMATS, help='default: from the file name')
+    parser.add_argument('--results', help='write per-row results here as JSON lines')
+    parser.add_argument('--batch-size', type=int, default=100,
+                        help='commands per transaction (default 100)')
+    parser.add_argument('--max-in-flight', type=int, default=1000,
+                        help='rows waiting on the ledger at once (default 1000)')
+    parser.add_argument('--mode', default='transaction', choices=('transaction', 'batch'))
+    parser.add_argument('--processes', type=int, default=0,
+                        help='sign on this many processes (batch mode only, default off)')
+    args = parser.parse_args(argv)
+
+    from iroha import Iroha
+    try:
+        from .batcher import DetailBatcher
+        from .peerpool import PeerPool
+        from .signpool import SigningPool
+    except ImportError:
+        from batcher import DetailBatcher
+        from peerpool import PeerPool
+        from signpool import SigningPool
+
+    IROHA_HOST_ADDR = os.getenv('IROHA_HOST_ADDR', '128.163.181.53')
+    IROHA_PORT = os.getenv('IROHA_PORT', '50051')
+    ADMIN_ACCOUNT_ID = os.getenv('ADMIN_ACCOUNT_ID', 'admin@test')
+    ADMIN_PRIVATE_KEY = os.getenv(
+        'ADMIN_PRIVATE_KEY', 'f101537e319568c765b2cc89698325604991dca57b9716b58016b253506cab70')
+
+    net = PeerPool.from_env(IROHA_HOST_ADDR, IROHA_PORT)
+    signing_pool = SigningPool(args.processes) if args.processes else None
+    batcher = DetailBatcher(net, Iroha(ADMIN_ACCOUNT_ID), ADMIN_PRIVATE_KEY,
+                            max_size=args.batch_size, mode=args.mode,
+                            signing_pool=signing_pool)
+    try:
+        counts = import_file(args.path, batcher, args.format, args.max_in_flight,
+                             args.results)
+    finally:
+        batcher.close()
+        if signing_pool is not None:
+            signing_pool.close()
+    return 0 if set(counts) <= {'COMMITTED'} else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+#
+# Bulk permission changes for care teams.
+# A roster change is a list of rows with a grantor (the patient), a grantee
+# (the provider), an op (grant or revoke) and a permission. A grant is a
+# command of the grantor's account, so rows are grouped by grantor and
+# sent as few transactions or batches as possible, all of them before
+# waiting on any status. Each row gets its own result back.
+#
+# python3 careteam.py [pairs] [commit latency] compares this with sending
+# one transaction per pair against a fake peer.
+#
+import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+try:
+    from .bulkimport import read_rows
+    from .consent import PERMISSIONS
+    from .journal import send_journaled
+    from .peerpool import split_batches
+    from .signers import as_signer
+    from .statusresolver import StatusResolver, committed, final_status, status_future
+    from .txtracker import tx_hash_hex
+except ImportError:
+    from bulkimport import read_rows
+    from consent import PERMISSIONS
+    from journal import send_journaled
+    from peerpool import split_batches
+    from signers import as_signer
+    from statusresolver import StatusResolver, committed, final_status, status_future
+    from txtracker import tx_hash_hex
+
+CHANGE_FIELDS = ('grantor', 'grantee', 'op')
+COMMANDS = {'grant': 'GrantPermission', 'revoke': 'RevokePermission'}
+# Modes for sending the changes:
+# 'batch' sends one transaction per change in non-atomic Iroha batches, so
+#     every change is committed or rejected on its own. A batch holds at
+#     most the peers' max_proposal_size transactions (peerpool.MAX_BATCH_SIZE).
+# 'transaction' packs the changes of each grantor into one transaction.
+#     This sends the fewest transactions, but one rejected change (e.g. a
+#     grant that is already there) rejects the grantor's other changes.
+MODES = ('batch', 'transaction')
+
+
+def read_changes(lines, fmt):
+    """
+    read_rows for permission changes: grantor, grantee, op (grant or
+    revoke) and optionally a permission name from consent.PERMISSIONS,
+    set by default
+    """
+    for number, row, error in read_rows(lines, fmt, CHANGE_FIELDS, optional=('permission',)):
+        if row is not None:
+            row['op'] = row['op'].lower()
+            row.setdefault('permission', 'set')
+            if row['op'] not in COMMANDS:
+                row, error = None, 'op must be one of {}'.format(sorted(COMMANDS))
+            elif row['permission'] not in PERMISSIONS:
+                row, error = None, 'permission must be one of {}'.format(sorted(PERMISSIONS))
+        yield number, row, error
+
+
+def _pair(row):
+    return row['grantor'], row['grantee'], row['permission']
+
+
+def apply_changes(rows, net, iroha, private_key, mode='batch', chunk_size=100,
+                  status_workers=64, on_commit=None, resolver=None, journal=None):
+    """
+    Send the rows from read_changes signed with `private_key`, which must
+    be a signatory of every grantor, and yield one result per row in
+    order. A later row for the same grantor, grantee and permission
+    supersedes an earlier one, which is not sent. Transactions are signed
+    and sent `chunk_size` at a time, in batch mode as several Iroha
+    batches. on_commit, if given, is called with each transaction that
+    commits. Statuses come from `resolver` when given, and the
+    transactions go in `journal` when given.
+    """
+    if mode not in MODES:
+        raise ValueError('mode must be one of {}'.format(MODES))
+    signer = as_signer(private_key)
+    rows = list(rows)
+    # the last change of each pair and permission, grouped by grantor
+    latest = {}
+    for number, row, error in rows:
+        if row is not None:
+            latest[_pair(row)] = number
+    groups = OrderedDict()
+    for number, row, error in rows:
+        if row is not None and latest[_pair(row)] == number:
+            groups.setdefault(row['grantor'], []).append((number, row))
+
+    def command(row):
+        return iroha.command(COMMANDS[row['op']], account_id=row['grantee'],
+                             permission=PERMISSIONS[row['permission']])
+
+    # (transaction, row numbers in it) in sending order
+    txs = []
+    for grantor, changes in groups.items():
+        if mode == 'transaction':
+            for i in range(0, len(changes), chunk_size):
+                chunk = changes[i:i + chunk_size]
+                txs.append((iroha.transaction([command(row) for _, row in chunk],
+                                              creator_account=grantor),
+                            [number for number, _ in chunk]))
+        else:
+            txs.extend((iroha.transaction([command(row)], creator_account=grantor), [number])
+                       for number, row in changes)
+
+    def follow(tx):
+        def done(status):
+            if status.exception() is None and committed(status.result()):
+                on_commit(tx)
+
+        future = status_future(net, tx, resolver, status_pool, journal)
+        if on_commit is not None:
+            future.add_done_callback(done)
+        return future
+
+    status_pool = ThreadPoolExecutor(max_workers=status_workers,
+                                     thread_name_prefix='careteam')
+    sent = {}
+    try:
+        for i in range(0, len(txs), chunk_size):
+            chunk = [tx for tx, _ in txs[i:i + chunk_size]]
+            sends = [chunk]
+            if mode == 'batch':
+                # a batch has to fit in one proposal
+                sends = split_batches(chunk)
+                for batch in sends:
+                    iroha.batch(batch, atomic=False)
+            for tx in chunk:
+                signer.sign_transaction(tx)
+            futures = []
+            for group in sends:
+                try:
+                    send_journaled(journal, group, lambda: net.send_txs(group))
+                    futures.extend(follow(tx) for tx in group)
+                except Exception as e:
+                    for _ in group:
+                        future = Future()
+                        future.set_exception(e)
+                        futures.append(future)
+            for (tx, numbers), future in zip(txs[i:i + chunk_size], futures):
+                for number in numbers:
+                    sent[number] = (tx_hash_hex(tx), future)
+
+        for number, row, error in rows:
+            if error is not None:
+                yield {'row': number, 'result': 'INVALID', 'error': error}
+                continue
+            result = dict(row, row=number)
+            if number not in sent:
+                result['result'] = 'SUPERSEDED'
+                result['by'] = latest[_pair(row)]
+                yield result
+                continue
+            result['hash'], future = sent[number]
+            try:
+                result['result'] = 'COMMITTED' if committed(future.result()) else 'REJECTED'
+            except Exception as e:
+                result['result'] = 'ERROR'
+                result['error'] = str(e)
+            yield result
+    finally:
+        status_pool.shutdown(wait=False)
+
+
+def benchmark(pairs=1000, commit_latency=1.0, one_by_one=20):
+    """
+    Pairs per second for a roster change of `pairs` grants against a fake
+    peer, sent in each mode and, for `one_by_one` of them, one blocking
+    transaction per pair as /cansetmydetails does
+    """
+    from iroha import Iroha, IrohaCrypto, IrohaGrpc
+
+    try:
+        from .fakepeer import FakePeer
+    except ImportError:
+        from fakepeer import FakePeer
+
+    peer = FakePeer(commit_latency=commit_latency, workers=64)
+    net = IrohaGrpc(peer.start())
+    iroha = Iroha('admin@test')
+    private_key = IrohaCrypto.private_key()
+    resolver = StatusResolver(net, poll_interval=0.1, first_poll=commit_latency / 2)
+
+    def roster(op):
+        return [(i + 1, {'grantor': 'patient{}@healthcare'.format(i % 100),
+                         'grantee': 'provider{}@healthcare'.format(i),
+                         'op': op, 'permission': 'set'}, None)
+                for i in range(pairs)]
+
+    one_by_one = min(one_by_one, pairs)
+    results = {'pairs': pairs, 'commit_latency': commit_latency}
+    signer = as_signer(private_key)
+    start = time.monotonic()
+    for _, row, _ in roster('grant')[:one_by_one]:
+        tx = iroha.transaction([iroha.command('GrantPermission', account_id=row['grantee'],
+                                              permission=PERMISSIONS['set'])],
+                               creator_account=row['grantor'])
+        signer.sign_transaction(tx)
+        net.send_tx(tx)
+        final_status(net, tx)
+    results['one_by_one_per_sec'] = one_by_one / (time.monotonic() - start)
+    for mode in MODES:
+        start = time.monotonic()
+        outcomes = list(apply_changes(roster('grant'), net, iroha, signer, mode,
+                                      resolver=resolver))
+        elapsed = time.monotonic() - start
+        # revoke them again, so the next mode starts from the same grants
+        list(apply_changes(roster('revoke'), net, iroha, signer, mode, resolver=resolver))
+        results[mode + '_per_sec'] = pairs / elapsed
+        results[mode + '_transactions'] = len({outcome['hash'] for outcome in outcomes})
+        results[mode + '_committed'] = sum(outcome['result'] == 'COMMITTED'
+                                           for outcome in outcomes)
+    peer.stop()
+    return results
+
+
+# python3 careteam.py [pairs] [commit latency]
+if __name__ == '__main__':
+    results = benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 1000,
+                        float(sys.argv[2]) if len(sys.argv) > 2 else 1.0)
+    for name, value in results.items():
+        print('{}: {}'.format(name, value))
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+#
+# Sweeps Iroha's consensus settings (max_proposal_size, proposal_delay,
+# vote_delay and the number of peers) under the loadtest.py EHR write and
+# detail read workloads, and reports commit latency and throughput for
+# each setting, so profiles in topology.py can be chosen from measurements
+# rather than guessed. Delays are in milliseconds, as in config.docker.
+#
+# By default the peers are simulated in this process by a ConsensusPeer
+# (fakepeer.py), which paces commits in proposal and vote rounds. The
+# network hop latency and the validation and storage costs per
+# transaction and per block are parameters of the simulation; measure
+# them on the real network and pass them in. With --cluster the same sweep runs against docker
+# containers on this host: for each setting the node folders are
+# generated from a topology spec, started with `network.sh up`, loaded
+# with loadtest.py --peers and removed again with `network.sh down_node`.
+#
+# python3 consensusbench.py --proposal-size 10,100,1000 --proposal-delay 5000,1000,100
+# python3 consensusbench.py --profiles default,dev,low-latency,throughput --peers 4,7
+# python3 consensusbench.py --cluster spec.json --profiles default,dev --out sweep.json
+#
+import argparse
+import itertools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+try:
+    from .fakepeer import ConsensusPeer
+    from .loadtest import run as run_load, summarize
+    from .topology import (PROFILES, TopologyError, build, peers as spec_peers, profile,
+                           validate, wait_ready, write)
+except ImportError:
+    from fakepeer import ConsensusPeer
+    from loadtest import run as run_load, summarize
+    from topology import (PROFILES, TopologyError, build, peers as spec_peers, profile,
+                          validate, wait_ready, write)
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+NETWORK_SH = os.path.join(HERE, 'network.sh')
+LOADTEST = os.path.join(HERE, 'loadtest.py')
+# EHR writes and detail reads; account creation is left out of the sweep
+DEFAULT_MIX = 'write=0.5,read=0.5'
+SWEPT = ('peers', 'max_proposal_size', 'proposal_delay', 'vote_delay')
+
+
+def parse_list(text, kind=int):
+    """
+    '10,100,1000' -> [10, 100, 1000]
+    """
+    return [kind(part) for part in text.split(',') if part.strip()]
+
+
+def grid(peers, sizes, proposal_delays, vote_delays):
+    """
+    Every combination of the given values as sweep points
+    """
+    return [{'peers': n, 'max_proposal_size': size, 'proposal_delay': proposal_delay,
+             'vote_delay': vote_delay}
+            for n, size, proposal_delay, vote_delay
+            in itertools.product(peers, sizes, proposal_delays, vote_delays)]
+
+
+def profile_points(names, peers):
+    """
+    Sweep points with the consensus settings of topology.py profiles
+    """
+    points = []
+    for name, n in itertools.product(names, peers):
+        settings = profile(name)
+        point = {'profile': name, 'peers': n}
+        point.update({key: settings[key] for key in SWEPT if key in settings})
+        points.append(point)
+    return points
+
+
+def label(point):
+    prefix = point['profile'] + ' ' if 'profile' in point else ''
+    return '{}n={} size={} delays={}/{}'.format(prefix, point['peers'],
+                                                point['max_proposal_size'],
+                                                point['proposal_delay'], point['vote_delay'])
+
+
+def point_result(point, results, commit):
+    operations = results['operations']
+    return {
+        'point': point,
+        'commit': commit,
+        'write': operations.get('write'),
+        'read': operations.get('read'),
+        'errors': results['total']['errors'],
+        'timeouts': results['total']['timeouts'],
+        'elapsed': results['elapsed'],
+    }
+
+
+def simulate(points, threads=32, duration=30.0, mix=DEFAULT_MIX, hop_latency=0.001,
+             tx_cost=0.0005, block_cost=0.02, fault_rate=0.0, seed=1, target='api'):
+    """
+    Run the workload against a simulated network for every point and
+    yield the results as each point finishes. Commit latency is measured
+    by the simulated peer, from receiving a transaction to its block.
+    """
+    peer = ConsensusPeer(hop_latency=hop_latency, tx_cost=tx_cost, block_cost=block_cost,
+                         fault_rate=fault_rate, workers=max(64, threads * 2), seed=seed)
+    peer.start()
+    try:
+        for point in points:
+            peer.configure(peers=point['peers'], max_proposal_size=point['max_proposal_size'],
+                           proposal_delay=point['proposal_delay'] / 1000.0,
+                           vote_delay=point['vote_delay'] / 1000.0)
+            peer.reset_stats()
+            results = run_load(target, threads, duration, mix, seed=seed, peer=peer)
+            result = point_result(point, results,
+                                  summarize(peer.commit_latencies, 0, results['elapsed']))
+            result['consensus'] = peer.stats()
+            yield result
+    finally:
+        peer.stop()
+
+
+def _network(action, folder, check=True):
+    subprocess.run(['bash', NETWORK_SH, action, folder], check=check)
+
+
+def cluster(spec, points, threads=32, duration=30.0, mix=DEFAULT_MIX, seed=1, work_dir=None,
+            ready_timeout=120.0):
+    """
+    Run the workload against docker containers on this host for every
+    point and yield the results. Each point starts from a fresh ledger and
+    commit latency is the end to end latency of the EHR writes.
+    """
+    work_dir = work_dir or tempfile.mkdtemp(prefix='consensusbench-')
+    for number, point in enumerate(points):
+        overrides = dict(spec.get('overrides', {}))
+        overrides.update({key: point[key] for key in SWEPT if key != 'peers'})
+        point_spec = dict(spec, overrides=overrides)
+        if 'profile' in point:
+            point_spec['profile'] = point['profile']
+        if 'peers' not in spec:
+            point_spec['count'] = point['peers']
+        out = os.path.join(work_dir, 'point{}'.format(number))
+        files = build(point_spec, out)
+        problems = validate(files)
+        if problems:
+            raise TopologyError('; '.join(problems))
+        write(files, out)
+        folders = [os.path.join(out, name) for name in sorted(files)]
+        addresses = ['{}:{}'.format(peer['host'], peer['torii_port'])
+                     for peer in spec_peers(point_spec)]
+        started = []
+        try:
+            for folder in folders:
+                started.append(folder)
+                _network('up', folder)
+            waiting = wait_ready(addresses, ready_timeout)
+            if waiting:
+                raise RuntimeError('peers not ready: {}'.format(', '.join(waiting)))
+            out_json = os.path.join(out, 'loadtest.json')
+            subprocess.run([sys.executable, LOADTEST, '--peers', ','.join(addresses),
+                            '--threads', str(threads), '--duration', str(duration),
+                            '--mix', mix, '--seed', str(seed), '--out', out_json],
+                           check=True, stdout=subprocess.DEVNULL)
+            with open(out_json) as f:
+                results = json.load(f)
+        finally:
+            for folder in reversed(started):
+                _network('down_node', folder, check=False)
+        yield point_result(point, results, results['operations'].get('write'))
+
+
+def _seconds(value):
+    return '{:8.3f}'.format(value) if value is not None else '     n/a'
+
+
+def print_point(result, out=sys.stdout):
+    commit = result['commit'] or {}
+    read = result['read'] or {}
+    line = '{:42} {:9.1f} {} {} {} {}'.format(
+        label(result['point']), commit.get('throughput', 0.0), _seconds(commit.get('p50')),
+        _seconds(commit.get('p95')), _seconds(commit.get('p99')), _seconds(read.get('p50')))
+    if 'consensus' in result:
+        line += ' {:8.1f}'.format(result['consensus']['mean_block_size'])
+    print(line, file=out)
+    out.flush()
+
+
+def print_summary(results, out=sys.stdout):
+    measured = [r for r in results if r['commit'] and r['commit']['count']]
+    if not measured:
+        return
+    fastest = max(measured, key=lambda r: r['commit']['throughput'])
+    quickest = min(measured, key=lambda r: r['commit']['p95'])
+    print('highest throughput: {} ({:.1f} tx/s)'.format(
+        label(fastest['point']), fastest['commit']['throughput']), file=out)
+    print('lowest p95 commit latency: {} ({:.3f}s)'.format(
+        label(quickest['point']), quickest['commit']['p95']), file=out)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Sweep Iroha consensus settings under the '
+                                                 'EHR write and detail read workloads')
+    parser.add_argument('--profiles', help='topology.py profiles to measure: {}'.format(
+        ', '.join(sorted(PROFILES))))
+    parser.add_argument('--proposal-size', default='10,100,1000', help='max_proposal_size values')
+    parser.add_argument('--proposal-delay', default='5000,1000,100', help='proposal_delay values, ms')
+    parser.add_argument('--vote-delay', default='5000', help='vote_delay values, ms')
+    parser.add_argument('--peers', default='4', help='numbers of peers')
+    parser.add_argument('--threads', type=int, default=32, help='concurrent clients (default 32)')
+    parser.add_argument('--duration', type=float, default=30.0, help='seconds per setting')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help='operation weights (default {})'.format(DEFAULT_MIX))
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--hop-latency', type=float, default=0.001,
+                        help='simulated mean network hop, seconds (default 0.001)')
+    parser.add_argument('--tx-cost', type=float, default=0.0005,
+                        help='simulated validation and storage time per transaction, seconds')
+    parser.add_argument('--block-cost', type=float, default=0.02,
+                        help='simulated time to store a block, seconds (default 0.02)')
+    parser.add_argument('--fault-rate', type=float, default=0.0,
+                        help='simulated share of vote rounds that wait vote_delay and vote again')
+    parser.add_argument('--cluster', help='topology spec to run as docker containers on this '
+                                          'host instead of simulating')
+    parser.add_argument('--work-dir', help='where --cluster writes the node folders')
+    parser.add_argument('--out', help='save the results as JSON')
+    args = parser.parse_args(argv)
+
+    peers = parse_list(args.peers)
+    if args.profiles:
+        try:
+            points = profile_points([name.strip() for name in args.profiles.split(',')], peers)
+        except TopologyError as e:
+            parser.error(str(e))
+    else:
+        points = grid(peers, parse_list(args.proposal_size), parse_list(args.proposal_delay),
+                      parse_list(args.vote_delay))
+
+    if args.cluster:
+        with open(args.cluster) as f:
+            spec = json.load(f)
+        sweep = cluster(spec, points, args.threads, args.duration, args.mix, args.seed,
+                        args.work_dir)
+    else:
+        sweep = simulate(points, args.threads, args.duration, args.mix, args.hop_latency,
+                         args.tx_cost, args.block_cost, args.fault_rate, args.seed)
+
+    print('{} settings, {:.0f}s each; commit latency in seconds'.format(len(points),
+                                                                       args.duration))
+    print('{:42} {:>9} {:>8} {:>8} {:>8} {:>8}{}'.format(
+        'setting', 'tx/s', 'p50', 'p95', 'p99', 'read p50',
+        '' if args.cluster else ' {:>8}'.format('block')))
+    results = []
+    for result in sweep:
+        results.append(result)
+        print_point(result)
+    print_summary(results)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump({'mix': args.mix, 'threads': args.threads, 'duration': args.duration,
+                       'mode': 'cluster' if args.cluster else 'simulated',
+                       'simulation': None if args.cluster else {
+                           'hop_latency': args.hop_latency, 'tx_cost': args.tx_cost,
+                           'block_cost': args.block_cost, 'fault_rate': args.fault_rate},
+                       'results': results}, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+#
+# Multi-signature consent grants.
+# A patient account with a quorum above one (for example the patient's key
+# and a guardian's or the hospital's consent key) can only grant access
+# with a transaction signed by enough of its signatories. Such a grant is
+# proposed as a pending multisig (MST) transaction, which the peers hold
+# until the remaining signatories have signed it; this needs "mst_enable"
+# in the peer config.
+# The ConsentBook keeps the grants this service proposed or co-signed.
+# Signing only adds a signature to the book; a background thread sends
+# the grants with new signatures every `flush_interval` seconds, each on
+# its own so a grant the peers refuse does not take the others with it,
+# and the peers merge the signature sets. A key only signs grants of
+# accounts it is a signatory of, checked with a GetSignatories query
+# signed by that key. Pending transactions and signatories read from the
+# peers are cached for `lookup_ttl` seconds per account and key.
+# A grant leaves the book once it is final: when the resolver given to the
+# book reports a final status for it, or when the peers no longer list it
+# as pending SETTLE_TIME seconds after it was last sent.
+#
+import threading
+import time
+from collections import OrderedDict
+
+from iroha import Iroha, primitive_pb2
+
+try:
+    from .detailcache import DetailCache
+    from .txtracker import tx_hash_hex
+except ImportError:
+    from detailcache import DetailCache
+    from txtracker import tx_hash_hex
+
+# Grantable permissions by the names used in the consent routes. Reading
+# details is a role permission in Iroha, it cannot be granted.
+PERMISSIONS = {
+    'set': primitive_pb2.can_set_my_account_detail,
+    'add_signatory': primitive_pb2.can_add_my_signatory,
+    'remove_signatory': primitive_pb2.can_remove_my_signatory,
+    'quorum': primitive_pb2.can_set_my_quorum,
+}
+# GetPendingTransactions page size
+PAGE_SIZE = 100
+# Quorum range the peers accept
+MAX_QUORUM = 128
+# Seconds after sending a grant for every peer to list it as pending
+SETTLE_TIME = 5.0
+
+
+class ConsentError(Exception):
+    """
+    A grant that is unknown, or a request the peer refused
+    """
+
+
+class NotSignatoryError(ConsentError):
+    """
+    A key signing for an account it is not a signatory of
+    """
+
+
+def grant_commands(iroha, grantee, permissions):
+    """
+    GrantPermission commands for permission names from PERMISSIONS
+    """
+    unknown = [name for name in permissions if name not in PERMISSIONS]
+    if unknown or not permissions:
+        raise ConsentError('permissions must be some of {}'.format(sorted(PERMISSIONS)))
+    return [iroha.command('GrantPermission', account_id=grantee, permission=PERMISSIONS[name])
+            for name in permissions]
+
+
+def summary(transaction, sent=None):
+    """
+    JSON friendly description of a pending grant
+    """
+    payload = transaction.payload.reduced_payload
+    grants = []
+    for command in payload.commands:
+        if command.HasField('grant_permission'):
+            grants.append({
+                'account_id': command.grant_permission.account_id,
+                'permission': primitive_pb2.GrantablePermission.Name(
+                    command.grant_permission.permission),
+            })
+    result = {
+        'hash': tx_hash_hex(transaction),
+        'creator': payload.creator_account_id,
+        'grants': grants,
+        'quorum': payload.quorum,
+        'signatures': len(transaction.signatures),
+        'signed_by': [signature.public_key for signature in transaction.signatures],
+        'created_time': payload.created_time,
+    }
+    if sent is not None:
+        result['sent'] = sent
+    return result
+
+
+class ConsentBook:
+    """
+    Pending grants by transaction hash, with their signatures collected
+    here and sent to the peers in bulk
+    """
+
+    def __init__(self, net, flush_interval=0.2, lookup_ttl=2.0, max_entries=100000,
+                 max_send=500, resolver=None):
+        self.net = net
+        self.resolver = resolver
+        self.iroha = Iroha()
+        self.flush_interval = flush_interval
+        self.max_entries = max_entries
+        self.max_send = max_send
+        self.proposed = 0
+        self.signed = 0
+        self.flushed = 0
+        self.sends = 0
+        self.finished = 0
+        self._lock = threading.Lock()
+        # hash -> transaction; _dirty holds the hashes with signatures
+        # the peers do not have yet, _sent the time each grant was last
+        # sent
+        self._entries = OrderedDict()
+        self._dirty = OrderedDict()
+        self._sent = {}
+        self._lookups = DetailCache(max_entries=10000, ttl=lookup_ttl)
+        self._signatories = DetailCache(max_entries=10000, ttl=lookup_ttl)
+        self._wake = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='consent', daemon=True)
+        self._thread.start()
+
+    def propose(self, grantor, grantee, permissions, quorum, signer=None):
+        """
+        Add a grant from `grantor` to `grantee` that needs `quorum`
+        signatures, signed by `signer` if given, and return its hash
+        """
+        if not 1 <= quorum <= MAX_QUORUM:
+            raise ConsentError('quorum must be between 1 and {}'.format(MAX_QUORUM))
+        if signer is not None:
+            self.check_signatory(grantor, signer)
+        transaction = self.iroha.transaction(
+            grant_commands(self.iroha, grantee, permissions),
+            quorum=quorum, creator_account=grantor)
+        tx_hash = tx_hash_hex(transaction)
+        with self._lock:
+            self._entries[tx_hash] = transaction
+            self.proposed += 1
+            while len(self._entries) > self.max_entries:
+                old_hash, _ = self._entries.popitem(last=False)
+                self._dirty.pop(old_hash, None)
+                self._sent.pop(old_hash, None)
+        if signer is not None:
+            self.sign([tx_hash], signer)
+        return tx_hash
+
+    def sign(self, hashes, signer, account_id=None):
+        """
+        Add the signer's signature to each grant and queue it to be sent.
+        Grants this book does not hold are looked up among the pending
+        transactions of `account_id`, queried with the signer's key.
+        Returns a summary per hash, or an 'error' for unknown ones and for
+        grants of accounts the signer is not a signatory of.
+        """
+        missing = [tx_hash for tx_hash in hashes if not self._has(tx_hash)]
+        if missing and account_id:
+            pending = self.lookup(account_id, signer)
+            self._settle(account_id, pending)
+            with self._lock:
+                for tx_hash in missing:
+                    if tx_hash in pending and tx_hash not in self._entries:
+                        # a copy, the cached lookup stays as the peers sent it
+                        transaction = type(pending[tx_hash])()
+                        transaction.CopyFrom(pending[tx_hash])
+                        self._entries[tx_hash] = transaction
+        public_key = signer.public_key.decode('ascii')
+        results = []
+        for tx_hash in hashes:
+            with self._lock:
+                transaction = self._entries.get(tx_hash)
+                if transaction is None:
+                    results.append({'hash': tx_hash, 'error': 'unknown pending transaction'})
+                    continue
+            try:
+                self.check_signatory(transaction.payload.reduced_payload.creator_account_id,
+                                     signer)
+            except ConsentError as e:
+                results.append({'hash': tx_hash, 'error': str(e)})
+                continue
+            if all(signature.public_key != public_key for signature in transaction.signatures):
+                # the signature covers the payload only, so it is made
+                # outside the lock
+                signature = signer.signature(transaction)
+                with self._lock:
+                    if all(s.public_key != public_key for s in transaction.signatures):
+                        transaction.signatures.extend([signature])
+                        self._dirty[tx_hash] = True
+                        self.signed += 1
+            with self._lock:
+                results.append(summary(transaction, sent=tx_hash not in self._dirty))
+        self._wake.set()
+        return results
+
+    def take(self, tx_hash):
+        """
+        Remove a grant from the book to send it now, returning the
+        transaction with every signature collected so far
+        """
+        with self._lock:
+            transaction = self._entries.pop(tx_hash, None)
+            self._dirty.pop(tx_hash, None)
+            self._sent.pop(tx_hash, None)
+        if transaction is None:
+            raise ConsentError('unknown pending transaction')
+        self._lookups.invalidate(transaction.payload.reduced_payload.creator_account_id)
+        return transaction
+
+    def pending(self, account_id, signer=None):
+        """
+        Summaries of the grants pending for an account: the ones held by
+        the peers, read with the signer's key, merged with the signatures
+        collected here. Without a signer only this book is listed.
+        """
+        merged = {}
+        if signer is not None:
+            merged = dict(self.lookup(account_id, signer))
+            self._settle(account_id, merged)
+        with self._lock:
+            for tx_hash, transaction in self._entries.items():
+                if transaction.payload.reduced_payload.creator_account_id == account_id:
+                    merged[tx_hash] = transaction
+            dirty = set(self._dirty)
+        return [summary(transaction, sent=tx_hash not in dirty)
+                for tx_hash, transaction in merged.items()]
+
+    def lookup(self, account_id, signer):
+        """
+        {hash: transaction} of the account's pending transactions as the
+        peers hold them, cached per account and key
+        """
+        def load():
+            transactions = {}
+            first_tx_hash = None
+            while True:
+                query = self.iroha.query('GetPendingTransactions', creator_account=account_id,
+                                         page_size=PAGE_SIZE, first_tx_hash=first_tx_hash)
+                signer.sign_query(query)
+                response = self.net.send_query(query)
+                if response.HasField('error_response'):
+                    raise ConsentError(response.error_response.message
+                                       or str(response.error_response.reason))
+                page = response.pending_transactions_page_response
+                for transaction in page.transactions:
+                    transactions[tx_hash_hex(transaction)] = transaction
+                if not page.HasField('next_batch_info'):
+                    return transactions
+                first_tx_hash = page.next_batch_info.first_tx_hash
+
+        requester = (account_id, signer.public_key)
+        return self._lookups.get_or_load(requester, account_id, load)
+
+    def check_signatory(self, account_id, signer):
+        """
+        Raise NotSignatoryError unless the signer's key is one of the
+        account's signatories. The GetSignatories query is signed with that
+        key as the account, so the peers only answer it for a signatory.
+        """
+        def load():
+            query = self.iroha.query('GetSignatories', creator_account=account_id,
+                                     account_id=account_id)
+            signer.sign_query(query)
+            response = self.net.send_query(query)
+            if response.HasField('error_response'):
+                return set()
+            return {key.lower() for key in response.signatories_response.keys}
+
+        requester = (account_id, signer.public_key)
+        keys = self._signatories.get_or_load(requester, account_id, load)
+        if not keys or signer.public_key.decode('ascii').lower() not in keys:
+            raise NotSignatoryError('not a signatory of {}'.format(account_id))
+
+    def flush(self):
+        """
+        Send the grants with signatures the peers do not have yet, one
+        transaction per call. Grants that fail to send stay queued.
+        """
+        with self._lock:
+            hashes = list(self._dirty)[:self.max_send]
+            batch = []
+            for tx_hash in hashes:
+                del self._dirty[tx_hash]
+                copy = type(self._entries[tx_hash])()
+                copy.CopyFrom(self._entries[tx_hash])
+                batch.append((tx_hash, copy))
+        if not batch:
+            return 0
+        sent = []
+        sent_hashes = []
+        for tx_hash, transaction in batch:
+            try:
+                self.net.send_tx(transaction)
+            except Exception as e:
+                print('Sending consent signatures of {} failed: {}'.format(tx_hash, e))
+                with self._lock:
+                    if tx_hash in self._entries:
+                        self._dirty[tx_hash] = True
+                continue
+            sent.append(transaction)
+            sent_hashes.append(tx_hash)
+            if self.resolver is not None:
+                self.resolver.watch(transaction).add_done_callback(
+                    lambda future, tx_hash=tx_hash: self._finish(tx_hash, future))
+        now = time.monotonic()
+        with self._lock:
+            self.flushed += len(sent)
+            self.sends += len(sent)
+            for tx_hash in sent_hashes:
+                if tx_hash in self._entries:
+                    self._sent[tx_hash] = now
+        for creator in {t.payload.reduced_payload.creator_account_id for t in sent}:
+            self._lookups.invalidate(creator)
+        return len(batch)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'unsent': len(self._dirty),
+                'proposed': self.proposed,
+                'signed': self.signed,
+                'flushed': self.flushed,
+                'sends': self.sends,
+                'finished': self.finished,
+                'lookups': self._lookups.stats(),
+            }
+
+    def _finish(self, tx_hash, future):
+        # a resolver timeout is not final, the grant may still be waiting
+        # for signatures
+        if future.exception() is not None:
+            return
+        self._forget([tx_hash])
+
+    def _settle(self, account_id, pending):
+        # grants sent a while ago that the peers no longer list are final
+        now = time.monotonic()
+        with self._lock:
+            gone = [tx_hash for tx_hash, transaction in self._entries.items()
+                    if tx_hash in self._sent and tx_hash not in self._dirty
+                    and tx_hash not in pending
+                    and now - self._sent[tx_hash] > SETTLE_TIME
+                    and transaction.payload.reduced_payload.creator_account_id == account_id]
+        self._forget(gone)
+
+    def _forget(self, hashes):
+        creators = set()
+        with self._lock:
+            for tx_hash in hashes:
+                transaction = self._entries.pop(tx_hash, None)
+                self._dirty.pop(tx_hash, None)
+                self._sent.pop(tx_hash, None)
+                if transaction is not None:
+                    self.finished += 1
+                    creators.add(transaction.payload.reduced_payload.creator_account_id)
+        for creator in creators:
+            self._lookups.invalidate(creator)
+
+    def _has(self, tx_hash):
+        with self._lock:
+            return tx_hash in self._entries
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            # gather the signatures of requests arriving together
+            time.sleep(self.flush_interval)
+            self._wake.clear()
+            while self.flush() == self.max_send:
+                pass
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+#
+# Read-through cache for GetAccountDetail results.
+# Entries are keyed by (requesting account, target account), expire after
+# `ttl` seconds, and are dropped as soon as a committed transaction that
+# touches the target account is seen, either from this service or from
+# the block stream of a peer.
+#
+import threading
+import time
+from collections import OrderedDict
+
+
+def touched_accounts(transaction):
+    """
+    Accounts whose readable details may change when the transaction commits
+    """
+    creator = transaction.payload.reduced_payload.creator_account_id
+    accounts = set()
+    for command in transaction.payload.reduced_payload.commands:
+        name = command.WhichOneof('command')
+        if name == 'set_account_detail':
+            accounts.add(command.set_account_detail.account_id)
+        elif name in ('grant_permission', 'revoke_permission'):
+            # the grantee can now read the creator's details, or not
+            accounts.add(creator)
+            accounts.add(getattr(command, name).account_id)
+    return accounts
+
+
+class DetailCache:
+    """
+    Bounded LRU cache with a time to live, with hit/miss counters
+    """
+
+    def __init__(self, max_entries=10000, ttl=5.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        # target account -> keys cached for it, so invalidation is cheap
+        self._by_target = {}
+
+    def get(self, requester, target):
+        """
+        Cached value for the pair, or None on a miss
+        """
+        key = (requester, target)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+            return None
+
+    def put(self, requester, target, value):
+        key = (requester, target)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            self._by_target.setdefault(target, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def get_or_load(self, requester, target, load):
+        """
+        Return the cached value, calling load() and caching its result on
+        a miss. Loads that return None are not cached.
+        """
+        value = self.get(requester, target)
+        if value is None:
+            value = load()
+            if value is not None:
+                self.put(requester, target, value)
+        return value
+
+    def invalidate(self, account):
+        """
+        Drop every entry whose target is the account
+        """
+        with self._lock:
+            for key in self._by_target.pop(account, ()):
+                self._entries.pop(key, None)
+            self.invalidations += 1
+
+    def invalidate_transaction(self, transaction):
+        """
+        Drop the entries a committed transaction may have made stale
+        """
+        for account in touched_accounts(transaction):
+            self.invalidate(account)
+
+    def invalidate_block(self, block):
+        for transaction in block.block_v1.payload.transactions:
+            self.invalidate_transaction(transaction)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_target.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+            }
+
+    def _remove(self, key):
+        self._entries.pop(key, None)
+        keys = self._by_target.get(key[1])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_target[key[1]]
+
+
+def watch_blocks(cache, hub):
+    """
+    Invalidate the cache for every committed transaction seen on the block
+    stream of an EventHub, so writes sent through other peers or services
+    are seen too, and clear it whenever the stream drops
+    """
+    hub.on_block.append(cache.invalidate_block)
+    # anything could have changed while the stream was down
+    hub.on_restart.append(cache.clear)
+    return hub.start()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+#
+# Paginated GetAccountDetail queries.
+# Iroha can return an account's details a page at a time, ordered by
+# writer and then key, and filter them by key and writer on the peer.
+# These helpers walk the pages and turn them into one JSON document that
+# is streamed out as it is read, so a large detail blob is never held
+# whole by the API or its client.
+#
+import json
+
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+class DetailQueryError(Exception):
+    """
+    The peer answered a GetAccountDetail query with an error
+    """
+
+
+def detail_query(iroha, account_id, key=None, writer=None, page_size=None, first=None):
+    """
+    GetAccountDetail query with the filters and pagination set. `first` is
+    the {'writer', 'key'} record to start from, as returned in 'next'.
+    """
+    filters = {}
+    if key:
+        filters['key'] = key
+    if writer:
+        filters['writer'] = writer
+    query = iroha.query('GetAccountDetail', account_id=account_id, **filters)
+    if page_size:
+        meta = query.payload.get_account_detail.pagination_meta
+        meta.page_size = page_size
+        if first:
+            meta.first_record_id.writer = first['writer']
+            meta.first_record_id.key = first['key']
+    return query
+
+
+def fetch_page(net, iroha, signer, account_id, key=None, writer=None, page_size=PAGE_SIZE,
+               first=None):
+    """
+    One page as (detail dict {writer: {key: value}}, total number of
+    records, next record or None on the last page)
+    """
+    query = detail_query(iroha, account_id, key, writer, page_size, first)
+    signer.sign_query(query)
+    response = net.send_query(query)
+    if response.HasField('error_response'):
+        raise DetailQueryError(response.error_response.message
+                               or str(response.error_response.reason))
+    page = response.account_detail_response
+    next_record = None
+    if page.HasField('next_record_id'):
+        next_record = {'writer': page.next_record_id.writer, 'key': page.next_record_id.key}
+    return json.loads(page.detail or '{}'), page.total_number, next_record
+
+
+def iter_pages(net, iroha, signer, account_id, key=None, writer=None, page_size=PAGE_SIZE,
+               first=None):
+    """
+    Yield every page from `first` on, fetching the next one only when the
+    previous has been consumed
+    """
+    while True:
+        detail, total, first = fetch_page(net, iroha, signer, account_id, key, writer,
+                                          page_size, first)
+        yield detail, total, first
+        if first is None:
+            return
+
+
+def stream_json(account_id, pages):
+    """
+    Yield the text of {"account_id": ..., "detail": {writer: {key: value}},
+    "total": n} piece by piece. Pages come in writer order, so each writer
+    is opened once and closed when the next one starts. An error after the
+    first page ends the document with an "error" field.
+    """
+    yield '{{"account_id": {}, "detail": {{'.format(json.dumps(account_id))
+    current = None
+    total = 0
+    error = None
+    try:
+        for detail, total, _ in pages:
+            for writer, values in detail.items():
+                for key, value in values.items():
+                    if writer != current:
+                        yield '{}{}: {{'.format('}, ' if current is not None else '',
+                                                json.dumps(writer))
+                        current = writer
+                        separator = ''
+                    yield '{}{}: {}'.format(separator, json.dumps(key), json.dumps(value))
+                    separator = ', '
+    except Exception as e:
+        error = str(e)
+    if current is not None:
+        yield '}'
+    yield '}}, "total": {}'.format(total)
+    if error is not None:
+        yield ', "error": {}'.format(json.dumps(error))
+    yield '}\n'
+
+
+def flag(args, name):
+    """
+    True for ?name=1, true or yes
+    """
+    return args.get(name, '').lower() in ('1', 'true', 'yes')
+
+
+def wants_pages(args):
+    """
+    True when a /getdetails request asked for pages, a stream or filters
+    """
+    return flag(args, 'stream') or any(args.get(name) for name in ('page_size', 'key', 'writer'))
+
+
+def details_response(args, net, iroha, signer, account_id):
+    """
+    Flask response for /getdetails with ?stream=1 (every page, streamed as
+    chunked JSON) or ?page_size=n (one page with the cursor of the next in
+    'next', passed back as ?first_writer=&first_key=). ?key= and ?writer=
+    filter on the peer.
+    """
+    from flask import Response, stream_with_context
+
+    try:
+        page_size = min(int(args.get('page_size', PAGE_SIZE)), MAX_PAGE_SIZE)
+    except ValueError:
+        return {'error': 'page_size must be a number'}, 400
+    first = None
+    if args.get('first_writer') or args.get('first_key'):
+        first = {'writer': args.get('first_writer', ''), 'key': args.get('first_key', '')}
+    key, writer = args.get('key'), args.get('writer')
+
+    if flag(args, 'stream'):
+        pages = iter_pages(net, iroha, signer, account_id, key, writer, page_size, first)
+        # fetch the first page before answering, so a bad query is a 400
+        try:
+            first_page = next(pages)
+        except DetailQueryError as e:
+            return {'error': str(e)}, 400
+
+        def all_pages():
+            yield first_page
+            yield from pages
+
+        return Response(stream_with_context(stream_json(account_id, all_pages())),
+                        mimetype='application/json')
+
+    try:
+        detail, total, next_record = fetch_page(net, iroha, signer, account_id, key, writer,
+                                                page_size, first)
+    except DetailQueryError as e:
+        return {'error': str(e)}, 400
+    return {'account_id': account_id, 'detail': detail, 'total': total, 'next': next_record}
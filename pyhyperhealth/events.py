@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+#
+# Committed ledger events for downstream systems.
+# One EventHub per process follows the block stream and turns committed
+# SetAccountDetail and GrantPermission/RevokePermission commands into
+# events. Each subscriber gets the events for its account or domain on a
+# bounded queue; a subscriber that falls `queue_size` events behind is
+# dropped and reconnects from the last height it saw. Recent events are
+# kept so a reconnect can resume from a height, and older heights are
+# read back with GetBlock queries. When those cannot reach the kept events
+# in one go, the stream ends after the blocks read and the client
+# reconnects from there.
+#
+import binascii
+import json
+import queue
+import threading
+import time
+from collections import deque
+
+from iroha import IrohaCrypto, primitive_pb2
+
+try:
+    from .indexer import fetch_block
+    from .signers import as_signer
+except ImportError:
+    from indexer import fetch_block
+    from signers import as_signer
+
+# Seconds between keep-alive comments on an idle event stream
+KEEPALIVE = 15
+
+
+def block_events(block):
+    """
+    Event dicts for the commands of interest in a block_pb2.Block
+    """
+    payload = block.block_v1.payload
+    events = []
+    for transaction in payload.transactions:
+        tx_hash = None
+        creator = transaction.payload.reduced_payload.creator_account_id
+        for command in transaction.payload.reduced_payload.commands:
+            name = command.WhichOneof('command')
+            if name == 'set_account_detail':
+                c = command.set_account_detail
+                event = {'type': 'SetAccountDetail', 'account_id': c.account_id,
+                         'writer': creator, 'key': c.key, 'value': c.value}
+            elif name in ('grant_permission', 'revoke_permission'):
+                c = getattr(command, name)
+                event = {'type': 'GrantPermission' if name == 'grant_permission'
+                         else 'RevokePermission',
+                         'account_id': c.account_id, 'grantor': creator,
+                         'permission': primitive_pb2.GrantablePermission.Name(c.permission)}
+            else:
+                continue
+            if tx_hash is None:
+                tx_hash = binascii.hexlify(IrohaCrypto.hash(transaction)).decode('ascii')
+            event['height'] = payload.height
+            event['index'] = len(events)
+            event['tx_hash'] = tx_hash
+            event['domain'] = event['account_id'].rsplit('@', 1)[-1]
+            events.append(event)
+    return events
+
+
+class Subscription:
+    """
+    One subscriber's filter and queue of pending events
+    """
+
+    def __init__(self, accounts=None, domain=None, queue_size=1000):
+        self.accounts = set(accounts) if accounts else None
+        self.domain = domain
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.backlog = deque()
+        self.dropped = False
+        # (height, index) of the last event delivered
+        self.last = None
+        # set when the backfill stopped short of the live events: the
+        # position to resume from once the backlog is delivered
+        self.resume = None
+
+    def wants(self, event):
+        if self.accounts is not None and not (
+                event['account_id'] in self.accounts or event.get('grantor') in self.accounts):
+            return False
+        return self.domain is None or event['domain'] == self.domain
+
+    def offer(self, event):
+        """
+        Queue an event, returning False once the subscriber is too far behind
+        """
+        if self.dropped:
+            return False
+        try:
+            self.queue.put_nowait(event)
+            return True
+        except queue.Full:
+            self.dropped = True
+            return False
+
+
+class EventHub:
+    """
+    Shares one block stream between every subscriber of a process.
+    on_block callbacks are also called with each block, and on_restart
+    callbacks whenever the stream had to be reopened.
+    """
+
+    def __init__(self, net, iroha, private_key, history=10000, queue_size=1000,
+                 max_backfill=100, retry_delay=5.0):
+        self.net = net
+        self.iroha = iroha
+        self.signer = as_signer(private_key)
+        self.queue_size = queue_size
+        self.max_backfill = max_backfill
+        self.retry_delay = retry_delay
+        self.on_block = []
+        self.on_restart = []
+        self.height = 0
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._history = deque(maxlen=history)
+        self._subscribers = set()
+        self._thread = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='event-hub',
+                                                daemon=True)
+                self._thread.start()
+        return self
+
+    def subscribe(self, accounts=None, domain=None, after=None):
+        """
+        New Subscription. With `after`, a (height, index) pair as in the
+        event ids, the later events are delivered first: from the kept
+        history, and from GetBlock queries for anything older. The queries
+        run on the caller's thread, so at most max_backfill blocks are read.
+        If they do not reach the first block the live stream delivers, the
+        subscription only gets the blocks read and its stream then ends.
+        """
+        self.start()
+        subscription = Subscription(accounts, domain, self.queue_size)
+        with self._lock:
+            self._subscribers.add(subscription)
+            history = list(self._history)
+            top = self.height
+        if after is None:
+            return subscription
+        subscription.last = after
+        # first height the subscription gets from the history or live, not
+        # known before the stream has delivered a block
+        live = history[0]['height'] if history else (top + 1 if top else None)
+        backlog = []
+        height = after[0]
+        last = after[0] + self.max_backfill - 1
+        block = True
+        while (live is None or height < live) and height <= last:
+            block = fetch_block(self.net, self.iroha, self.signer, height)
+            if block is None:
+                break
+            backlog.extend(block_events(block))
+            height += 1
+        if live is None and block is None or live is not None and height >= live:
+            backlog.extend(history)
+        else:
+            # joining the history would skip the blocks in between
+            self.unsubscribe(subscription)
+            subscription.resume = (height - 1, float('inf')) if height > after[0] else after
+        subscription.backlog.extend(
+            event for event in backlog
+            if (event['height'], event['index']) > after and subscription.wants(event))
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def stream(self, subscription, keepalive=KEEPALIVE):
+        """
+        Yield events for the subscription, None on idle keep-alive ticks,
+        until the subscriber is dropped for falling behind or a partial
+        backfill is delivered
+        """
+        try:
+            while True:
+                if subscription.backlog:
+                    event = subscription.backlog.popleft()
+                elif subscription.resume is not None:
+                    subscription.last = subscription.resume
+                    return
+                elif subscription.dropped and subscription.queue.empty():
+                    return
+                else:
+                    try:
+                        event = subscription.queue.get(timeout=keepalive)
+                    except queue.Empty:
+                        if subscription.dropped:
+                            return
+                        yield None
+                        continue
+                # blocks read back with GetBlock can also arrive live
+                key = (event['height'], event['index'])
+                if subscription.last is not None and key <= subscription.last:
+                    continue
+                subscription.last = key
+                yield event
+        finally:
+            self.unsubscribe(subscription)
+
+    def stats(self):
+        with self._lock:
+            return {'height': self.height, 'subscribers': len(self._subscribers),
+                    'history': len(self._history), 'dropped': self.dropped}
+
+    def _publish(self, block):
+        events = block_events(block)
+        with self._lock:
+            self.height = max(self.height, block.block_v1.payload.height)
+            self._history.extend(events)
+            subscribers = list(self._subscribers)
+        for subscription in subscribers:
+            for event in events:
+                if subscription.wants(event) and not subscription.offer(event):
+                    with self._lock:
+                        self.dropped += 1
+                        self._subscribers.discard(subscription)
+                    break
+        for callback in self.on_block:
+            callback(block)
+
+    def _run(self):
+        while True:
+            try:
+                query = self.iroha.blocks_query()
+                self.signer.sign_query(query)
+                for response in self.net.block_stream(query):
+                    block = response.block_response.block
+                    # blocks committed while the stream was being reopened;
+                    # on the first connect there is nothing to catch up on
+                    start = self.height + 1 if self.height else block.block_v1.payload.height
+                    for height in range(start, block.block_v1.payload.height):
+                        missing = fetch_block(self.net, self.iroha, self.signer, height)
+                        if missing is not None:
+                            self._publish(missing)
+                    self._publish(block)
+            except Exception as e:
+                print('Block stream for events failed: {}'.format(e))
+            for callback in self.on_restart:
+                callback()
+            time.sleep(self.retry_delay)
+
+
+def parse_position(text):
+    """
+    (height, index) from an event id, or from a bare height meaning
+    everything after that block. None for an empty value.
+    """
+    if not text:
+        return None
+    height, _, index = text.partition('-')
+    if not index:
+        return int(height), float('inf')
+    return int(height), int(index)
+
+
+def format_position(position):
+    """
+    Event id for a (height, index) pair, the inverse of parse_position
+    """
+    height, index = position
+    if index == float('inf'):
+        return str(height)
+    return '{}-{}'.format(height, index)
+
+
+def sse(hub, subscription):
+    """
+    Server-Sent Events text for a subscription. The event id is
+    <height>-<index>, so a reconnecting EventSource resumes with
+    Last-Event-ID right after the last event it got.
+    """
+    yield 'retry: 2000\n\n'
+    for event in hub.stream(subscription):
+        if event is None:
+            yield ': keep-alive\n\n'
+            continue
+        yield 'id: {}\nevent: {}\ndata: {}\n\n'.format(
+            format_position((event['height'], event['index'])), event['type'],
+            json.dumps(event))
+    # dropped for falling behind or the backfill stopped short, the client
+    # reconnects from this id
+    if subscription.last is not None:
+        yield 'id: {}\n'.format(format_position(subscription.last))
+    yield 'event: overflow\ndata: {}\n\n'
@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+#
+# In-process stand-in for an Iroha peer, for benchmarks and local testing.
+# It serves the CommandService_v1 and QueryService_v1 gRPC services on
+# localhost, commits each transaction after `commit_latency` seconds (or
+# rejects it with probability `reject_rate`), and keeps account details,
+# roles and grants in memory. Signatures and permissions are not checked.
+#
+# ConsensusPeer instead commits in rounds paced by Iroha's consensus
+# settings (max_proposal_size, proposal_delay, vote_delay) over a number
+# of simulated peers, for comparing those settings without a cluster.
+#
+import binascii
+import json
+import random
+import threading
+import time
+from collections import deque
+from concurrent import futures
+
+import grpc
+from google.protobuf import empty_pb2
+from iroha import IrohaCrypto
+from iroha import block_pb2, endpoint_pb2, endpoint_pb2_grpc, qry_responses_pb2
+
+# How long a status stream waits for a final status before giving up
+STREAM_TIMEOUT = 120
+
+
+class LedgerState:
+    """
+    World state kept by the fake peer
+    """
+
+    def __init__(self):
+        self.accounts = {}
+        self.details = {}
+        self.roles = {}
+        self.grants = set()
+
+    def apply(self, transaction):
+        creator = transaction.payload.reduced_payload.creator_account_id
+        for command in transaction.payload.reduced_payload.commands:
+            name = command.WhichOneof('command')
+            if name == 'set_account_detail':
+                c = command.set_account_detail
+                self.details.setdefault(c.account_id, {}).setdefault(creator, {})[c.key] = c.value
+            elif name == 'create_account':
+                c = command.create_account
+                account_id = '{}@{}'.format(c.account_name, c.domain_id)
+                self.accounts[account_id] = c.public_key
+                self.roles.setdefault(account_id, set()).add('user')
+            elif name == 'append_role':
+                c = command.append_role
+                self.roles.setdefault(c.account_id, set()).add(c.role_name)
+            elif name == 'detach_role':
+                c = command.detach_role
+                self.roles.get(c.account_id, set()).discard(c.role_name)
+            elif name == 'grant_permission':
+                c = command.grant_permission
+                self.grants.add((creator, c.account_id, c.permission))
+            elif name == 'revoke_permission':
+                c = command.revoke_permission
+                self.grants.discard((creator, c.account_id, c.permission))
+
+
+class FakePeer(endpoint_pb2_grpc.CommandService_v1Servicer,
+               endpoint_pb2_grpc.QueryService_v1Servicer):
+    """
+    Fake Torii endpoint with configurable commit latency and rejection rate
+    """
+
+    def __init__(self, commit_latency=0.05, reject_rate=0.0, workers=64, seed=None):
+        self.commit_latency = commit_latency
+        self.reject_rate = reject_rate
+        self.workers = workers
+        self.state = LedgerState()
+        self.height = 1
+        self.blocks = []
+        self._random = random.Random(seed)
+        self._cond = threading.Condition()
+        self._statuses = {}
+        self._server = None
+
+    def start(self, port=0):
+        """
+        Serve on localhost and return the address to give to IrohaGrpc
+        """
+        self._server = grpc.server(futures.ThreadPoolExecutor(max_workers=self.workers))
+        endpoint_pb2_grpc.add_CommandService_v1Servicer_to_server(self, self._server)
+        endpoint_pb2_grpc.add_QueryService_v1Servicer_to_server(self, self._server)
+        port = self._server.add_insecure_port('127.0.0.1:{}'.format(port))
+        self._server.start()
+        self.address = '127.0.0.1:{}'.format(port)
+        return self.address
+
+    def stop(self):
+        if self._server is not None:
+            self._server.stop(0)
+
+    # consensus
+
+    def receive(self, transactions):
+        """
+        Accept transactions and schedule their commit or rejection
+        """
+        for transaction in transactions:
+            tx_hash = binascii.hexlify(IrohaCrypto.hash(transaction)).decode('ascii')
+            with self._cond:
+                if tx_hash in self._statuses:
+                    continue
+                self._statuses[tx_hash] = endpoint_pb2.ENOUGH_SIGNATURES_COLLECTED
+                self._cond.notify_all()
+            self._schedule(tx_hash, transaction)
+
+    def _schedule(self, tx_hash, transaction):
+        timer = threading.Timer(self.commit_latency, self._finish, args=(tx_hash, transaction))
+        timer.daemon = True
+        timer.start()
+
+    def _finish(self, tx_hash, transaction):
+        with self._cond:
+            if self._random.random() < self.reject_rate:
+                self._statuses[tx_hash] = endpoint_pb2.REJECTED
+            else:
+                self.state.apply(transaction)
+                self._commit_block([transaction])
+                self._statuses[tx_hash] = endpoint_pb2.COMMITTED
+            self._cond.notify_all()
+
+    def _commit_block(self, transactions):
+        # called with the condition held
+        self.height += 1
+        block = block_pb2.Block()
+        block.block_v1.payload.height = self.height
+        block.block_v1.payload.created_time = int(time.time() * 1000)
+        block.block_v1.payload.transactions.extend(transactions)
+        self.blocks.append(block)
+
+    def _response(self, tx_hash, status):
+        response = endpoint_pb2.ToriiResponse()
+        response.tx_hash = tx_hash
+        response.tx_status = status
+        return response
+
+    # CommandService_v1
+
+    def Torii(self, request, context):
+        self.receive([request])
+        return empty_pb2.Empty()
+
+    def ListTorii(self, request, context):
+        self.receive(request.transactions)
+        return empty_pb2.Empty()
+
+    def Status(self, request, context):
+        with self._cond:
+            status = self._statuses.get(request.tx_hash, endpoint_pb2.NOT_RECEIVED)
+        return self._response(request.tx_hash, status)
+
+    def StatusStream(self, request, context):
+        final = (endpoint_pb2.COMMITTED, endpoint_pb2.REJECTED)
+        deadline = time.monotonic() + STREAM_TIMEOUT
+        last = None
+        while True:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: self._statuses.get(request.tx_hash) != last,
+                    max(deadline - time.monotonic(), 0))
+                status = self._statuses.get(request.tx_hash, endpoint_pb2.NOT_RECEIVED)
+            if status == last:
+                return
+            if status == endpoint_pb2.COMMITTED:
+                yield self._response(request.tx_hash, endpoint_pb2.STATEFUL_VALIDATION_SUCCESS)
+            elif status == endpoint_pb2.REJECTED:
+                yield self._response(request.tx_hash, endpoint_pb2.STATEFUL_VALIDATION_FAILED)
+            yield self._response(request.tx_hash, status)
+            if status in final:
+                return
+            last = status
+
+    # QueryService_v1
+
+    def Find(self, request, context):
+        response = qry_responses_pb2.QueryResponse()
+        query = request.payload
+        name = query.WhichOneof('query')
+        if name == 'get_account_detail':
+            q = query.get_account_detail
+            with self._cond:
+                records = sorted(
+                    (writer, key, value)
+                    for writer, values in self.state.details.get(q.account_id, {}).items()
+                    for key, value in values.items()
+                    if (not q.writer or writer == q.writer) and (not q.key or key == q.key))
+            page = response.account_detail_response
+            page.total_number = len(records)
+            if q.HasField('pagination_meta') and q.pagination_meta.page_size:
+                meta = q.pagination_meta
+                if meta.HasField('first_record_id'):
+                    first = (meta.first_record_id.writer, meta.first_record_id.key)
+                    records = [r for r in records if r[:2] >= first]
+                if len(records) > meta.page_size:
+                    page.next_record_id.writer = records[meta.page_size][0]
+                    page.next_record_id.key = records[meta.page_size][1]
+                    records = records[:meta.page_size]
+            detail = {}
+            for writer, key, value in records:
+                detail.setdefault(writer, {})[key] = value
+            page.detail = json.dumps(detail)
+        elif name == 'get_account':
+            account_id = query.get_account.account_id
+            with self._cond:
+                if account_id not in self.state.accounts:
+                    response.error_response.reason = qry_responses_pb2.ErrorResponse.NO_ACCOUNT
+                else:
+                    account = response.account_response
+                    account.account.account_id = account_id
+                    account.account.domain_id = account_id.split('@', 1)[1]
+                    account.account_roles.extend(sorted(self.state.roles.get(account_id, ())))
+        elif name == 'get_block':
+            height = query.get_block.height
+            with self._cond:
+                # the first block after genesis is height 2
+                if 2 <= height <= self.height:
+                    response.block_response.block.CopyFrom(self.blocks[height - 2])
+                else:
+                    response.error_response.reason = qry_responses_pb2.ErrorResponse.STATEFUL_INVALID
+        else:
+            response.error_response.reason = qry_responses_pb2.ErrorResponse.NOT_SUPPORTED
+            response.error_response.message = '{} is not supported by the fake peer'.format(name)
+        return response
+
+    def FetchCommits(self, request, context):
+        with self._cond:
+            next_index = len(self.blocks)
+        while context.is_active():
+            with self._cond:
+                self._cond.wait_for(lambda: len(self.blocks) > next_index, 1.0)
+                new_blocks = self.blocks[next_index:]
+                next_index = len(self.blocks)
+            for block in new_blocks:
+                response = qry_responses_pb2.BlockQueryResponse()
+                response.block_response.block.CopyFrom(block)
+                yield response
+
+
+class ConsensusPeer(FakePeer):
+    """
+    Fake peer that commits in consensus rounds. A round's proposal closes
+    when `max_proposal_size` transactions are queued or `proposal_delay`
+    seconds after the round started, and empty rounds commit nothing.
+    The proposal then reaches the peers (one hop), each validates it
+    (`tx_cost` seconds per transaction) and votes, and the block commits
+    when the supermajority's votes are in, plus one hop for the commit
+    message and `block_cost` seconds to store the block. Hops take exponentially distributed times averaging
+    `hop_latency`. With probability `fault_rate` a vote round misses its
+    supermajority and the peers vote again after `vote_delay`.
+    """
+
+    SETTINGS = ('peers', 'max_proposal_size', 'proposal_delay', 'vote_delay',
+                'hop_latency', 'tx_cost', 'block_cost', 'fault_rate', 'reject_rate')
+
+    def __init__(self, peers=4, max_proposal_size=10, proposal_delay=5.0, vote_delay=5.0,
+                 hop_latency=0.001, tx_cost=0.0005, block_cost=0.02, fault_rate=0.0,
+                 reject_rate=0.0, workers=64, seed=None):
+        super().__init__(0.0, reject_rate, workers, seed)
+        self._queue = deque()
+        self._stopped = False
+        self.configure(peers=peers, max_proposal_size=max_proposal_size,
+                       proposal_delay=proposal_delay, vote_delay=vote_delay,
+                       hop_latency=hop_latency, tx_cost=tx_cost, block_cost=block_cost,
+                       fault_rate=fault_rate)
+        self.reset_stats()
+        self._rounds = threading.Thread(target=self._run_rounds, daemon=True)
+        self._rounds.start()
+
+    def configure(self, **settings):
+        """
+        Change the consensus settings, taking effect from the current round
+        """
+        unknown = set(settings) - set(self.SETTINGS)
+        if unknown:
+            raise ValueError('unknown settings {}'.format(sorted(unknown)))
+        if settings.get('peers', 1) < 1 or settings.get('max_proposal_size', 1) < 1:
+            raise ValueError('peers and max_proposal_size must be at least 1')
+        if not 0 <= settings.get('fault_rate', 0) < 1:
+            raise ValueError('fault_rate must be in [0, 1)')
+        with self._cond:
+            for name, value in settings.items():
+                setattr(self, name, value)
+            self._cond.notify_all()
+
+    def reset_stats(self):
+        with self._cond:
+            self.commit_latencies = []
+            self.block_sizes = []
+            self.empty_rounds = 0
+            self.revotes = 0
+
+    def stats(self):
+        with self._cond:
+            blocks = len(self.block_sizes)
+            return {
+                'blocks': blocks,
+                'mean_block_size': sum(self.block_sizes) / blocks if blocks else 0.0,
+                'full_blocks': sum(1 for size in self.block_sizes
+                                   if size >= self.max_proposal_size),
+                'empty_rounds': self.empty_rounds,
+                'revotes': self.revotes,
+                'queued': len(self._queue),
+            }
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        super().stop()
+
+    def _schedule(self, tx_hash, transaction):
+        with self._cond:
+            self._queue.append((time.monotonic(), tx_hash, transaction))
+            self._cond.notify_all()
+
+    def _vote_time(self, transactions):
+        if self.hop_latency:
+            votes = sorted(self._random.expovariate(1.0 / self.hop_latency)
+                           for _ in range(self.peers))
+            hop = self._random.expovariate(1.0 / self.hop_latency)
+        else:
+            votes = [0.0] * self.peers
+            hop = 0.0
+        supermajority = self.peers - (self.peers - 1) // 3
+        return hop + self.tx_cost * transactions + votes[supermajority - 1] + hop
+
+    def _run_rounds(self):
+        while True:
+            with self._cond:
+                started = time.monotonic()
+                while not self._stopped and len(self._queue) < self.max_proposal_size:
+                    remaining = started + self.proposal_delay - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                if self._stopped:
+                    return
+                proposal = [self._queue.popleft()
+                            for _ in range(min(len(self._queue), self.max_proposal_size))]
+                if not proposal:
+                    self.empty_rounds += 1
+                    continue
+                delay = self._vote_time(len(proposal))
+                while self._random.random() < self.fault_rate:
+                    self.revotes += 1
+                    delay += self.vote_delay + self._vote_time(len(proposal))
+                delay += self.block_cost
+            time.sleep(delay)
+            with self._cond:
+                committed = []
+                now = time.monotonic()
+                for received, tx_hash, transaction in proposal:
+                    if self._random.random() < self.reject_rate:
+                        self._statuses[tx_hash] = endpoint_pb2.REJECTED
+                    else:
+                        self.state.apply(transaction)
+                        committed.append(transaction)
+                        self._statuses[tx_hash] = endpoint_pb2.COMMITTED
+                    self.commit_latencies.append(now - received)
+                if committed:
+                    self._commit_block(committed)
+                self.block_sizes.append(len(proposal))
+                self._cond.notify_all()
+
+
+# Run a fake peer on its own: python3 fakepeer.py [port] [commit latency] [reject rate]
+if __name__ == '__main__':
+    import sys
+
+    peer = FakePeer(commit_latency=float(sys.argv[2]) if len(sys.argv) > 2 else 0.05,
+                    reject_rate=float(sys.argv[3]) if len(sys.argv) > 3 else 0.0)
+    print('Fake Iroha peer listening on {}'.format(
+        peer.start(int(sys.argv[1]) if len(sys.argv) > 1 else 50051)))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        peer.stop()
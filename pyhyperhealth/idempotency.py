@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+#
+# Idempotent EHR writes.
+# Clients retry /addehr when consensus outlasts their timeout, and each
+# retry used to become a new transaction with a new created_time. Every
+# write now has a slot, (signing account, account, key), and optionally a
+# client key from the Idempotency-Key header. The first request for a
+# value sends the transaction; requests for the same value while it is in
+# flight wait on that transaction's result, and later ones within `ttl`
+# seconds get its hash and result back without touching the ledger.
+# A write of a different value to the slot always goes to the ledger.
+# Writes are also bound to the digest of the key the request was signed
+# with, so a request naming someone else's account without their key
+# never learns the result of their writes.
+#
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+# Header a client may send to name a write, e.g. a request id it reuses
+# on every retry
+HEADER = 'Idempotency-Key'
+
+
+class KeyReuseError(Exception):
+    """
+    A client key was sent again with a different write
+    """
+
+
+class Write:
+    """
+    One write shared by the first request and its duplicates. `hash`
+    resolves to the transaction hash once it is signed, or None for a
+    write sent in a shared batch; `result` to the COMMITTED/REJECTED text.
+    """
+
+    def __init__(self, slot, value, client_key=None, requester=None):
+        self.slot = slot
+        self.value = value
+        self.client_key = client_key
+        self.requester = requester
+        self.created = time.monotonic()
+        self.hash = Future()
+        self.result = Future()
+
+
+class IdempotentWrites:
+    """
+    Writes of the last `ttl` seconds by slot and by client key. Only
+    committed writes are remembered once final, so a retry after a
+    rejection sends a new transaction.
+    """
+
+    def __init__(self, ttl=300, max_entries=100000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.sent = 0
+        self.attached = 0
+        self.replayed = 0
+
+    def begin(self, creator, account_id, key, value, client_key=None, requester=None):
+        """
+        (write, True) for the first request of a write, which must then
+        call finish() or fail(); (write, False) for a duplicate of one that
+        is in flight or committed. `requester` is the digest of the
+        signing key; only requests with the same digest share a write.
+        """
+        slot = ('slot', creator, account_id, key)
+        if client_key:
+            client_key = ('client', creator, requester, client_key)
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            write = self._live(client_key, now) if client_key else None
+            if write is not None and (write.slot != slot or write.value != value):
+                raise KeyReuseError('{} was already used for another write'.format(HEADER))
+            owner = self._live(slot, now)
+            if write is None:
+                write = owner
+                if write is not None and (write.value != value or write.requester != requester):
+                    write = None
+            if write is not None:
+                if write.result.done():
+                    self.replayed += 1
+                else:
+                    self.attached += 1
+                if client_key:
+                    self._entries[client_key] = write
+                return write, False
+            write = Write(slot, value, client_key, requester)
+            # another key's write keeps the slot, this one is not shared
+            if owner is None or owner.requester == requester:
+                self._entries.pop(slot, None)
+                self._entries[slot] = write
+            if client_key:
+                self._entries[client_key] = write
+            self.sent += 1
+            self._evict()
+            return write, True
+
+    def finish(self, write, result):
+        """
+        Hand the final result to every request waiting on the write
+        """
+        if result != "COMMITTED\n":
+            self._forget(write)
+        with self._lock:
+            if write.result.done():
+                return
+            if not write.hash.done():
+                write.hash.set_result(None)
+            write.result.set_result(result)
+
+    def fail(self, write, error):
+        """
+        The write could not be sent; waiting duplicates get the error and
+        the next retry starts over
+        """
+        self._forget(write)
+        with self._lock:
+            if write.result.done():
+                return
+            if not write.hash.done():
+                write.hash.set_exception(error)
+            write.result.set_exception(error)
+
+    def follow(self, write, future):
+        """
+        Finish the write when `future`, e.g. from a DetailBatcher, resolves
+        """
+        def done(f):
+            if f.exception() is not None:
+                self.fail(write, f.exception())
+            else:
+                self.finish(write, f.result())
+
+        future.add_done_callback(done)
+
+    def invalidate_block(self, block):
+        """
+        Forget remembered writes whose slot a committed transaction set to
+        another value, e.g. through another API process
+        """
+        for transaction in block.block_v1.payload.transactions:
+            creator = transaction.payload.reduced_payload.creator_account_id
+            for command in transaction.payload.reduced_payload.commands:
+                if not command.HasField('set_account_detail'):
+                    continue
+                c = command.set_account_detail
+                with self._lock:
+                    write = self._entries.get(('slot', creator, c.account_id, c.key))
+                    if write is not None and write.value != c.value and write.result.done():
+                        del self._entries[write.slot]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'sent': self.sent,
+                'attached': self.attached,
+                'replayed': self.replayed,
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+            }
+
+    def _forget(self, write):
+        with self._lock:
+            for key in (write.slot, write.client_key):
+                if key is not None and self._entries.get(key) is write:
+                    del self._entries[key]
+
+    def _live(self, key, now):
+        write = self._entries.get(key)
+        if write is not None and now - write.created > self.ttl:
+            return None
+        return write
+
+    def _expire(self, now):
+        # entries are in insertion order, so the expired ones come first
+        while self._entries:
+            key, write = next(iter(self._entries.items()))
+            if now - write.created <= self.ttl:
+                break
+            del self._entries[key]
+
+    def _evict(self):
+        # drop the oldest finished writes, keeping in-flight ones so their
+        # duplicates can still attach
+        if len(self._entries) <= self.max_entries:
+            return
+        for key in list(self._entries):
+            if len(self._entries) <= self.max_entries:
+                break
+            if self._entries[key].result.done():
+                del self._entries[key]
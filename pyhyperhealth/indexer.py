@@ -0,0 +1,452 @@
+#!/usr/bin/env python3
+#
+# Sidecar that mirrors account details, accounts, domains, roles and
+# grants into a local SQLite database, so searches across accounts ("who
+# has an EHR with key ehr1", "all details in domain healthcare") are one
+# indexed query instead of a GetAccountDetail call per account.
+#
+# Blocks come from the peer's block stream or from the files under the
+# peer's block_store_path. Each block is applied in one SQLite transaction
+# together with its height, so a restarted indexer resumes after the last
+# block it stored.
+#
+# python3 indexer.py --db index.sqlite --follow --port 5001
+# python3 indexer.py --db index.sqlite --block-store /tmp/block_store/
+#
+import argparse
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+from google.protobuf import json_format
+from iroha import block_pb2, primitive_pb2
+
+try:
+    from .signers import as_signer
+except ImportError:
+    from signers import as_signer
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS accounts (
+    account_id TEXT PRIMARY KEY,
+    domain TEXT NOT NULL,
+    public_key TEXT,
+    height INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS accounts_domain ON accounts (domain);
+CREATE TABLE IF NOT EXISTS domains (
+    domain TEXT PRIMARY KEY,
+    default_role TEXT NOT NULL,
+    height INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS details (
+    account_id TEXT NOT NULL,
+    domain TEXT NOT NULL,
+    writer TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    height INTEGER NOT NULL,
+    PRIMARY KEY (account_id, writer, key)
+);
+CREATE INDEX IF NOT EXISTS details_domain ON details (domain, account_id);
+CREATE INDEX IF NOT EXISTS details_key_value ON details (key, value);
+CREATE INDEX IF NOT EXISTS details_value ON details (value);
+CREATE TABLE IF NOT EXISTS roles (
+    account_id TEXT NOT NULL,
+    role TEXT NOT NULL,
+    PRIMARY KEY (account_id, role)
+);
+CREATE INDEX IF NOT EXISTS roles_role ON roles (role);
+CREATE TABLE IF NOT EXISTS grants (
+    grantor TEXT NOT NULL,
+    grantee TEXT NOT NULL,
+    permission TEXT NOT NULL,
+    PRIMARY KEY (grantor, grantee, permission)
+);
+CREATE INDEX IF NOT EXISTS grants_grantee ON grants (grantee);
+CREATE TABLE IF NOT EXISTS checkpoint (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    height INTEGER NOT NULL,
+    updated REAL NOT NULL
+);
+'''
+
+# Most rows a search returns unless asked for fewer
+MAX_LIMIT = 10000
+# Tables of world state, as exported to snapshots
+TABLES = ('accounts', 'domains', 'details', 'roles', 'grants')
+
+
+def _domain(account_id):
+    return account_id.rsplit('@', 1)[-1]
+
+
+class DetailIndex:
+    """
+    SQLite store of the indexed world state. One writer applies blocks;
+    any number of threads can search, each on its own connection.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        db = self._db()
+        db.executescript(SCHEMA)
+        db.commit()
+
+    def _db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30)
+            db.row_factory = sqlite3.Row
+            # readers do not block the writer and the other way round
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+        return db
+
+    def height(self):
+        """
+        Height of the last applied block, 0 before the first one
+        """
+        row = self._db().execute('SELECT height FROM checkpoint WHERE id = 1').fetchone()
+        return row['height'] if row is not None else 0
+
+    def apply_block(self, block):
+        """
+        Apply the commands of a block_pb2.Block and record its height. Blocks
+        at or below the checkpoint are skipped. Returns True if applied.
+        """
+        payload = block.block_v1.payload
+        with self._write_lock:
+            db = self._db()
+            if payload.height <= self.height():
+                return False
+            with db:
+                for transaction in payload.transactions:
+                    self._apply_transaction(db, transaction, payload.height)
+                db.execute('INSERT OR REPLACE INTO checkpoint (id, height, updated) '
+                           'VALUES (1, ?, ?)', (payload.height, time.time()))
+        return True
+
+    def _apply_transaction(self, db, transaction, height):
+        creator = transaction.payload.reduced_payload.creator_account_id
+        for command in transaction.payload.reduced_payload.commands:
+            name = command.WhichOneof('command')
+            if name == 'set_account_detail':
+                c = command.set_account_detail
+                db.execute('INSERT OR REPLACE INTO details VALUES (?, ?, ?, ?, ?, ?)',
+                           (c.account_id, _domain(c.account_id), creator, c.key, c.value,
+                            height))
+            elif name == 'create_account':
+                c = command.create_account
+                account_id = '{}@{}'.format(c.account_name, c.domain_id)
+                db.execute('INSERT OR REPLACE INTO accounts VALUES (?, ?, ?, ?)',
+                           (account_id, c.domain_id, c.public_key, height))
+                # a new account gets the default role of its domain
+                db.execute('INSERT OR IGNORE INTO roles SELECT ?, default_role FROM domains '
+                           'WHERE domain = ?', (account_id, c.domain_id))
+            elif name == 'create_domain':
+                c = command.create_domain
+                db.execute('INSERT OR REPLACE INTO domains VALUES (?, ?, ?)',
+                           (c.domain_id, c.default_role, height))
+            elif name == 'append_role':
+                c = command.append_role
+                db.execute('INSERT OR IGNORE INTO roles VALUES (?, ?)',
+                           (c.account_id, c.role_name))
+            elif name == 'detach_role':
+                c = command.detach_role
+                db.execute('DELETE FROM roles WHERE account_id = ? AND role = ?',
+                           (c.account_id, c.role_name))
+            elif name == 'grant_permission':
+                c = command.grant_permission
+                db.execute('INSERT OR IGNORE INTO grants VALUES (?, ?, ?)',
+                           (creator, c.account_id,
+                            primitive_pb2.GrantablePermission.Name(c.permission)))
+            elif name == 'revoke_permission':
+                c = command.revoke_permission
+                db.execute('DELETE FROM grants WHERE grantor = ? AND grantee = ? '
+                           'AND permission = ?',
+                           (creator, c.account_id,
+                            primitive_pb2.GrantablePermission.Name(c.permission)))
+
+    # searches
+
+    def search_details(self, key=None, value=None, domain=None, writer=None, limit=1000):
+        """
+        Detail rows matching every given filter
+        """
+        clauses, params = [], []
+        for column, wanted in (('key', key), ('value', value), ('domain', domain),
+                               ('writer', writer)):
+            if wanted is not None:
+                clauses.append('{} = ?'.format(column))
+                params.append(wanted)
+        sql = 'SELECT account_id, writer, key, value, height FROM details'
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        sql += ' ORDER BY account_id, writer, key LIMIT ?'
+        params.append(min(limit, MAX_LIMIT))
+        return [dict(row) for row in self._db().execute(sql, params)]
+
+    def account_details(self, account_id):
+        """
+        Details of one account in the GetAccountDetail shape,
+        {writer: {key: value}}
+        """
+        detail = {}
+        for row in self._db().execute(
+                'SELECT writer, key, value FROM details WHERE account_id = ?', (account_id,)):
+            detail.setdefault(row['writer'], {})[row['key']] = row['value']
+        return detail
+
+    def search_accounts(self, domain=None, role=None, limit=1000):
+        """
+        Accounts in a domain and/or holding a role
+        """
+        sql = 'SELECT a.account_id, a.domain, a.public_key, a.height FROM accounts a'
+        clauses, params = [], []
+        if role is not None:
+            sql += ' JOIN roles r ON r.account_id = a.account_id'
+            clauses.append('r.role = ?')
+            params.append(role)
+        if domain is not None:
+            clauses.append('a.domain = ?')
+            params.append(domain)
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        sql += ' ORDER BY a.account_id LIMIT ?'
+        params.append(min(limit, MAX_LIMIT))
+        return [dict(row) for row in self._db().execute(sql, params)]
+
+    def grants(self, account_id):
+        """
+        Permissions the account has granted and been granted
+        """
+        db = self._db()
+        return {
+            'granted': [dict(row) for row in db.execute(
+                'SELECT grantee, permission FROM grants WHERE grantor = ?', (account_id,))],
+            'received': [dict(row) for row in db.execute(
+                'SELECT grantor, permission FROM grants WHERE grantee = ?', (account_id,))],
+        }
+
+    # snapshots
+
+    def export_state(self, batch=10000):
+        """
+        Yield the height, then (table, column names, rows) batches of every
+        table, all read in one transaction so they match the height
+        """
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            db.execute('BEGIN')
+            row = db.execute('SELECT height FROM checkpoint WHERE id = 1').fetchone()
+            yield row[0] if row is not None else 0
+            for table in TABLES:
+                cursor = db.execute('SELECT * FROM {}'.format(table))
+                columns = [d[0] for d in cursor.description]
+                while True:
+                    rows = cursor.fetchmany(batch)
+                    if not rows:
+                        break
+                    yield table, columns, rows
+        finally:
+            db.close()
+
+    def import_state(self, height, batches):
+        """
+        Replace the indexed state with (table, column names, rows) batches
+        at `height`, in one transaction. An exception from `batches`
+        leaves the index as it was.
+        """
+        with self._write_lock:
+            db = self._db()
+            with db:
+                for table in TABLES:
+                    db.execute('DELETE FROM {}'.format(table))
+                for table, columns, rows in batches:
+                    if table not in TABLES:
+                        raise ValueError('unknown table {}'.format(table))
+                    known = {row[1] for row in db.execute('PRAGMA table_info({})'.format(table))}
+                    if not set(columns) <= known:
+                        raise ValueError('unknown columns {} in {}'.format(columns, table))
+                    db.executemany('INSERT OR REPLACE INTO {} ({}) VALUES ({})'.format(
+                        table, ', '.join(columns), ', '.join('?' * len(columns))), rows)
+                db.execute('INSERT OR REPLACE INTO checkpoint (id, height, updated) '
+                           'VALUES (1, ?, ?)', (height, time.time()))
+
+    def stats(self):
+        db = self._db()
+        counts = {table: db.execute('SELECT COUNT(*) FROM {}'.format(table)).fetchone()[0]
+                  for table in TABLES}
+        counts['height'] = self.height()
+        return counts
+
+
+def blocks_from_store(path, after=0):
+    """
+    Yield the blocks stored under a peer's block_store_path with a height
+    above `after`, in order. Iroha names each file by its zero padded
+    height and stores the block as JSON.
+    """
+    heights = sorted(int(name) for name in os.listdir(path) if name.isdigit())
+    for height in heights:
+        if height <= after:
+            continue
+        with open(os.path.join(path, '{:016d}'.format(height))) as f:
+            yield json_format.Parse(f.read(), block_pb2.Block(), ignore_unknown_fields=True)
+
+
+def replay_store(index, path, progress_every=1000):
+    """
+    Apply every stored block past the checkpoint and return the count
+    """
+    applied = 0
+    for block in blocks_from_store(path, index.height()):
+        if index.apply_block(block):
+            applied += 1
+            if applied % progress_every == 0:
+                print('indexed up to block {}'.format(index.height()))
+    return applied
+
+
+def fetch_block(net, iroha, signer, height):
+    """
+    One block by height with a GetBlock query, or None if there is none yet
+    """
+    query = iroha.query('GetBlock', height=height)
+    signer.sign_query(query)
+    response = net.send_query(query)
+    if response.HasField('error_response'):
+        return None
+    return response.block_response.block
+
+
+def follow(index, net, iroha, private_key, retry_delay=5.0):
+    """
+    Catch up from the checkpoint with GetBlock queries, then apply blocks
+    from the block stream as they are committed, filling any gap the same
+    way. Runs until interrupted; the account needs can_get_blocks.
+    """
+    signer = as_signer(private_key)
+
+    def catch_up(until=None):
+        while until is None or index.height() + 1 < until:
+            block = fetch_block(net, iroha, signer, index.height() + 1)
+            if block is None:
+                return
+            index.apply_block(block)
+
+    while True:
+        try:
+            catch_up()
+            query = iroha.blocks_query()
+            signer.sign_query(query)
+            for response in net.block_stream(query):
+                block = response.block_response.block
+                # blocks committed between the catch up and the stream
+                catch_up(until=block.block_v1.payload.height)
+                index.apply_block(block)
+        except Exception as e:
+            print('Block stream for the indexer failed: {}'.format(e))
+        time.sleep(retry_delay)
+
+
+def create_app(index):
+    """
+    Flask app with the search endpoints
+    """
+    from flask import Flask, request
+
+    try:
+        from .metrics import instrument_app
+    except ImportError:
+        from metrics import instrument_app
+
+    app = Flask(__name__)
+    instrument_app(app)
+
+    def limit():
+        return int(request.args.get('limit', '1000'))
+
+    # /search/details?key=ehr1 finds every account with an ehr1 detail,
+    # /search/details?domain=healthcare every detail in the domain
+    @app.route('/search/details')
+    def search_details():
+        try:
+            rows = index.search_details(request.args.get('key'), request.args.get('value'),
+                                        request.args.get('domain'),
+                                        request.args.get('writer'), limit())
+        except ValueError:
+            return {'error': 'limit must be a number'}, 400
+        return {'height': index.height(), 'details': rows}
+
+    @app.route('/search/accounts')
+    def search_accounts():
+        try:
+            rows = index.search_accounts(request.args.get('domain'), request.args.get('role'),
+                                         limit())
+        except ValueError:
+            return {'error': 'limit must be a number'}, 400
+        return {'height': index.height(), 'accounts': rows}
+
+    @app.route('/accounts/<acc_id>/<domain>/details')
+    def account_details(acc_id, domain):
+        return {'height': index.height(),
+                'details': index.account_details(acc_id + '@' + domain)}
+
+    @app.route('/accounts/<acc_id>/<domain>/grants')
+    def account_grants(acc_id, domain):
+        return dict(index.grants(acc_id + '@' + domain), height=index.height())
+
+    @app.route('/indexstats')
+    def index_stats():
+        return index.stats()
+
+    return app
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Index Iroha blocks into SQLite')
+    parser.add_argument('--db', default='index.sqlite', help='SQLite file (default index.sqlite)')
+    parser.add_argument('--block-store', help="replay the blocks in a peer's block_store_path")
+    parser.add_argument('--follow', action='store_true',
+                        help='follow the block stream of the peers after replaying')
+    parser.add_argument('--port', type=int, help='serve the search endpoints on this port')
+    args = parser.parse_args(argv)
+
+    index = DetailIndex(args.db)
+    if args.block_store:
+        print('replayed {} blocks, now at height {}'.format(
+            replay_store(index, args.block_store), index.height()))
+    if args.follow:
+        from iroha import Iroha
+        try:
+            from .peerpool import PeerPool
+        except ImportError:
+            from peerpool import PeerPool
+
+        IROHA_HOST_ADDR = os.getenv('IROHA_HOST_ADDR', '128.163.181.53')
+        IROHA_PORT = os.getenv('IROHA_PORT', '50051')
+        # an account with the can_get_blocks permission
+        ACCOUNT_ID = os.getenv('BLOCK_STREAM_ACCOUNT_ID', os.getenv('ADMIN_ACCOUNT_ID', 'admin@test'))
+        PRIVATE_KEY = os.getenv('BLOCK_STREAM_PRIVATE_KEY', os.getenv(
+            'ADMIN_PRIVATE_KEY', 'f101537e319568c765b2cc89698325604991dca57b9716b58016b253506cab70'))
+        net = PeerPool.from_env(IROHA_HOST_ADDR, IROHA_PORT)
+        thread = threading.Thread(target=follow, name='indexer-blocks', daemon=True,
+                                  args=(index, net, Iroha(ACCOUNT_ID), PRIVATE_KEY))
+        thread.start()
+    if args.port:
+        create_app(index).run(host='0.0.0.0', port=args.port, threaded=True)
+    elif args.follow:
+        while True:
+            time.sleep(3600)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
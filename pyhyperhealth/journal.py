@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+#
+# Append-only journal of submitted transactions, so a transaction sent by
+# a process that dies before its final status is not lost.
+# Each transaction is written as its serialized protobuf bytes and hash
+# before it is sent, and its final status is appended once known. Records
+# are written by one thread and fsynced in groups: a sender waits for the
+# fsync that covers its record, and everything queued while one fsync
+# runs goes into the next.
+# On startup the journal is scanned through mmap, only the transactions
+# still pending are parsed, and recover() asks the peers about them: final
+# ones are resolved, ones the peers never received are sent again, and
+# ones too old for the peers to accept are marked EXPIRED. The file is
+# rewritten with only the pending records at startup and whenever it
+# grows past `max_bytes`.
+#
+# Record layout, little endian:
+#   kind (1 byte), body length (4), transaction hash (32), body, crc32 (4)
+# SUBMITTED records hold the transaction bytes, RESOLVED ones the status.
+#
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+from iroha import IrohaCrypto, endpoint_pb2, transaction_pb2
+
+try:
+    from .statusresolver import FINAL
+except ImportError:
+    from statusresolver import FINAL
+
+MAGIC = b'PHTXJ001'
+SUBMITTED = 1
+RESOLVED = 2
+HEADER = struct.Struct('<BI32s')
+CRC = struct.Struct('<I')
+# Peers refuse transactions created longer ago than this (Iroha's
+# default max_past_created_hours of 24)
+MAX_AGE = 24 * 3600
+
+
+class JournalError(Exception):
+    """
+    The file is not a transaction journal
+    """
+
+
+def record(kind, tx_hash, body):
+    """
+    One journal record for a 32 byte hash and body
+    """
+    head = HEADER.pack(kind, len(body), tx_hash)
+    return head + body + CRC.pack(zlib.crc32(body, zlib.crc32(head)))
+
+
+def scan(path):
+    """
+    (pending, end) for a journal file: the SUBMITTED records without a
+    RESOLVED one as {hash: (body offset, body length)} in submission
+    order, and the offset after the last intact record. Nothing but the
+    record headers is copied out of the mapped file.
+    """
+    pending = OrderedDict()
+    size = os.path.getsize(path)
+    if size == 0:
+        return pending, 0
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if mm[:len(MAGIC)] != MAGIC:
+            raise JournalError('{} is not a transaction journal'.format(path))
+        view = memoryview(mm)
+        try:
+            offset = len(MAGIC)
+            while offset + HEADER.size + CRC.size <= size:
+                kind, length, tx_hash = HEADER.unpack_from(mm, offset)
+                body = offset + HEADER.size
+                end = body + length + CRC.size
+                if end > size:
+                    break
+                crc = zlib.crc32(view[body:body + length], zlib.crc32(view[offset:body]))
+                if CRC.unpack_from(mm, body + length)[0] != crc:
+                    break
+                if kind == SUBMITTED:
+                    pending[tx_hash] = (body, length)
+                elif kind == RESOLVED:
+                    pending.pop(tx_hash, None)
+                offset = end
+        finally:
+            view.release()
+    # a record cut short by a crash ends the journal
+    return pending, offset
+
+
+class TxJournal:
+    """
+    Journal file of the transactions this process sends. submitted()
+    returns once the transaction is on disk; resolved() does not wait.
+    """
+
+    def __init__(self, path, sync_interval=0.0, max_bytes=64 * 1024 * 1024):
+        self.path = path
+        self.sync_interval = sync_interval
+        self.max_bytes = max_bytes
+        self.written = 0
+        self.syncs = 0
+        self.compactions = 0
+        self.recovered = {'resolved': 0, 'resent': 0, 'expired': 0, 'in_flight': 0, 'errors': 0}
+        self._cond = threading.Condition()
+        self._queue = []
+        self._queued = 0
+        self._synced = 0
+        # (first ticket, last ticket, error) of writes that failed
+        self._failures = []
+        if not os.path.exists(path):
+            open(path, 'wb').close()
+        self._pending, end = scan(path)
+        self._restored = list(self._pending)
+        self._file = open(path, 'r+b')
+        self._file.truncate(end)
+        self._file.seek(end)
+        self._size = end
+        self._compact()
+        self._thread = threading.Thread(target=self._run, name='journal', daemon=True)
+        self._thread.start()
+
+    def submitted(self, *transactions):
+        """
+        Journal transactions about to be sent and wait until they are synced
+        """
+        self._append([record(SUBMITTED, IrohaCrypto.hash(transaction),
+                             transaction.SerializeToString())
+                      for transaction in transactions], wait=True)
+
+    def resolved(self, tx_hash, status):
+        """
+        Journal the final status name of a transaction by its hex hash
+        """
+        self._append([record(RESOLVED, bytes.fromhex(tx_hash), status.encode('ascii'))],
+                     wait=False)
+
+    def pending_transactions(self):
+        """
+        (hex hash, transaction) for the transactions an earlier process
+        left without a final status, parsed from the mapped file
+        """
+        with self._cond:
+            wanted = [(tx_hash, self._pending[tx_hash]) for tx_hash in self._restored
+                      if tx_hash in self._pending]
+            # the writer thread cannot compact away these offsets meanwhile
+            self._file.flush()
+            with mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return [(tx_hash.hex(), transaction_pb2.Transaction.FromString(
+                            mm[offset:offset + length]))
+                        for tx_hash, (offset, length) in wanted]
+
+    def recover(self, net, resolver=None, resend=True, max_age=MAX_AGE):
+        """
+        Reconcile the pending transactions of an earlier process with the
+        ledger. With a resolver, transactions still in flight are followed
+        and journaled once final; otherwise the next start looks again.
+        """
+        oldest = (time.time() - max_age) * 1000
+        for tx_hash, transaction in self.pending_transactions():
+            try:
+                status = net.tx_status(transaction)
+                if status[1] in FINAL:
+                    self.resolved(tx_hash, status[0])
+                    outcome = 'resolved'
+                elif transaction.payload.reduced_payload.created_time < oldest:
+                    self.resolved(tx_hash, 'EXPIRED')
+                    outcome = 'expired'
+                elif status[1] == endpoint_pb2.NOT_RECEIVED and resend:
+                    net.send_tx(transaction)
+                    outcome = 'resent'
+                else:
+                    outcome = 'in_flight'
+                if outcome in ('resent', 'in_flight') and resolver is not None:
+                    self.follow(resolver.watch(transaction), tx_hash)
+            except Exception as e:
+                print('Recovering transaction {} failed: {}'.format(tx_hash, e))
+                outcome = 'errors'
+            with self._cond:
+                self.recovered[outcome] += 1
+        with self._cond:
+            self._restored = []
+        return dict(self.recovered)
+
+    def follow(self, future, tx_hash):
+        """
+        Journal the final status a StatusResolver future resolves to
+        """
+        def done(f):
+            # a status stream that closed early gives None, still pending
+            if f.exception() is None and f.result() is not None:
+                self.resolved(tx_hash, f.result()[0])
+
+        future.add_done_callback(done)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'pending': len(self._pending),
+                'bytes': self._size,
+                'records': self.written,
+                'syncs': self.syncs,
+                'compactions': self.compactions,
+                'recovered': dict(self.recovered),
+            }
+
+    def _append(self, records, wait):
+        with self._cond:
+            self._queue.extend(records)
+            start = self._queued + 1
+            self._queued += len(records)
+            ticket = self._queued
+            self._cond.notify_all()
+            if wait:
+                self._cond.wait_for(lambda: self._synced >= ticket)
+                for first, last, error in self._failures:
+                    if first <= ticket and start <= last:
+                        raise error
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._queue)
+            if self.sync_interval:
+                # let more records join this fsync
+                time.sleep(self.sync_interval)
+            with self._cond:
+                queue, self._queue = self._queue, []
+                first, ticket = self._synced + 1, self._queued
+            offset = self._size
+            entries = []
+            for data in queue:
+                kind, length, tx_hash = HEADER.unpack_from(data)
+                entries.append((kind, tx_hash, offset + HEADER.size, length))
+                offset += len(data)
+            try:
+                self._file.write(b''.join(queue))
+                self._file.flush()
+                os.fsync(self._file.fileno())
+            except Exception as e:
+                print('Writing {} journal records failed: {}'.format(len(queue), e))
+                with self._cond:
+                    # cut off a partial write, later records must follow
+                    # the last intact one
+                    self._file.truncate(self._size)
+                    self._file.seek(self._size)
+                    self._failures = self._failures[-99:] + [(first, ticket, e)]
+                    self._synced = ticket
+                    self._cond.notify_all()
+                continue
+            with self._cond:
+                self._size = offset
+                for kind, tx_hash, body, length in entries:
+                    if kind == SUBMITTED:
+                        self._pending[tx_hash] = (body, length)
+                    else:
+                        self._pending.pop(tx_hash, None)
+                self.written += len(queue)
+                self.syncs += 1
+                self._synced = ticket
+                self._cond.notify_all()
+                if self._size > self.max_bytes:
+                    self._compact()
+
+    def _compact(self):
+        # rewrite the file with only the pending records, called at start
+        # and from the writer thread with the lock held
+        if self._size == len(MAGIC) and not self._pending:
+            return
+        self._file.flush()
+        tmp = self.path + '.tmp'
+        pending = OrderedDict()
+        with open(tmp, 'wb') as out:
+            out.write(MAGIC)
+            offset = len(MAGIC)
+            if self._size:
+                with mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    for tx_hash, (body, length) in self._pending.items():
+                        data = record(SUBMITTED, tx_hash, mm[body:body + length])
+                        out.write(data)
+                        pending[tx_hash] = (offset + HEADER.size, length)
+                        offset += len(data)
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(tmp, self.path)
+        directory = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        self._file.close()
+        self._file = open(self.path, 'r+b')
+        self._file.seek(offset)
+        self._size = offset
+        self._pending = pending
+        self.compactions += 1
+
+
+def send_journaled(journal, transactions, send):
+    """
+    Call send() for transactions about to be sent, journaling them first
+    when there is a journal and marking them SEND_FAILED if send() raises
+    """
+    if journal is None:
+        return send()
+    journal.submitted(*transactions)
+    try:
+        return send()
+    except Exception:
+        for transaction in transactions:
+            journal.resolved(IrohaCrypto.hash(transaction).hex(), 'SEND_FAILED')
+        raise
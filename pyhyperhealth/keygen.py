@@ -1,15 +1,52 @@
 # This is an example script to generate new keys in Hyperledger Iroha
-# From their documentation here: 
+# From their documentation here:
 # https://iroha.readthedocs.io/en/main/getting_started/python-guide.html#creating-your-own-key-pairs-with-python-library
+#
+# python3 keygen.py                      writes keypair.priv and keypair.pub
+# python3 keygen.py node2 node3          writes node2.priv, node2.pub, node3.priv, node3.pub
+# python3 keygen.py --count 100 patient  writes patient0.priv ... patient99.pub
+# Add --out <directory> to write the files somewhere else. Many pairs are
+# generated on all cores; for whole accounts use provision.py instead.
+import argparse
+import os
+
 from iroha import IrohaCrypto
 
-# these first two lines are enough to create the keys
-private_key = IrohaCrypto.private_key()
-public_key = IrohaCrypto.derive_public_key(private_key)
+# The pool's worker processes import this file again, so the work only
+# runs when it is the main script
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate Iroha key pairs')
+    parser.add_argument('names', nargs='*', default=['keypair'],
+                        help='file name for each pair (default keypair)')
+    parser.add_argument('--count', type=int, help='number the pairs name0 .. name<count-1>')
+    parser.add_argument('--out', default='.', help='directory to write the files to')
+    args = parser.parse_args()
+
+    names = args.names
+    if args.count is not None:
+        names = ['{}{}'.format(name, i) for name in names for i in range(args.count)]
+
+    if len(names) == 1:
+        # these first two lines are enough to create the keys
+        private_key = IrohaCrypto.private_key()
+        public_key = IrohaCrypto.derive_public_key(private_key)
+        pairs = [(private_key, public_key)]
+    else:
+        try:
+            from .signpool import SigningPool
+        except ImportError:
+            from signpool import SigningPool
+        pool = SigningPool()
+        pairs = pool.keypairs(len(names))
+        pool.close()
 
-# the rest of the code writes them into the file
-with open('keypair.priv', 'wb') as f:
-    f.write(private_key)
+    # the rest of the code writes them into the files, the private key
+    # readable by its owner only
+    os.makedirs(args.out, exist_ok=True)
+    for name, (private_key, public_key) in zip(names, pairs):
+        with os.fdopen(os.open(os.path.join(args.out, name + '.priv'),
+                               os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as f:
+            f.write(private_key)
 
-with open('keypair.pub', 'wb') as f:
-    f.write(public_key)
+        with open(os.path.join(args.out, name + '.pub'), 'wb') as f:
+            f.write(public_key)
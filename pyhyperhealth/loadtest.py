@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+#
+# Load test and benchmark harness.
+# Starts a FakePeer, points the API modules at it, then runs a mixed
+# workload of EHR writes, detail reads and account creation from several
+# threads. With --peers it runs against real peers instead, creating the
+# patient accounts first. Throughput, latency percentiles and memory are printed and saved
+# as JSON so results from two versions can be compared with --compare.
+# The timed pass runs untraced and reports the process's max RSS; peak
+# Python allocations come from a separate tracemalloc pass, after the
+# timed one, with --trace-memory SECONDS.
+#
+# python3 loadtest.py --target api --threads 32 --duration 20 --out run.json
+# python3 loadtest.py --peers 127.0.0.1:50051,127.0.0.1:50052 --mix write=0.5,read=0.5
+#
+import argparse
+import importlib
+import json
+import os
+import platform
+import random
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+
+TARGETS = ('api', 'adminapi', 'menu')
+OPERATIONS = ('write', 'read', 'account')
+DEFAULT_MIX = 'write=0.5,read=0.45,account=0.05'
+# Patient accounts written to and read from
+PATIENTS = 100
+
+# Same admin account as adminapi.py, used to sign requests to api.py
+ADMIN_USER = 'admin'
+ADMIN_DOMAIN = 'test'
+ADMIN_PRIVATE_KEY = 'f101537e319568c765b2cc89698325604991dca57b9716b58016b253506cab70'
+
+
+class StatusTimeout(Exception):
+    """
+    A write answered TIMEOUT, sent but without a final status in time
+    """
+
+
+def parse_mix(text):
+    """
+    'write=0.5,read=0.5' -> cumulative weights for picking operations
+    """
+    weights = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise ValueError('unknown operation {}, use one of {}'.format(name, OPERATIONS))
+        weights[name] = float(weight)
+    total = sum(weights.values())
+    cumulative = []
+    running = 0.0
+    for name, weight in weights.items():
+        running += weight / total
+        cumulative.append((running, name))
+    return cumulative
+
+
+def percentile(values, fraction):
+    """
+    Nearest-rank percentile of a sorted list
+    """
+    if not values:
+        return None
+    index = min(len(values) - 1, max(0, int(round(fraction * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def summarize(latencies, errors, elapsed, timeouts=0):
+    latencies = sorted(latencies)
+    return {
+        'count': len(latencies),
+        'errors': errors,
+        'timeouts': timeouts,
+        'throughput': len(latencies) / elapsed if elapsed else 0.0,
+        'mean': sum(latencies) / len(latencies) if latencies else None,
+        'p50': percentile(latencies, 0.50),
+        'p95': percentile(latencies, 0.95),
+        'p99': percentile(latencies, 0.99),
+        'max': latencies[-1] if latencies else None,
+    }
+
+
+def load_target(name, address):
+    """
+    Import api.py, adminapi.py or menu.py with its peer set to the fake peer
+    """
+    os.environ['IROHA_PEERS'] = address
+    if __package__:
+        return importlib.import_module('.' + name, __package__)
+    return importlib.import_module(name)
+
+
+def operations_for(target, module):
+    """
+    Callables for each operation. Each takes a random number generator and
+    a counter and raises on failure, StatusTimeout for a write without a
+    final status. 'patient' creates the n-th patient account the other
+    operations use.
+    """
+    patients = ['patient{}'.format(i) for i in range(PATIENTS)]
+
+    if target == 'menu':
+        return {
+            'write': lambda rng, n: module.add_ehr(rng.choice(patients), 'healthcare',
+                                                   'ehr{}'.format(n), 'REF{}'.format(n)),
+            'read': lambda rng, n: module.get_account_details(rng.choice(patients), 'healthcare'),
+            'account': lambda rng, n: module.create_account('load{}'.format(n), 'healthcare'),
+            'patient': lambda rng, n: module.create_account(patients[n], 'healthcare'),
+        }
+
+    local = threading.local()
+
+    def client():
+        if not hasattr(local, 'client'):
+            local.client = module.app.test_client()
+        return local.client
+
+    def get(path, write=False):
+        response = client().get(path, headers={'Accept': 'application/json'})
+        if response.status_code >= 400:
+            raise RuntimeError('{} {}'.format(response.status_code, response.data[:200]))
+        if write:
+            # only a COMMITTED status counts, 202 answers are not final yet
+            status = response.status_code
+            if status == 200:
+                status = json.loads(response.data).get('status')
+            if status == 'TIMEOUT':
+                raise StatusTimeout(path)
+            if status != 'COMMITTED':
+                raise RuntimeError('{} {}'.format(status, response.data[:200]))
+
+    if target == 'api':
+        auth = '/{}/{}/{}'.format(ADMIN_USER, ADMIN_DOMAIN, ADMIN_PRIVATE_KEY)
+    else:
+        auth = ''
+    return {
+        'write': lambda rng, n: get('/addehr/{}/healthcare/ehr{}/REF{}{}'.format(
+            rng.choice(patients), n, n, auth), write=True),
+        'read': lambda rng, n: get('/getdetails/{}/healthcare{}'.format(rng.choice(patients), auth)),
+        'account': lambda rng, n: get('/createaccount/load{}/healthcare{}'.format(n, auth),
+                                      write=True),
+        'patient': lambda rng, n: get('/createaccount/{}/healthcare{}'.format(patients[n], auth),
+                                      write=True),
+    }
+
+
+def run(target='api', threads=16, duration=10.0, mix=DEFAULT_MIX, commit_latency=0.05,
+        reject_rate=0.0, seed=1, peer=None, peers=None, trace_memory=0.0):
+    """
+    Run one load test against a fresh fake peer and return the results.
+    `peer` is a started fake peer to use instead, left running, and
+    `peers` a list of real peer addresses. With `trace_memory` seconds the
+    workload runs again that long under tracemalloc for the peak Python
+    memory, which tracing would skew in the timed run.
+    """
+    try:
+        from .fakepeer import FakePeer
+    except ImportError:
+        from fakepeer import FakePeer
+
+    own_peer = peer is None and not peers
+    if own_peer:
+        peer = FakePeer(commit_latency=commit_latency, reject_rate=reject_rate, seed=seed)
+        peer.start()
+    module = load_target(target, ','.join(peers) if peers else peer.address)
+    operations = operations_for(target, module)
+    if peers:
+        # a real ledger starts from the genesis block, without the patients
+        for n in range(PATIENTS):
+            operations['patient'](None, n)
+    weights = parse_mix(mix)
+
+    lock = threading.Lock()
+    counter = iter(range(10 ** 12))
+    stop_at = [0.0]
+
+    def worker(number, latencies, errors, timeouts):
+        rng = random.Random(seed * 1000 + number)
+        while time.monotonic() < stop_at[0]:
+            pick = rng.random()
+            name = weights[-1][1]
+            for bound, candidate in weights:
+                if pick <= bound:
+                    name = candidate
+                    break
+            with lock:
+                n = next(counter)
+            start = time.perf_counter()
+            try:
+                operations[name](rng, n)
+                failed = None
+            except StatusTimeout:
+                failed = timeouts
+            except Exception:
+                failed = errors
+            elapsed = time.perf_counter() - start
+            with lock:
+                if failed is not None:
+                    failed[name] += 1
+                else:
+                    latencies[name].append(elapsed)
+
+    def drive(seconds, latencies, errors, timeouts):
+        start = time.monotonic()
+        stop_at[0] = start + seconds
+        workers = [threading.Thread(target=worker, args=(i, latencies, errors, timeouts),
+                                    daemon=True)
+                   for i in range(threads)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        return time.monotonic() - start
+
+    latencies = {name: [] for name in OPERATIONS}
+    errors = {name: 0 for name in OPERATIONS}
+    timeouts = {name: 0 for name in OPERATIONS}
+    elapsed = drive(duration, latencies, errors, timeouts)
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak = None
+    if trace_memory:
+        tracemalloc.start()
+        drive(trace_memory, {name: [] for name in OPERATIONS}, {name: 0 for name in OPERATIONS},
+              {name: 0 for name in OPERATIONS})
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    if own_peer:
+        peer.stop()
+
+    all_latencies = [value for values in latencies.values() for value in values]
+    return {
+        'target': target,
+        'settings': {
+            'threads': threads,
+            'duration': duration,
+            'mix': mix,
+            'commit_latency': commit_latency,
+            'reject_rate': reject_rate,
+            'peers': peers,
+            'trace_memory': trace_memory,
+        },
+        'environment': {
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'elapsed': elapsed,
+        'total': summarize(all_latencies, sum(errors.values()), elapsed,
+                           sum(timeouts.values())),
+        'operations': {name: summarize(latencies[name], errors[name], elapsed, timeouts[name])
+                       for name in OPERATIONS
+                       if latencies[name] or errors[name] or timeouts[name]},
+        'memory': {
+            # None without a tracemalloc pass
+            'python_peak_bytes': peak,
+            # kilobytes on Linux, at the end of the timed run
+            'max_rss_kb': max_rss,
+        },
+    }
+
+
+def print_results(results, out=sys.stdout):
+    print('{} for {:.1f}s: {:.1f} ops/sec, {} errors, {} timeouts'.format(
+        results['target'], results['elapsed'], results['total']['throughput'],
+        results['total']['errors'], results['total'].get('timeouts', 0)), file=out)
+    for name, stats in [('total', results['total'])] + sorted(results['operations'].items()):
+        if stats['count']:
+            print('  {:8} {:6} ops  p50 {:.4f}s  p95 {:.4f}s  p99 {:.4f}s'.format(
+                name, stats['count'], stats['p50'], stats['p95'], stats['p99']), file=out)
+    memory = results['memory']
+    line = '  max rss {:.1f} MB'.format(memory['max_rss_kb'] / 1e3)
+    if memory.get('python_peak_bytes') is not None:
+        line += ', peak python memory {:.1f} MB (traced pass)'.format(
+            memory['python_peak_bytes'] / 1e6)
+    print(line, file=out)
+
+
+def compare(old, new, out=sys.stdout):
+    """
+    Print the change of each headline number between two saved runs
+    """
+    def change(a, b):
+        if a in (None, 0) or b is None:
+            return 'n/a'
+        return '{:+.1f}%'.format((b - a) / a * 100)
+
+    print('compared with the saved run:', file=out)
+    for key in ('throughput', 'p50', 'p95', 'p99'):
+        print('  {:10} {} -> {} ({})'.format(key, old['total'][key], new['total'][key],
+                                           change(old['total'][key], new['total'][key])),
+              file=out)
+    for label, key in (('max rss', 'max_rss_kb'), ('peak mem', 'python_peak_bytes')):
+        before, after = old['memory'].get(key), new['memory'].get(key)
+        if before is not None and after is not None:
+            print('  {:10} {} -> {} ({})'.format(label, before, after, change(before, after)),
+                  file=out)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load test pyhyperhealth against a fake Iroha peer')
+    parser.add_argument('--target', choices=TARGETS, default='api')
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help='operation weights (default {})'.format(DEFAULT_MIX))
+    parser.add_argument('--commit-latency', type=float, default=0.05,
+                        help='seconds before the fake peer commits a transaction')
+    parser.add_argument('--reject-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--peers', help='host:port,host:port of real peers to use instead '
+                                        'of a fake peer')
+    parser.add_argument('--trace-memory', type=float, default=0.0, metavar='SECONDS',
+                        help='measure peak Python memory in a separate traced pass this long')
+    parser.add_argument('--out', help='save the results as JSON')
+    parser.add_argument('--compare', help='saved JSON results to compare against')
+    args = parser.parse_args(argv)
+
+    results = run(args.target, args.threads, args.duration, args.mix,
+                  args.commit_latency, args.reject_rate, args.seed,
+                  peers=args.peers.split(',') if args.peers else None,
+                  trace_memory=args.trace_memory)
+    print_results(results)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -7,11 +7,11 @@
 
 # Here are Iroha dependencies.
 # Python library generally consists of 3 parts:
-# Iroha, IrohaCrypto and IrohaGrpc which we need to import:
+# Iroha, IrohaCrypto and IrohaGrpc. IrohaGrpc is wrapped by PeerPool here:
 import os
 import binascii
 from iroha import IrohaCrypto
-from iroha import Iroha, IrohaGrpc
+from iroha import Iroha
 from iroha import primitive_pb2
 
 # The following line is actually about the permissions
@@ -21,6 +21,21 @@ from iroha import primitive_pb2
 from iroha.primitive_pb2 import can_set_my_account_detail
 import sys
 
+try:
+    from .batcher import DetailBatcher
+    from .bulkimport import import_file
+    from .metrics import trace
+    from .peerpool import PeerPool
+    from .provision import provision_file
+    from .statusresolver import StatusResolver, StatusTimeout
+except ImportError:
+    from batcher import DetailBatcher
+    from bulkimport import import_file
+    from metrics import trace
+    from peerpool import PeerPool
+    from provision import provision_file
+    from statusresolver import StatusResolver, StatusTimeout
+
 if sys.version_info[0] < 3:
     raise Exception('Python 3 or a more recent version is required.')
 
@@ -29,8 +44,8 @@ if sys.version_info[0] < 3:
 # Iroha peers
 IROHA_HOST_ADDR = os.getenv('IROHA_HOST_ADDR', '128.163.181.53')
 IROHA_PORT = os.getenv('IROHA_PORT', '50051')
-# IROHA_HOST_ADDR_2 = os.getenv('IROHA_HOST_ADDR', '128.163.181.54')
-# IROHA_PORT_2 = os.getenv('IROHA_PORT', '50051')
+# More peers can be listed in IROHA_PEERS, e.g. '128.163.181.53:50051,128.163.181.54:50051',
+# or read from a genesis block with IROHA_GENESIS=Network-Files/node1/genesis.block
 
 ADMIN_ACCOUNT_ID = os.getenv('ADMIN_ACCOUNT_ID', 'admin@test')
 ADMIN_PRIVATE_KEY = os.getenv(
@@ -38,23 +53,10 @@ ADMIN_PRIVATE_KEY = os.getenv(
 print(ADMIN_ACCOUNT_ID)
 iroha = Iroha(ADMIN_ACCOUNT_ID)
 
-# Defining the nets for each node
-net = IrohaGrpc('{}:{}'.format(IROHA_HOST_ADDR, IROHA_PORT))
-
-def trace(func):
-    """
-    A decorator for tracing methods' begin/end execution points
-    """
-
-    def tracer(*args, **kwargs):
-        name = func.__name__
-        print('\tEntering "{}"'.format(name))
-        result = func(*args, **kwargs)
-        print('\tLeaving "{}"'.format(name))
-        return result
-    tracer.__name__ = func.__name__
-    return tracer
-
+# Defining the nets for each node, requests are spread over the pool
+net = PeerPool.from_env(IROHA_HOST_ADDR, IROHA_PORT)
+# Statuses are polled for at most STATUS_TIMEOUT seconds per transaction
+resolver = StatusResolver(net, timeout=float(os.getenv('STATUS_TIMEOUT', '120')))
 
 # Defining the commands:
 @trace
@@ -63,8 +65,10 @@ def send_transaction_and_print_status(transaction):
     print('Transaction hash = {}, creator = {}'.format(
         hex_hash, transaction.payload.reduced_payload.creator_account_id))
     net.send_tx(transaction)
-    for status in net.tx_status_stream(transaction):
-        print(status)
+    try:
+        print(resolver.wait(transaction))
+    except StatusTimeout:
+        print('No final status within {} seconds'.format(resolver.timeout))
 
         
 ### NEW COMMANDS ###
@@ -159,6 +163,21 @@ def add_ehr(acc_id, domain, detail, ehr_reference):
     return tx
 
 
+@trace
+def add_ehrs(records, max_size=100):
+    """
+    Add many EHR references at once. records is a list of
+    (acc_id, domain, detail, ehr_reference) tuples, and the writes are sent
+    in transactions of up to max_size commands. Returns the result of each
+    record in order.
+    """
+    batcher = DetailBatcher(net, iroha, ADMIN_PRIVATE_KEY, max_size=max_size)
+    futures = [batcher.add(acc_id + '@' + domain, detail, ehr_reference)
+               for acc_id, domain, detail, ehr_reference in records]
+    batcher.close()
+    return [future.result() for future in futures]
+
+
 @trace
 def add_peer(peerIP, peerkey):
     """
@@ -175,15 +194,19 @@ def add_peer(peerIP, peerkey):
 
 
 @trace
-def cansetmydetails(acc_id, myacc_id):
+def cansetmydetails(acc_id, myacc_id, myacc_private_key, quorum=1):
     """
-    Give an account permission to set and get the user's account details
+    Give an account permission to set the user's account details. The
+    grant is signed with the user's own key; with a quorum above one it
+    waits on the peers for the other signatories (see /consent in api.py).
     """
-    tx1 = iroha.transaction([iroha.command('GrantPermission', account_id=acc_id, permission=primitive_pb2.can_set_my_account_detail)], creator_account=myacc_id)
-    IrohaCrypto.sign_transaction(tx1, ADMIN_PRIVATE_KEY)
-    tx1 = iroha.transaction([iroha.command('GrantPermission', account_id=acc_id, permission=primitive_pb2.can_get_my_account_detail)], creator_account=myacc_id)
-    IrohaCrypto.sign_transaction(tx2, ADMIN_PRIVATE_KEY)
-    return tx1, tx2
+    tx = iroha.transaction([
+        iroha.command('GrantPermission', account_id=acc_id,
+                      permission=primitive_pb2.can_set_my_account_detail)
+    ], creator_account=myacc_id, quorum=quorum)
+    IrohaCrypto.sign_transaction(tx, myacc_private_key)
+    send_transaction_and_print_status(tx)
+    return tx
 
 
 ########### custom commands #############
@@ -237,6 +260,8 @@ if __name__ == "__main__":
         print('5. Create New Account')
         print('6. Get account details')
         print('7. Add Peer')
+        print('8. Import EHRs from a CSV or JSONL file')
+        print('9. Create accounts from a CSV or JSONL file')
         choice = input()
         # Creating a new role is not allowed yet due to needing to define all permissions
         if choice == "1":
@@ -279,6 +304,25 @@ if __name__ == "__main__":
             input_peerkey = input("Peer Public Key: ")
             input_peer = input_peer_IP + ":" + input_peer_port
             add_peer(input_peer, input_peerkey)
+        elif choice == "8":
+            print('Import EHRs: the file needs account, domain, key and reference columns')
+            input_file = input('File to import: ')
+            input_results = input('File to write results to (blank for none): ')
+            batcher = DetailBatcher(net, iroha, ADMIN_PRIVATE_KEY)
+            try:
+                counts = import_file(input_file, batcher, results_path=input_results or None)
+            finally:
+                batcher.close()
+            print('Results: ', counts)
+        elif choice == "9":
+            print('Create Accounts: the file needs account and domain columns, role is optional')
+            input_file = input('File of accounts: ')
+            input_manifest = input('New file to write the keys to: ')
+            input_role = input('Role for every account (blank for none): ')
+            counts = provision_file(input_file, input_manifest, net, iroha, ADMIN_PRIVATE_KEY,
+                                    manifest_key=os.getenv('MANIFEST_KEY'),
+                                    role=input_role or None)
+            print('Results: ', counts)
         elif choice == "q" or choice == "quit":
             print("Goodbye!")
         else:
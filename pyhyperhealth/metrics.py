@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+#
+# Low overhead timing of routes, functions and transaction phases.
+# Timings go into fixed bucket histograms and are served in the Prometheus
+# text format. METRICS_SAMPLE_RATE (0 to 1, default 1) sets the share of
+# calls that are timed; call counters always count every call.
+# PYHYPERHEALTH_TRACE=1 brings back the old Entering/Leaving prints.
+#
+import bisect
+import inspect
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+SAMPLE_RATE = float(os.getenv('METRICS_SAMPLE_RATE', '1'))
+VERBOSE = os.getenv('PYHYPERHEALTH_TRACE', '').lower() in ('1', 'true', 'yes')
+
+# Seconds. Consensus with the shipped config.docker takes several seconds,
+# so the buckets reach well past that.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0, 15.0, 30.0, 60.0)
+
+HELP = {
+    'pyhyperhealth_route_seconds': 'Time spent serving each API route',
+    'pyhyperhealth_call_seconds': 'Time spent in each traced function',
+    'pyhyperhealth_phase_seconds': 'Time spent in each phase of a transaction',
+    'pyhyperhealth_calls_total': 'Calls of each traced function',
+    'pyhyperhealth_requests_total': 'Requests served by each route',
+    'pyhyperhealth_tx_status_total': 'Final transaction statuses',
+}
+
+
+class Histogram:
+    """
+    Cumulative histogram with fixed buckets
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    """
+    Histograms and counters by metric name and label values
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+
+    def observe(self, name, labels, seconds):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def inc(self, name, labels, amount=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def render(self):
+        """
+        All metrics in the Prometheus text exposition format
+        """
+        with self._lock:
+            histograms = [(key, list(h.counts), h.sum, h.count, h.buckets)
+                          for key, h in self._histograms.items()]
+            counters = list(self._counters.items())
+        lines = []
+        seen = set()
+
+        def header(name, kind):
+            if name not in seen:
+                seen.add(name)
+                lines.append('# HELP {} {}'.format(name, HELP.get(name, name)))
+                lines.append('# TYPE {} {}'.format(name, kind))
+
+        for (name, labels), value in sorted(counters):
+            header(name, 'counter')
+            lines.append('{}{} {}'.format(name, _labels(labels), value))
+        for (name, labels), counts, total, count, buckets in sorted(histograms, key=lambda h: h[0]):
+            header(name, 'histogram')
+            cumulative = 0
+            for bound, bucket_count in zip(buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('{}_bucket{} {}'.format(name, _labels(labels + (('le', le),)), cumulative))
+            lines.append('{}_sum{} {}'.format(name, _labels(labels), total))
+            lines.append('{}_count{} {}'.format(name, _labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\')
+                                           .replace('"', '\\"').replace('\n', '\\n'))
+                          for k, v in labels) + '}'
+
+
+registry = Registry()
+
+
+def sampled():
+    """
+    Whether this call should be timed
+    """
+    return SAMPLE_RATE >= 1 or random.random() < SAMPLE_RATE
+
+
+def trace(func):
+    """
+    A decorator for timing methods, replacing the Entering/Leaving prints.
+    Coroutine functions are timed until they finish.
+    """
+    name = func.__name__
+    labels = {'function': name}
+
+    if inspect.iscoroutinefunction(func):
+        async def atracer(*args, **kwargs):
+            registry.inc('pyhyperhealth_calls_total', labels)
+            if not sampled():
+                return await func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                registry.observe('pyhyperhealth_call_seconds', labels,
+                                 time.perf_counter() - start)
+        atracer.__name__ = func.__name__
+        atracer.__doc__ = func.__doc__
+        return atracer
+
+    def tracer(*args, **kwargs):
+        registry.inc('pyhyperhealth_calls_total', labels)
+        if VERBOSE:
+            print('\tEntering "{}"'.format(name))
+        if not sampled():
+            result = func(*args, **kwargs)
+        else:
+            start = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            finally:
+                registry.observe('pyhyperhealth_call_seconds', labels,
+                                 time.perf_counter() - start)
+        if VERBOSE:
+            print('\tLeaving "{}"'.format(name))
+        return result
+    tracer.__name__ = func.__name__
+    tracer.__doc__ = func.__doc__
+    return tracer
+
+
+@contextmanager
+def phase(name):
+    """
+    Time a block as one phase of a transaction: build, sign, send,
+    first_status or commit
+    """
+    if not sampled():
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        registry.observe('pyhyperhealth_phase_seconds', {'phase': name},
+                         time.perf_counter() - start)
+
+
+def observe_phase(name, seconds):
+    if sampled():
+        registry.observe('pyhyperhealth_phase_seconds', {'phase': name}, seconds)
+
+
+def count_status(status):
+    registry.inc('pyhyperhealth_tx_status_total', {'status': status})
+
+
+def count_request(route, method, code, start=None):
+    """
+    Count a served request, and time it when it was sampled at `start`
+    """
+    labels = {'route': route, 'method': method}
+    registry.inc('pyhyperhealth_requests_total', dict(labels, code=str(code)))
+    if start is not None:
+        registry.observe('pyhyperhealth_route_seconds', labels, time.perf_counter() - start)
+
+
+def instrument_app(app):
+    """
+    Time every route of a Flask app and serve the metrics on /metrics
+    """
+    from flask import Response, g, request
+
+    @app.before_request
+    def start_timer():
+        g.metrics_start = time.perf_counter() if sampled() else None
+
+    @app.after_request
+    def stop_timer(response):
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        count_request(route, request.method, response.status_code, g.get('metrics_start'))
+        return response
+
+    @app.route('/metrics')
+    def metrics():
+        return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+    return app
@@ -1,3 +1,29 @@
+# Readiness probes, instead of sleeping a fixed time and hoping.
+# WAIT_SECONDS (default 60) bounds each wait.
+function wait_for_postgres(){
+
+    # pg_isready over TCP, the image's first start runs a socket-only
+    # server while it initialises the database
+    for i in $(seq 1 ${WAIT_SECONDS:-60}); do
+	docker exec $1 pg_isready -q -h 127.0.0.1 -p $2 -U postgres && return 0
+	sleep 1
+    done
+    echo "postgres in $1 is not ready after ${WAIT_SECONDS:-60}s" >&2
+    return 1
+
+}
+
+function wait_for_port(){
+
+    for i in $(seq 1 ${WAIT_SECONDS:-60}); do
+	(echo > /dev/tcp/$1/$2) 2>/dev/null && return 0
+	sleep 1
+    done
+    echo "$1:$2 is not accepting connections after ${WAIT_SECONDS:-60}s" >&2
+    return 1
+
+}
+
 
 function up_1(){
 
@@ -6,10 +32,10 @@ function up_1(){
 	    -e POSTGRES_USER=postgres \
 	    -e POSTGRES_PASSWORD=mysecretpassword \
 	    --net host \
-	    -d postgres:9.5 \
-	    -c 'max_prepared_transactions=100'
+	    -d ${POSTGRES_IMAGE:-postgres:9.5} \
+	    ${POSTGRES_ARGS:--c max_prepared_transactions=100}
     docker volume create blockstore
-    sleep 10s
+    wait_for_postgres some-postgres 5432 || return 1
     docker run --name iroha \
 	    -d \
 	    --net host \
@@ -17,6 +43,7 @@ function up_1(){
 	    -v blockstore:/tmp/block_store \
 	    -e KEY='node1' \
 	    hyperledger/iroha:latest
+    wait_for_port 127.0.0.1 50051 || return 1
 	    
 }
 
@@ -27,10 +54,10 @@ function up_2(){
 	    -e POSTGRES_USER=postgres \
 	    -e POSTGRES_PASSWORD=mysecretpassword \
 	    --net host \
-	    -d postgres:9.5 \
-	    -c 'max_prepared_transactions=100'
+	    -d ${POSTGRES_IMAGE:-postgres:9.5} \
+	    ${POSTGRES_ARGS:--c max_prepared_transactions=100}
     docker volume create blockstore
-    sleep 10s
+    wait_for_postgres some-postgres 5432 || return 1
     docker run --name iroha \
 	    -d \
 	    --net host \
@@ -38,6 +65,7 @@ function up_2(){
 	    -v blockstore:/tmp/block_store \
 	    -e KEY='node2' \
 	    hyperledger/iroha:latest
+    wait_for_port 127.0.0.1 50051 || return 1
 	    
 }
 
@@ -49,10 +77,10 @@ function up_3_plus(){
 	    -e POSTGRES_USER=postgres \
 	    -e POSTGRES_PASSWORD=mysecretpassword \
 	    --net host \
-	    -d postgres:9.5 \
-	    -c 'max_prepared_transactions=100'
+	    -d ${POSTGRES_IMAGE:-postgres:9.5} \
+	    ${POSTGRES_ARGS:--c max_prepared_transactions=100}
     docker volume create blockstore
-    sleep 10s
+    wait_for_postgres some-postgres 5432 || return 1
     docker run --name iroha \
 	    -d \
 	    --net host \
@@ -60,9 +88,46 @@ function up_3_plus(){
 	    -v blockstore:/tmp/block_store \
 	    -e KEY='keypair' \
 	    hyperledger/iroha:latest
+    wait_for_port 127.0.0.1 50051 || return 1
 	    
 }
 
+# A node folder written by topology.py, e.g. "network.sh up network/node1".
+# Its node.env names the containers, ports and postgres settings, so
+# several peers can run on one host.
+function up(){
+
+    source $1/node.env
+    service docker start
+    docker run --name $POSTGRES_CONTAINER \
+	    -e POSTGRES_USER=postgres \
+	    -e POSTGRES_PASSWORD=mysecretpassword \
+	    --net host \
+	    -d $POSTGRES_IMAGE \
+	    $POSTGRES_ARGS
+    docker volume create $BLOCKSTORE_VOLUME
+    wait_for_postgres $POSTGRES_CONTAINER $POSTGRES_PORT || return 1
+    docker run --name $IROHA_CONTAINER \
+	    -d \
+	    --net host \
+	    -v $(cd $1 && pwd):/opt/iroha_data \
+	    -v $BLOCKSTORE_VOLUME:/tmp/block_store \
+	    -e KEY=$KEY \
+	    $IROHA_IMAGE
+    wait_for_port 127.0.0.1 $TORII_PORT || return 1
+
+}
+
+# Removes the containers, database and block store of a folder started
+# with "up", leaving everything else on the host alone.
+function down_node(){
+
+    source $1/node.env
+    docker rm -f -v $IROHA_CONTAINER $POSTGRES_CONTAINER
+    docker volume rm $BLOCKSTORE_VOLUME
+
+}
+
 function up_post(){
 
     service docker start
@@ -70,8 +135,8 @@ function up_post(){
 	    -e POSTGRES_USER=postgres \
 	    -e POSTGRES_PASSWORD=mysecretpassword \
 	    --net host \
-	    -d postgres:9.5 \
-	    -c 'max_prepared_transactions=100'
+	    -d ${POSTGRES_IMAGE:-postgres:9.5} \
+	    ${POSTGRES_ARGS:--c max_prepared_transactions=100}
 	    
 }
 
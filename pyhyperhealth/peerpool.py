@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+#
+# Pool of Iroha peers that stands in for a single IrohaGrpc.
+# Each peer keeps one long lived gRPC channel. Queries go to the healthy
+# peer with the fewest outstanding calls (or round robin), status streams
+# stick to the peer that received the transaction, and peers that keep
+# failing or answer too slowly are ejected until a health check passes.
+#
+import binascii
+import itertools
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import grpc
+from iroha import IrohaCrypto, IrohaGrpc
+
+STRATEGIES = ('least_outstanding', 'round_robin')
+# Most transactions the peers take in one Iroha batch. A batch has to fit
+# in one proposal, so this is the max_proposal_size of the peers'
+# config.docker (10 in Network-Files), set with IROHA_MAX_PROPOSAL_SIZE.
+MAX_BATCH_SIZE = int(os.getenv('IROHA_MAX_PROPOSAL_SIZE', '10'))
+
+
+def peers_from_genesis(path, torii_port='50051'):
+    """
+    Torii addresses of the peers added in a genesis.block file. The block
+    lists the internal consensus port, so it is swapped for torii_port.
+    """
+    with open(path) as f:
+        block = json.load(f)
+    addresses = []
+    for transaction in block['block_v1']['payload']['transactions']:
+        for command in transaction['payload']['reducedPayload']['commands']:
+            if 'addPeer' in command:
+                host = command['addPeer']['peer']['address'].rsplit(':', 1)[0]
+                addresses.append('{}:{}'.format(host, torii_port))
+    return addresses
+
+
+def split_batches(transactions, size=None):
+    """
+    The transactions in lists of at most `size` (MAX_BATCH_SIZE by
+    default), one list per Iroha batch
+    """
+    size = min(size or MAX_BATCH_SIZE, MAX_BATCH_SIZE)
+    return [transactions[i:i + size] for i in range(0, len(transactions), size)]
+
+
+def addresses_from_env(default_host, default_port):
+    """
+    Peer addresses from IROHA_PEERS (comma separated host:port list) or the
+    peers in the IROHA_GENESIS block file, falling back to the single
+    default peer
+    """
+    addresses = [a.strip() for a in os.getenv('IROHA_PEERS', '').split(',') if a.strip()]
+    if not addresses and os.getenv('IROHA_GENESIS'):
+        addresses = peers_from_genesis(os.getenv('IROHA_GENESIS'), default_port)
+    if not addresses:
+        addresses = ['{}:{}'.format(default_host, default_port)]
+    return addresses
+
+
+class Peer:
+    """
+    One peer of the pool and the numbers used to route to it
+    """
+
+    def __init__(self, address, timeout):
+        self.address = address
+        self.net = IrohaGrpc(address, timeout=timeout)
+        self.outstanding = 0
+        self.failures = 0
+        self.latency = 0.0
+        self.ejected = False
+        self.ejected_at = 0.0
+
+    def stats(self):
+        return {
+            'address': self.address,
+            'outstanding': self.outstanding,
+            'failures': self.failures,
+            'latency': round(self.latency, 4),
+            'ejected': self.ejected,
+        }
+
+
+class PeerPool:
+    """
+    Spreads calls over several peers with the same methods as IrohaGrpc
+    """
+
+    def __init__(self, addresses, timeout=None, strategy='least_outstanding',
+                 max_failures=3, slow_after=5.0, eject_for=30.0,
+                 health_interval=10.0, sticky_size=100000):
+        if not addresses:
+            raise ValueError('at least one peer address is needed')
+        if strategy not in STRATEGIES:
+            raise ValueError('strategy must be one of {}'.format(STRATEGIES))
+        self.peers = [Peer(address, timeout) for address in addresses]
+        self.strategy = strategy
+        self.max_failures = max_failures
+        self.slow_after = slow_after
+        self.eject_for = eject_for
+        self.sticky_size = sticky_size
+        self._lock = threading.Lock()
+        self._turn = itertools.count()
+        # transaction hash -> peer that received it, for status streams
+        self._sticky = OrderedDict()
+        if health_interval:
+            thread = threading.Thread(target=self._health_loop, args=(health_interval,),
+                                      name='peerpool-health', daemon=True)
+            thread.start()
+
+    @classmethod
+    def from_env(cls, default_host, default_port):
+        """
+        Pool of the peers named by addresses_from_env
+        """
+        return cls(addresses_from_env(default_host, default_port),
+                   strategy=os.getenv('IROHA_PEER_STRATEGY', 'least_outstanding'))
+
+    # IrohaGrpc methods
+
+    def send_tx(self, transaction):
+        peer = self._call(lambda net: net.send_tx(transaction))
+        self._stick(transaction, peer)
+        return True
+
+    def send_txs(self, transactions):
+        peer = self._call(lambda net: net.send_txs(transactions))
+        for transaction in transactions:
+            self._stick(transaction, peer)
+        return True
+
+    def send_query(self, query):
+        return self._result(lambda net: net.send_query(query))
+
+    def tx_status(self, transaction):
+        return self._result(lambda net: net.tx_status(transaction),
+                            first=self._sticky_peer(transaction))
+
+    def tx_status_stream(self, transaction):
+        """
+        Status stream from the peer that received the transaction, moving to
+        another peer if that one goes away before a final status
+        """
+        tried = set()
+        peer = self._sticky_peer(transaction)
+        while True:
+            peer = peer if peer is not None and peer not in tried else self._pick(exclude=tried)
+            if peer is None:
+                raise grpc.RpcError('no peer left to follow the status stream')
+            tried.add(peer)
+            try:
+                for status in peer.net.tx_status_stream(transaction):
+                    yield status
+                return
+            except grpc.RpcError:
+                self._failed(peer)
+                peer = None
+
+    def block_stream(self, query):
+        peer = self._pick()
+        return peer.net.block_stream(query)
+
+    def stats(self):
+        with self._lock:
+            return [peer.stats() for peer in self.peers]
+
+    # routing
+
+    def _pick(self, exclude=()):
+        with self._lock:
+            candidates = [p for p in self.peers if not p.ejected and p not in exclude]
+            if not candidates:
+                # everyone is ejected, so try the least bad peer anyway
+                candidates = [p for p in self.peers if p not in exclude]
+            if not candidates:
+                return None
+            turn = next(self._turn)
+            if self.strategy == 'round_robin':
+                return candidates[turn % len(candidates)]
+            # rotate before min() so ties are spread over the peers
+            start = turn % len(candidates)
+            candidates = candidates[start:] + candidates[:start]
+            return min(candidates, key=lambda p: p.outstanding)
+
+    def _call(self, call, first=None):
+        """
+        Run call(net) on a peer, failing over to the others on errors, and
+        return the peer that answered
+        """
+        return self._run(call, first)[0]
+
+    def _result(self, call, first=None):
+        return self._run(call, first)[1]
+
+    def _run(self, call, first):
+        tried = set()
+        error = None
+        peer = first
+        while True:
+            if peer is None or peer in tried:
+                peer = self._pick(exclude=tried)
+            if peer is None:
+                raise error
+            tried.add(peer)
+            with self._lock:
+                peer.outstanding += 1
+            start = time.monotonic()
+            try:
+                result = call(peer.net)
+            except grpc.RpcError as e:
+                error = e
+                self._failed(peer)
+                peer = None
+                continue
+            except Exception:
+                with self._lock:
+                    peer.outstanding -= 1
+                raise
+            self._succeeded(peer, time.monotonic() - start)
+            return peer, result
+
+    def _succeeded(self, peer, elapsed):
+        with self._lock:
+            peer.outstanding -= 1
+            peer.failures = 0
+            peer.latency = elapsed if not peer.latency else 0.8 * peer.latency + 0.2 * elapsed
+            if peer.latency > self.slow_after and not peer.ejected:
+                self._eject(peer, 'slow, {:.2f}s'.format(peer.latency))
+
+    def _failed(self, peer):
+        with self._lock:
+            peer.outstanding = max(peer.outstanding - 1, 0)
+            peer.failures += 1
+            if peer.failures >= self.max_failures and not peer.ejected:
+                self._eject(peer, '{} failures in a row'.format(peer.failures))
+
+    def _eject(self, peer, reason):
+        # called with the lock held
+        peer.ejected = True
+        peer.ejected_at = time.monotonic()
+        print('Ejecting Iroha peer {} ({})'.format(peer.address, reason))
+
+    def _stick(self, transaction, peer):
+        tx_hash = binascii.hexlify(IrohaCrypto.hash(transaction))
+        with self._lock:
+            self._sticky[tx_hash] = peer
+            while len(self._sticky) > self.sticky_size:
+                self._sticky.popitem(last=False)
+
+    def _sticky_peer(self, transaction):
+        tx_hash = binascii.hexlify(IrohaCrypto.hash(transaction))
+        with self._lock:
+            return self._sticky.get(tx_hash)
+
+    def _health_loop(self, interval):
+        while True:
+            time.sleep(interval)
+            for peer in self.peers:
+                ready = True
+                try:
+                    grpc.channel_ready_future(peer.net._channel).result(timeout=interval)
+                except grpc.FutureTimeoutError:
+                    ready = False
+                with self._lock:
+                    if not ready and not peer.ejected:
+                        self._eject(peer, 'health check failed')
+                    elif (ready and peer.ejected
+                          and time.monotonic() - peer.ejected_at >= self.eject_for):
+                        peer.ejected = False
+                        peer.failures = 0
+                        peer.latency = 0.0
+                        print('Re-admitting Iroha peer {}'.format(peer.address))
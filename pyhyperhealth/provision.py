@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+#
+# Bulk account provisioning.
+# Reads account names from a CSV or JSONL stream, generates the key pairs
+# on a SigningPool, and sends CreateAccount (plus AppendRole when a role is
+# given) in Iroha batches of one transaction per account, so each account
+# is created or rejected on its own. Keys are made and signed for
+# `chunk_size` accounts at a time, and each batch holds at most
+# `batch_size` of them, no more than the peers' max_proposal_size. Results
+# come out in input order with at most `max_in_flight` accounts waiting on
+# the ledger.
+#
+# The keys go to a manifest written one JSON line at a time. With a key
+# from make_manifest_key each line is encrypted as a Fernet token, which
+# needs the optional cryptography package (pip install pyhyperhealth[manifest]).
+#
+import argparse
+import json
+import os
+import sys
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+try:
+    from .bulkimport import FORMATS, guess_format, read_rows, with_progress
+    from .journal import send_journaled
+    from .peerpool import MAX_BATCH_SIZE, split_batches
+    from .signers import as_signer
+    from .signpool import SigningPool, make_keypairs
+    from .statusresolver import committed, status_future
+except ImportError:
+    from bulkimport import FORMATS, guess_format, read_rows, with_progress
+    from journal import send_journaled
+    from peerpool import MAX_BATCH_SIZE, split_batches
+    from signers import as_signer
+    from signpool import SigningPool, make_keypairs
+    from statusresolver import committed, status_future
+
+ACCOUNT_FIELDS = ('account', 'domain')
+
+
+def _fernet(key):
+    try:
+        from cryptography.fernet import Fernet
+    except ImportError:
+        raise RuntimeError('encrypted manifests need the cryptography package, '
+                           'pip install pyhyperhealth[manifest]')
+    return Fernet(key)
+
+
+def make_manifest_key():
+    """
+    New key for encrypting manifests
+    """
+    from cryptography.fernet import Fernet
+    return Fernet.generate_key()
+
+
+class ManifestWriter:
+    """
+    Writes manifest records as JSON lines, each one encrypted when a key is
+    given, so nothing is held in memory and no key is written in the clear.
+    Without `out`, line() still formats records for streaming elsewhere.
+    """
+
+    def __init__(self, out=None, key=None):
+        self.out = out
+        self._fernet = _fernet(key) if key else None
+
+    def line(self, record):
+        text = json.dumps(record)
+        if self._fernet is not None:
+            text = self._fernet.encrypt(text.encode('utf-8')).decode('ascii')
+        return text + '\n'
+
+    def write(self, record):
+        self.out.write(self.line(record))
+
+
+def open_manifest(path):
+    """
+    Open a new manifest file readable by its owner only
+    """
+    return os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'w')
+
+
+def read_manifest(lines, key=None):
+    """
+    Yield the records of a manifest, decrypting them when a key is given
+    """
+    fernet = _fernet(key) if key else None
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        if fernet is not None:
+            line = fernet.decrypt(line.encode('ascii')).decode('utf-8')
+        yield json.loads(line)
+
+
+def read_accounts(lines, fmt):
+    """
+    read_rows for account lists: account and domain, and optionally role
+    """
+    return read_rows(lines, fmt, ACCOUNT_FIELDS, optional=('role',))
+
+
+def provision_accounts(rows, net, iroha, private_key, signing_pool=None, role=None,
+                       batch_size=MAX_BATCH_SIZE, max_in_flight=1000, status_workers=16,
+                       resolver=None, chunk_size=100, journal=None):
+    """
+    Create an account for each row from read_accounts and yield one result
+    per row, in order, holding the new key pair. A row's own role wins
+    over `role`. Batches larger than MAX_BATCH_SIZE are split. Statuses
+    come from `resolver` when given, and the transactions go in `journal`
+    when given.
+    """
+    signer = as_signer(private_key)
+    status_pool = ThreadPoolExecutor(max_workers=status_workers,
+                                     thread_name_prefix='provision')
+    in_flight = deque()
+
+    def finish(number, row, keys, future, error):
+        if error is not None:
+            return {'row': number, 'result': 'INVALID', 'error': error}
+        result = {'row': number, 'account': row['account'] + '@' + row['domain'],
+                  'private_key': keys[0].decode('ascii'),
+                  'public_key': keys[1].decode('ascii')}
+        try:
+            result['result'] = 'COMMITTED' if committed(future.result()) else 'REJECTED'
+        except Exception as e:
+            result['result'] = 'ERROR'
+            result['error'] = str(e)
+        return result
+
+    def send(chunk):
+        valid = [entry for entry in chunk if entry[2] is None]
+        keys_by_row = {}
+        if valid:
+            if signing_pool is not None:
+                pairs = signing_pool.keypairs(len(valid))
+            else:
+                pairs = make_keypairs(len(valid))
+            txs = []
+            for (number, row, _), keys in zip(valid, pairs):
+                commands = [iroha.command('CreateAccount', account_name=row['account'],
+                                          domain_id=row['domain'], public_key=keys[1])]
+                account_role = row.get('role') or role
+                if account_role:
+                    commands.append(iroha.command(
+                        'AppendRole', account_id=row['account'] + '@' + row['domain'],
+                        role_name=account_role))
+                txs.append(iroha.transaction(commands))
+            batches = split_batches(txs, batch_size)
+            for batch in batches:
+                iroha.batch(batch, atomic=False)
+            if signing_pool is not None:
+                signing_pool.sign_transactions(signer, txs)
+            else:
+                for tx in txs:
+                    signer.sign_transaction(tx)
+            futures = []
+            for batch in batches:
+                try:
+                    send_journaled(journal, batch, lambda: net.send_txs(batch))
+                    futures.extend(status_future(net, tx, resolver, status_pool, journal)
+                                   for tx in batch)
+                except Exception as e:
+                    for _ in batch:
+                        future = Future()
+                        future.set_exception(e)
+                        futures.append(future)
+            keys_by_row = {entry[0]: (keys, future)
+                           for entry, keys, future in zip(valid, pairs, futures)}
+        for number, row, error in chunk:
+            if error is None:
+                keys, future = keys_by_row[number]
+                in_flight.append((number, row, keys, future, None))
+            else:
+                in_flight.append((number, None, None, None, error))
+
+    try:
+        chunk = []
+        for number, row, error in rows:
+            chunk.append((number, row, error))
+            if len(chunk) >= chunk_size:
+                send(chunk)
+                chunk = []
+                while len(in_flight) > max_in_flight:
+                    yield finish(*in_flight.popleft())
+        if chunk:
+            send(chunk)
+        while in_flight:
+            yield finish(*in_flight.popleft())
+    finally:
+        status_pool.shutdown(wait=False)
+
+
+def provision_file(path, manifest_path, net, iroha, private_key, manifest_key=None,
+                   signing_pool=None, role=None, fmt=None, batch_size=MAX_BATCH_SIZE,
+                   max_in_flight=1000, progress_every=1000):
+    """
+    Provision the accounts in a CSV/JSONL file, writing the manifest to
+    manifest_path, and return the count of each result
+    """
+    counts = {}
+    with open(path, newline='') as f, open_manifest(manifest_path) as manifest:
+        writer = ManifestWriter(manifest, manifest_key)
+        results = provision_accounts(read_accounts(f, fmt or guess_format(path)), net, iroha,
+                                     private_key, signing_pool, role, batch_size,
+                                     max_in_flight)
+        for result in with_progress(results, progress_every):
+            counts[result['result']] = counts.get(result['result'], 0) + 1
+            writer.write(result)
+    return counts
+
+
+def main(argv=None):
+    """
+    Console script: provision accounts as the admin account from adminapi.py
+    """
+    parser = argparse.ArgumentParser(
+        description='Create accounts in bulk and write their keys to a manifest')
+    parser.add_argument('path', nargs='?',
+                        help='file with account, domain (and optional role) rows')
+    parser.add_argument('--manifest', help='write the key manifest here')
+    parser.add_argument('--key-file', help='file holding the manifest encryption key')
+    parser.add_argument('--new-key', metavar='PATH',
+                        help='write a new manifest key to PATH and exit')
+    parser.add_argument('--plaintext', action='store_true',
+                        help='write the manifest without encrypting it')
+    parser.add_argument('--decrypt', metavar='MANIFEST',
+                        help='print the records of an encrypted manifest and exit')
+    parser.add_argument('--format', choices=FORMATS, help='default: from the file name')
+    parser.add_argument('--role', help='role to append to every account')
+    parser.add_argument('--batch-size', type=int, default=MAX_BATCH_SIZE,
+                        help='accounts per Iroha batch, at most the peers\' max_proposal_size '
+                             '(default {})'.format(MAX_BATCH_SIZE))
+    parser.add_argument('--max-in-flight', type=int, default=1000)
+    parser.add_argument('--processes', type=int, default=None,
+                        help='processes for key generation and signing (default: all cores)')
+    args = parser.parse_args(argv)
+
+    if args.new_key:
+        with open_manifest(args.new_key) as f:
+            f.write(make_manifest_key().decode('ascii'))
+        return 0
+    key = None
+    if args.key_file:
+        with open(args.key_file) as f:
+            key = f.read().strip().encode('ascii')
+    if args.decrypt:
+        with open(args.decrypt) as f:
+            for record in read_manifest(f, key):
+                print(json.dumps(record))
+        return 0
+    if not args.path or not args.manifest:
+        parser.error('the account file and --manifest are required')
+    if key is None and not args.plaintext:
+        parser.error('give --key-file to encrypt the manifest, or --plaintext')
+    if not 1 <= args.batch_size <= MAX_BATCH_SIZE:
+        parser.error('--batch-size must be between 1 and {}'.format(MAX_BATCH_SIZE))
+
+    from iroha import Iroha
+    try:
+        from .peerpool import PeerPool
+    except ImportError:
+        from peerpool import PeerPool
+
+    IROHA_HOST_ADDR = os.getenv('IROHA_HOST_ADDR', '128.163.181.53')
+    IROHA_PORT = os.getenv('IROHA_PORT', '50051')
+    ADMIN_ACCOUNT_ID = os.getenv('ADMIN_ACCOUNT_ID', 'admin@test')
+    ADMIN_PRIVATE_KEY = os.getenv(
+        'ADMIN_PRIVATE_KEY', 'f101537e319568c765b2cc89698325604991dca57b9716b58016b253506cab70')
+
+    net = PeerPool.from_env(IROHA_HOST_ADDR, IROHA_PORT)
+    signing_pool = SigningPool(args.processes)
+    try:
+        counts = provision_file(args.path, args.manifest, net, Iroha(ADMIN_ACCOUNT_ID),
+                                ADMIN_PRIVATE_KEY, key, signing_pool, args.role,
+                                args.format, args.batch_size, args.max_in_flight)
+    finally:
+        signing_pool.close()
+    return 0 if set(counts) <= {'COMMITTED'} else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+#
+# Response bodies of the API servers.
+# Documents are sent as JSON unless the Accept header prefers MessagePack
+# (application/msgpack, when the msgpack package is installed:
+# pip install pyhyperhealth[msgpack]). Account details can also be had as
+# the peer's own AccountDetailResponse protobuf (application/x-protobuf).
+# The detail JSON a peer returns is cached as UTF-8 bytes and spliced into
+# the JSON response as it is, so it is never parsed and dumped again.
+#
+import json
+
+from iroha import qry_responses_pb2
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+PROTOBUF = 'application/x-protobuf'
+# Other names clients use for the same formats
+ALIASES = {
+    MSGPACK: ('application/x-msgpack', 'application/vnd.msgpack'),
+    PROTOBUF: ('application/protobuf', 'application/vnd.google.protobuf'),
+}
+
+
+def _msgpack():
+    try:
+        import msgpack
+    except ImportError:
+        return None
+    return msgpack
+
+
+def offered(protobuf=False):
+    """
+    Media types a response can be sent as, the default first
+    """
+    types = [JSON]
+    if _msgpack() is not None:
+        types.append(MSGPACK)
+    if protobuf:
+        types.append(PROTOBUF)
+    return types
+
+
+def best_match(accept, types):
+    """
+    The type of `types` an Accept header prefers, by quality and then by
+    how specific the match is. The first type when nothing matches, so
+    clients sending no Accept header or text/plain still get JSON.
+    """
+    if not accept:
+        return types[0]
+    ranges = []
+    for part in accept.split(','):
+        media, _, params = part.partition(';')
+        quality = 1.0
+        for param in params.split(';'):
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        ranges.append((media.strip().lower(), quality))
+    # types named with q=0 are refused even when a wildcard matches them
+    refused = {candidate for media, quality in ranges if quality <= 0 for candidate in types
+               if media == candidate or media in ALIASES.get(candidate, ())}
+    best, best_rank = types[0], (0.0, -1)
+    for media, quality in ranges:
+        if quality <= 0:
+            continue
+        for candidate in types:
+            if candidate in refused:
+                continue
+            if media == candidate or media in ALIASES.get(candidate, ()):
+                specificity = 2
+            elif media == '*/*':
+                specificity = 0
+            elif media.endswith('/*') and candidate.startswith(media[:-1]):
+                specificity = 1
+            else:
+                continue
+            if (quality, specificity) > best_rank:
+                best, best_rank = candidate, (quality, specificity)
+            break
+    return best
+
+
+def encode(document, media_type):
+    """
+    Bytes of a dict or list in the negotiated format
+    """
+    if media_type == MSGPACK:
+        return _msgpack().packb(document, use_bin_type=True)
+    return json.dumps(document).encode('utf-8')
+
+
+def detail_body(account_id, detail, media_type):
+    """
+    Bytes of {"account_id": ..., "detail": {writer: {key: value}}} from the
+    detail JSON a peer returned, as UTF-8 bytes
+    """
+    if media_type == PROTOBUF:
+        return qry_responses_pb2.AccountDetailResponse(
+            detail=detail.decode('utf-8')).SerializeToString()
+    if media_type == MSGPACK:
+        return encode({'account_id': account_id, 'detail': json.loads(detail or b'{}')},
+                      media_type)
+    return b''.join((b'{"account_id": ', json.dumps(account_id).encode('utf-8'),
+                     b', "detail": ', detail or b'{}', b'}'))
+
+
+def status_document(result, tx_hash=None):
+    """
+    {"hash": ..., "status": ...} for the "COMMITTED\\n", "REJECTED\\n" or
+    "TIMEOUT\\n" result of a transaction. Writes sent in a shared batch have
+    no hash of their own.
+    """
+    document = {'status': result.strip()}
+    if tx_hash is not None:
+        document['hash'] = tx_hash
+    return document
+
+
+def respond(document, code=200):
+    """
+    Flask response with the document in the format the request accepts
+    """
+    from flask import Response, request
+
+    media_type = best_match(request.headers.get('Accept'), offered())
+    return Response(encode(document, media_type), code, mimetype=media_type)
+
+
+def respond_detail(account_id, detail):
+    """
+    Flask response for /getdetails from the cached detail bytes
+    """
+    from flask import Response, request
+
+    media_type = best_match(request.headers.get('Accept'), offered(protobuf=True))
+    return Response(detail_body(account_id, detail, media_type), mimetype=media_type)
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+#
+# Benchmark of the Flask server (api.py) against the asyncio server
+# (asyncapi.py). Both are served over real HTTP against a FakePeer, and a
+# fixed number of EHR writes is kept in flight for `duration` seconds.
+# Each mode runs in its own process so their threads and memory are
+# counted separately.
+#
+# python3 serverbench.py --in-flight 2000 --duration 20 --commit-latency 2
+#
+import argparse
+import asyncio
+import json
+import resource
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+try:
+    from .loadtest import ADMIN_DOMAIN, ADMIN_PRIVATE_KEY, ADMIN_USER, load_target, summarize
+except ImportError:
+    from loadtest import ADMIN_DOMAIN, ADMIN_PRIVATE_KEY, ADMIN_USER, load_target, summarize
+
+MODES = ('flask', 'async')
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def serve(mode, address):
+    """
+    Start the server for the mode on a thread and return its port
+    """
+    port = _free_port()
+    if mode == 'flask':
+        from werkzeug.serving import make_server
+
+        module = load_target('api', address)
+        server = make_server('127.0.0.1', port, module.app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    else:
+        import uvicorn
+
+        module = load_target('asyncapi', address)
+        config = uvicorn.Config(module.app, host='127.0.0.1', port=port,
+                                log_level='warning', backlog=8192)
+        server = uvicorn.Server(config)
+        threading.Thread(target=server.run, daemon=True).start()
+        while not server.started:
+            time.sleep(0.05)
+    return port
+
+
+async def _get(port, path):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write('GET {} HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n'
+                 .format(path).encode('ascii'))
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    status = int(response.split(b' ', 2)[1])
+    # only a COMMITTED write counts, not TIMEOUT or a 202 without a status
+    if status != 200 or json.loads(response.split(b'\r\n\r\n', 1)[1]).get('status') != 'COMMITTED':
+        raise RuntimeError(response[:200])
+
+
+async def _drive(port, in_flight, duration):
+    latencies = []
+    errors = [0]
+    counter = iter(range(10 ** 12))
+    stop_at = time.monotonic() + duration
+    auth = '/{}/{}/{}'.format(ADMIN_USER, ADMIN_DOMAIN, ADMIN_PRIVATE_KEY)
+
+    async def worker():
+        while time.monotonic() < stop_at:
+            n = next(counter)
+            start = time.perf_counter()
+            try:
+                await _get(port, '/addehr/patient{}/healthcare/ehr{}/REF{}{}'.format(
+                    n % 100, n, n, auth))
+                latencies.append(time.perf_counter() - start)
+            except Exception:
+                errors[0] += 1
+
+    await asyncio.gather(*(worker() for _ in range(in_flight)))
+    return latencies, errors[0]
+
+
+def run(mode, in_flight=1000, duration=10.0, commit_latency=1.0):
+    """
+    Benchmark one server mode in this process and return the results
+    """
+    try:
+        from .fakepeer import FakePeer
+    except ImportError:
+        from fakepeer import FakePeer
+
+    peer = FakePeer(commit_latency=commit_latency, workers=max(64, in_flight))
+    port = serve(mode, peer.start())
+    peak_threads = [threading.active_count()]
+    sampling = [True]
+
+    def sample():
+        while sampling[0]:
+            peak_threads[0] = max(peak_threads[0], threading.active_count())
+            time.sleep(0.1)
+
+    threading.Thread(target=sample, daemon=True).start()
+    start = time.monotonic()
+    latencies, errors = asyncio.run(_drive(port, in_flight, duration))
+    elapsed = time.monotonic() - start
+    sampling[0] = False
+    peer.stop()
+    return {
+        'mode': mode,
+        'in_flight': in_flight,
+        'duration': duration,
+        'commit_latency': commit_latency,
+        'total': summarize(latencies, errors, elapsed),
+        'peak_threads': peak_threads[0],
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare the Flask and asyncio API servers')
+    parser.add_argument('--mode', choices=MODES + ('both',), default='both')
+    parser.add_argument('--in-flight', type=int, default=1000,
+                        help='requests kept open at once (default 1000)')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds')
+    parser.add_argument('--commit-latency', type=float, default=1.0,
+                        help='seconds before the fake peer commits a transaction')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args(argv)
+
+    if args.mode != 'both':
+        results = [run(args.mode, args.in_flight, args.duration, args.commit_latency)]
+    else:
+        results = []
+        for mode in MODES:
+            output = subprocess.run(
+                [sys.executable, __file__, '--mode', mode, '--json',
+                 '--in-flight', str(args.in_flight), '--duration', str(args.duration),
+                 '--commit-latency', str(args.commit_latency)],
+                check=True, stdout=subprocess.PIPE).stdout
+            results.append(json.loads(output.decode('utf-8').strip().splitlines()[-1]))
+    for result in results:
+        if args.json:
+            print(json.dumps(result))
+            continue
+        total = result['total']
+        print('{:6} {:8.1f} req/sec  p50 {}  p99 {}  {} errors  {} threads  {:.1f} MB rss'.format(
+            result['mode'], total['throughput'], total['p50'], total['p99'], total['errors'],
+            result['peak_threads'], result['max_rss_kb'] / 1e3))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
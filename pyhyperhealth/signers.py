@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+#
+# Reusable signers and Iroha builders.
+# IrohaCrypto.sign_transaction decodes the hex key and derives the public
+# key again on every call, and the public key derivation is the slow part.
+# A Signer does that once, and a ClientCache keeps one Iroha builder and
+# Signer per (account, key) so repeated requests skip the setup.
+#
+import binascii
+import contextlib
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from iroha import Iroha, IrohaCrypto
+from iroha import ed25519, primitive_pb2
+
+
+def key_digest(private_key):
+    """
+    Digest that identifies a key without keeping the key itself
+    """
+    if isinstance(private_key, str):
+        private_key = private_key.encode('ascii')
+    return hashlib.sha256(private_key).hexdigest()
+
+
+class Signer:
+    """
+    Signs transactions and queries with one private key, decoded once
+    """
+
+    def __init__(self, private_key):
+        if isinstance(private_key, str):
+            private_key = private_key.encode('ascii')
+        self.public_key = IrohaCrypto.derive_public_key(private_key)
+        self._public_raw = binascii.unhexlify(self.public_key)
+        # a bytearray so the key can be overwritten when it is dropped
+        self._private_raw = bytearray(binascii.unhexlify(private_key))
+
+    def signature(self, message):
+        """
+        Signature of the payload of a transaction or query
+        """
+        return self.make_signature(self.sign_hash(IrohaCrypto.hash(message)))
+
+    def sign_hash(self, message_hash):
+        """
+        Raw ed25519 signature of an already computed payload hash
+        """
+        if not any(self._private_raw):
+            raise ValueError('this signer has been wiped')
+        return ed25519.signature_unsafe(
+            message_hash, bytes(self._private_raw), self._public_raw)
+
+    def make_signature(self, signature_bytes):
+        """
+        Signature message for raw signature bytes made with this key
+        """
+        signature = primitive_pb2.Signature()
+        signature.public_key = self.public_key
+        signature.signature = binascii.hexlify(signature_bytes)
+        return signature
+
+    def sign_transaction(self, transaction):
+        transaction.signatures.extend([self.signature(transaction)])
+        return transaction
+
+    def sign_query(self, query):
+        query.signature.CopyFrom(self.signature(query))
+        return query
+
+    def hex_private_key(self):
+        """
+        The key in hex again, for handing to signing worker processes
+        """
+        return binascii.hexlify(bytes(self._private_raw))
+
+    def wipe(self):
+        """
+        Overwrite the decoded private key. Python may still hold short lived
+        copies made while signing, so this is best effort.
+        """
+        for i in range(len(self._private_raw)):
+            self._private_raw[i] = 0
+
+
+def as_signer(private_key):
+    """
+    Signer for a hex private key, or the signer itself if given one
+    """
+    if isinstance(private_key, Signer):
+        return private_key
+    return Signer(private_key)
+
+
+class ClientCache:
+    """
+    LRU cache of (Iroha builder, Signer) pairs by account and key. Entries
+    not used for `max_idle` seconds are dropped. get() checks an entry out
+    and a dropped signer is wiped once the last request using it is done.
+    """
+
+    def __init__(self, max_entries=1000, max_idle=600.0):
+        self.max_entries = max_entries
+        self.max_idle = max_idle
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # key -> [iroha, signer, last used, requests using it]
+        self._entries = OrderedDict()
+
+    @contextlib.contextmanager
+    def get(self, account_id, private_key):
+        """
+        Iroha builder and Signer for the account, created on first use and
+        held until the with block ends
+        """
+        entry = self._checkout(account_id, private_key)
+        try:
+            yield entry[0], entry[1]
+        finally:
+            with self._lock:
+                entry[3] -= 1
+                if entry[3] == 0 and entry[4]:
+                    entry[1].wipe()
+
+    def _checkout(self, account_id, private_key):
+        key = (account_id, key_digest(private_key))
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                entry[2] = now
+                entry[3] += 1
+                self.hits += 1
+                self._expire(now)
+                return entry
+            self.misses += 1
+        # deriving the public key is slow, so do it outside the lock
+        iroha, signer = Iroha(account_id), Signer(private_key)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                signer.wipe()
+                entry[3] += 1
+                return entry
+            # the last field is set once the entry has left the cache
+            entry = self._entries[key] = [iroha, signer, now, 1, False]
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+            self._expire(now)
+        return entry
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries):
+                self._drop(key)
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits,
+                    'misses': self.misses, 'max_entries': self.max_entries}
+
+    def _drop(self, key):
+        # called with the lock held
+        entry = self._entries.pop(key)
+        entry[4] = True
+        if entry[3] == 0:
+            entry[1].wipe()
+
+    def _expire(self, now):
+        # called with the lock held, oldest entries are first
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if now - entry[2] < self.max_idle:
+                break
+            self._drop(key)
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+#
+# Signing and hashing spread over CPU cores.
+# The ed25519 code in the iroha library is pure Python, so signing many
+# transactions on one thread is limited by the GIL. A SigningPool sends
+# chunks of serialized payloads to worker processes, which hash and sign
+# them and send back the hashes and signatures. Key pairs for new accounts
+# are generated the same way.
+#
+import binascii
+import hashlib
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from iroha import IrohaCrypto
+
+try:
+    from .signers import Signer, as_signer
+except ImportError:
+    from signers import Signer, as_signer
+
+# Below this many payloads the pool is not worth the process round trip
+INLINE_BELOW = 8
+
+# One Signer per key in each worker process
+_worker_signers = {}
+
+
+def _sign_chunk(private_key, payloads):
+    """
+    Worker: sha3-256 hash and sign each serialized payload
+    """
+    signer = _worker_signers.get(private_key)
+    if signer is None:
+        if len(_worker_signers) >= 64:
+            for old in _worker_signers.values():
+                old.wipe()
+            _worker_signers.clear()
+        signer = _worker_signers[private_key] = Signer(private_key)
+    results = []
+    for payload in payloads:
+        payload_hash = hashlib.sha3_256(payload).digest()
+        results.append((payload_hash, signer.sign_hash(payload_hash)))
+    return results
+
+
+def make_keypairs(count):
+    """
+    `count` new (private key, public key) pairs in hex, also run on the workers
+    """
+    pairs = []
+    for _ in range(count):
+        private_key = IrohaCrypto.private_key()
+        pairs.append((private_key, IrohaCrypto.derive_public_key(private_key)))
+    return pairs
+
+
+class SigningPool:
+    """
+    Process pool that signs transaction payloads in bulk
+    """
+
+    def __init__(self, processes=None, chunk_size=64):
+        self.processes = processes or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self._pool = ProcessPoolExecutor(max_workers=self.processes)
+
+    def sign_payloads(self, private_key, payloads):
+        """
+        (hash, raw signature) for each serialized payload, in order.
+        private_key may be a hex key or a Signer.
+        """
+        payloads = list(payloads)
+        if isinstance(private_key, Signer):
+            private_key = private_key.hex_private_key()
+        if isinstance(private_key, str):
+            private_key = private_key.encode('ascii')
+        if len(payloads) < INLINE_BELOW:
+            return _sign_chunk(private_key, payloads)
+        # split evenly so every process gets work, in chunks of at most chunk_size
+        size = max(1, min(self.chunk_size, -(-len(payloads) // self.processes)))
+        chunks = [payloads[i:i + size] for i in range(0, len(payloads), size)]
+        results = []
+        for chunk_results in self._pool.map(_sign_chunk, [private_key] * len(chunks), chunks):
+            results.extend(chunk_results)
+        return results
+
+    def keypairs(self, count):
+        """
+        `count` new key pairs, generated on the worker processes
+        """
+        if count < INLINE_BELOW:
+            return make_keypairs(count)
+        size = max(1, min(self.chunk_size, -(-count // self.processes)))
+        sizes = [min(size, count - i) for i in range(0, count, size)]
+        pairs = []
+        for chunk_pairs in self._pool.map(make_keypairs, sizes):
+            pairs.extend(chunk_pairs)
+        return pairs
+
+    def sign_transactions(self, private_key, transactions):
+        """
+        Add a signature to each transaction and return their hex hashes
+        """
+        signer = as_signer(private_key)
+        results = self.sign_payloads(
+            private_key, (tx.payload.SerializeToString() for tx in transactions))
+        hashes = []
+        for transaction, (payload_hash, signature_bytes) in zip(transactions, results):
+            transaction.signatures.extend([signer.make_signature(signature_bytes)])
+            hashes.append(binascii.hexlify(payload_hash).decode('ascii'))
+        return hashes
+
+    def close(self):
+        self._pool.shutdown(wait=True)
+
+
+def benchmark(count=2000, processes=None):
+    """
+    Signatures per second signing `count` transactions on one thread and
+    through a SigningPool
+    """
+    from iroha import Iroha
+
+    private_key = IrohaCrypto.private_key()
+    iroha = Iroha('admin@test')
+
+    def transactions():
+        return [iroha.transaction([iroha.command('SetAccountDetail', account_id='bob@healthcare',
+                                                 key='ehr{}'.format(i), value=str(i))])
+                for i in range(count)]
+
+    serial_txs = transactions()
+    signer = Signer(private_key)
+    start = time.monotonic()
+    for tx in serial_txs:
+        signer.sign_transaction(tx)
+    serial = count / (time.monotonic() - start)
+
+    pool = SigningPool(processes)
+    pool.sign_payloads(private_key, [b'warm up'] * pool.processes * INLINE_BELOW)
+    pool_txs = transactions()
+    start = time.monotonic()
+    pool.sign_transactions(private_key, pool_txs)
+    pooled = count / (time.monotonic() - start)
+    pool.close()
+    return {'transactions': count, 'processes': pool.processes,
+            'serial_per_sec': serial, 'pool_per_sec': pooled,
+            'speedup': pooled / serial}
+
+
+# python3 signpool.py [transactions] [processes]
+if __name__ == '__main__':
+    results = benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 2000,
+                        int(sys.argv[2]) if len(sys.argv) > 2 else None)
+    for name, value in results.items():
+        print('{}: {}'.format(name, value))
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+#
+# Snapshots of the healthcare world state (accounts, domains, roles,
+# details and grants, as kept by indexer.py) at a block height, so a new
+# indexer starts from the state instead of replaying every block.
+#
+# A snapshot is a sequence of frames, each a 4 byte length followed by a
+# zlib compressed JSON document: a header with the height and the hash of
+# the block at that height, chunks of at most `rows_per_chunk` rows of
+# one table, and a footer with the row counts and a SHA-256 over the
+# header and all the chunks. Frames are read and applied one at a time, so
+# memory does not grow with the state. Before committing, import checks
+# the header against the block at the snapshot height, that the next
+# block links to the snapshot block by its prev_block_hash, and the footer
+# digest, and then catches up the tail.
+#
+# Iroha 1.x peers build their world state by replaying blocks and cannot
+# load a snapshot, so peers still sync from the block store.
+#
+# python3 snapshot.py export --db index.sqlite --block-store /tmp/block_store/ state.snap
+# python3 snapshot.py import state.snap --db new.sqlite --block-store /tmp/block_store/
+# python3 snapshot.py verify state.snap --block-store /tmp/block_store/
+#
+import argparse
+import binascii
+import hashlib
+import json
+import os
+import struct
+import sys
+import time
+import zlib
+
+from iroha import IrohaCrypto
+
+try:
+    from .indexer import DetailIndex, blocks_from_store, fetch_block, follow, replay_store
+except ImportError:
+    from indexer import DetailIndex, blocks_from_store, fetch_block, follow, replay_store
+
+MAGIC = b'PHSNAP01'
+FRAME = struct.Struct('<I')
+# 2: the digest covers the header too
+FORMAT = 2
+
+
+class SnapshotError(Exception):
+    """
+    A snapshot that is damaged or does not match the ledger
+    """
+
+
+def block_hash(block):
+    """
+    Hex hash of a block_pb2.Block, as the next block's prev_block_hash
+    """
+    return binascii.hexlify(IrohaCrypto.hash(block.block_v1)).decode('ascii')
+
+
+def _write_frame(f, document):
+    data = json.dumps(document, separators=(',', ':')).encode('utf-8')
+    compressed = zlib.compress(data, 6)
+    f.write(FRAME.pack(len(compressed)))
+    f.write(compressed)
+    return data
+
+
+def read_frames(path):
+    """
+    Yield the decoded frames of a snapshot file, header first
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise SnapshotError('{} is not a snapshot'.format(path))
+        while True:
+            head = f.read(FRAME.size)
+            if not head:
+                return
+            if len(head) < FRAME.size:
+                raise SnapshotError('truncated snapshot')
+            compressed = f.read(FRAME.unpack(head)[0])
+            try:
+                yield zlib.decompress(compressed)
+            except zlib.error as e:
+                raise SnapshotError('damaged snapshot chunk: {}'.format(e))
+
+
+def export_snapshot(index, path, block, rows_per_chunk=10000):
+    """
+    Write the state of a DetailIndex to `path`. `block` is the block at
+    the index height, from the block store or a peer, and its hash goes
+    into the header. Returns the header.
+    """
+    state = index.export_state(rows_per_chunk)
+    height = next(state)
+    if block.block_v1.payload.height != height:
+        state.close()
+        raise SnapshotError('the index is at height {}, the block is {}'.format(
+            height, block.block_v1.payload.height))
+    header = {
+        'format': FORMAT,
+        'height': height,
+        'block_hash': block_hash(block),
+        'prev_block_hash': block.block_v1.payload.prev_block_hash,
+        'created': time.time(),
+    }
+    counts = {}
+    chunks = 0
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(MAGIC)
+        digest = hashlib.sha256(_write_frame(f, dict(header, kind='header')))
+        for table, columns, rows in state:
+            digest.update(_write_frame(f, {'kind': 'chunk', 'table': table, 'columns': columns,
+                                           'rows': [list(row) for row in rows]}))
+            counts[table] = counts.get(table, 0) + len(rows)
+            chunks += 1
+        _write_frame(f, {'kind': 'footer', 'rows': counts, 'chunks': chunks,
+                         'sha256': digest.hexdigest()})
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return dict(header, rows=counts, chunks=chunks)
+
+
+def _chunks(frames, header, raw):
+    # yield (table, columns, rows) and check the footer, a digest starting
+    # from the raw header frame, after the last one
+    digest = hashlib.sha256(raw)
+    for data in frames:
+        frame = json.loads(data)
+        if frame.get('kind') == 'chunk':
+            digest.update(data)
+            yield frame['table'], frame['columns'], frame['rows']
+        elif frame.get('kind') == 'footer':
+            if frame['sha256'] != digest.hexdigest():
+                raise SnapshotError('snapshot digest does not match its header and chunks')
+            header['rows'] = frame['rows']
+            return
+    raise SnapshotError('snapshot has no footer, it was cut short')
+
+
+def _header(frames, block=None):
+    # (header, its frame bytes)
+    try:
+        raw = next(frames)
+    except StopIteration:
+        raise SnapshotError('empty snapshot')
+    header = json.loads(raw)
+    if header.get('kind') != 'header' or header.get('format') != FORMAT:
+        raise SnapshotError('unknown snapshot format')
+    del header['kind']
+    if block is not None:
+        if block.block_v1.payload.height != header['height']:
+            raise SnapshotError('expected the block at height {}'.format(header['height']))
+        if block_hash(block) != header['block_hash']:
+            raise SnapshotError('block {} has hash {}, the snapshot was taken at {}'.format(
+                header['height'], block_hash(block), header['block_hash']))
+    return header, raw
+
+
+def verify_snapshot(path, block=None):
+    """
+    Read a whole snapshot, checking its digest and, given the block at its
+    height, the block hash. Returns the header with the row counts.
+    """
+    frames = read_frames(path)
+    header, raw = _header(frames, block)
+    for _ in _chunks(frames, header, raw):
+        pass
+    return header
+
+
+def import_snapshot(path, index, block=None, tail=None):
+    """
+    Replace the state of a DetailIndex with a snapshot, checked against
+    the block at its height and the block after it when given. Nothing is
+    committed unless the whole snapshot is intact and matches them.
+    Returns the header.
+    """
+    frames = read_frames(path)
+    header, raw = _header(frames, block)
+    if tail is not None:
+        check_tail(header, tail)
+    index.import_state(header['height'], _chunks(frames, header, raw))
+    return header
+
+
+def check_tail(header, block):
+    """
+    Raise SnapshotError unless `block` is the one after the snapshot and
+    links to it
+    """
+    payload = block.block_v1.payload
+    if payload.height != header['height'] + 1 or payload.prev_block_hash != header['block_hash']:
+        raise SnapshotError('block {} does not follow the snapshot at height {}'.format(
+            payload.height, header['height']))
+
+
+def _store_block(path, height):
+    for block in blocks_from_store(path, height - 1):
+        if block.block_v1.payload.height == height:
+            return block
+        break
+    return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export and import world state snapshots')
+    parser.add_argument('action', choices=('export', 'import', 'verify'))
+    parser.add_argument('snapshot', help='snapshot file')
+    parser.add_argument('--db', default='index.sqlite', help='indexer SQLite file')
+    parser.add_argument('--block-store', help="a peer's block_store_path, for the block hashes "
+                                              'and the tail after an import')
+    parser.add_argument('--follow', action='store_true',
+                        help='read blocks from the peers (BLOCK_STREAM_ACCOUNT_ID) and keep '
+                             'following them after an import')
+    args = parser.parse_args(argv)
+
+    net = iroha = signer = None
+    if args.follow:
+        from iroha import Iroha
+        try:
+            from .peerpool import PeerPool
+            from .signers import as_signer
+        except ImportError:
+            from peerpool import PeerPool
+            from signers import as_signer
+
+        net = PeerPool.from_env(os.getenv('IROHA_HOST_ADDR', '128.163.181.53'),
+                                os.getenv('IROHA_PORT', '50051'))
+        iroha = Iroha(os.getenv('BLOCK_STREAM_ACCOUNT_ID', 'admin@test'))
+        private_key = os.getenv('BLOCK_STREAM_PRIVATE_KEY')
+        if not private_key:
+            parser.error('--follow needs BLOCK_STREAM_ACCOUNT_ID and BLOCK_STREAM_PRIVATE_KEY')
+        signer = as_signer(private_key)
+
+    def block_at(height):
+        if args.block_store:
+            return _store_block(args.block_store, height)
+        if net is not None:
+            return fetch_block(net, iroha, signer, height)
+        return None
+
+    if args.action == 'export':
+        index = DetailIndex(args.db)
+        block = block_at(index.height())
+        if block is None:
+            parser.error('export needs --block-store or --follow for the block hash')
+        print(json.dumps(export_snapshot(index, args.snapshot, block)))
+        return 0
+
+    header = json.loads(next(read_frames(args.snapshot)))
+    block = block_at(header['height'])
+    if block is None:
+        print('no block at height {} to check the snapshot hash against'.format(header['height']))
+    if args.action == 'verify':
+        print(json.dumps(verify_snapshot(args.snapshot, block)))
+        return 0
+
+    index = DetailIndex(args.db)
+    print(json.dumps(import_snapshot(args.snapshot, index, block,
+                                     block_at(header['height'] + 1))))
+    if args.block_store:
+        print('replayed {} blocks, now at height {}'.format(
+            replay_store(index, args.block_store), index.height()))
+    if args.follow:
+        follow(index, net, iroha, private_key)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+#
+# One place that follows the status of every transaction in flight.
+# Instead of a status stream, and a thread, per transaction, the resolver
+# keeps the outstanding hashes in one table and polls them with unary
+# Status calls in rounds, spread over a few threads. When a block stream
+# is attached, the transactions of each committed block, and the hashes
+# the block lists as rejected, are resolved without waiting for a poll.
+# Statuses are compared as TxStatus enum values, and each transaction
+# gets a Future that fails with StatusTimeout after `timeout` seconds.
+#
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from iroha import endpoint_pb2
+
+try:
+    from .txtracker import tx_hash_hex
+except ImportError:
+    from txtracker import tx_hash_hex
+
+# Iroha does not send anything else for a transaction after these statuses
+FINAL = frozenset((endpoint_pb2.STATELESS_VALIDATION_FAILED,
+                   endpoint_pb2.STATEFUL_VALIDATION_FAILED,
+                   endpoint_pb2.REJECTED,
+                   endpoint_pb2.COMMITTED,
+                   endpoint_pb2.MST_EXPIRED))
+
+
+class StatusTimeout(Exception):
+    """
+    No final status arrived within the timeout
+    """
+
+
+def committed(status):
+    """
+    True for a (name, code, error code) status tuple that is COMMITTED
+    """
+    return status is not None and status[1] == endpoint_pb2.COMMITTED
+
+
+def final_status(net, transaction):
+    """
+    Final status of a sent transaction read from its own status stream,
+    or the last status seen if the stream closes early
+    """
+    last = None
+    for status in net.tx_status_stream(transaction):
+        last = status
+        if status[1] in FINAL:
+            break
+    return last
+
+
+def status_future(net, transaction, resolver=None, pool=None, journal=None):
+    """
+    Future for the final status of a sent transaction: from the resolver
+    when there is one, otherwise from a status stream followed on `pool`.
+    The status is journaled once final when a TxJournal is given.
+    """
+    if resolver is not None:
+        future = resolver.watch(transaction)
+    else:
+        future = pool.submit(final_status, net, transaction)
+    if journal is not None:
+        journal.follow(future, tx_hash_hex(transaction))
+    return future
+
+
+class StatusResolver:
+    """
+    Futures for the final (name, code, error code) status of sent
+    transactions. Each is first polled `first_poll` seconds after it is
+    watched and then every `poll_interval` seconds, at most `max_round`
+    transactions per round. on_first_status callbacks are called with each
+    transaction and the seconds from watching it to its first status.
+    """
+
+    def __init__(self, net, timeout=120.0, poll_interval=0.5, first_poll=0.5, workers=8,
+                 max_round=1000):
+        self.net = net
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.first_poll = first_poll
+        self.max_round = max_round
+        self.polls = 0
+        self.poll_errors = 0
+        self.by_poll = 0
+        self.by_block = 0
+        self.timeouts = 0
+        self.on_first_status = []
+        self._cond = threading.Condition()
+        # hash -> [transaction, future, deadline, next poll, watched at],
+        # the last one None once a status was seen
+        self._pending = OrderedDict()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='status')
+        self._thread = threading.Thread(target=self._run, name='status-resolver', daemon=True)
+        self._thread.start()
+
+    def watch(self, transaction, timeout=None):
+        """
+        Future for the transaction's final status. Watching a transaction
+        that is already watched returns the same future.
+        """
+        tx_hash = tx_hash_hex(transaction)
+        now = time.monotonic()
+        with self._cond:
+            entry = self._pending.get(tx_hash)
+            if entry is not None:
+                return entry[1]
+            future = Future()
+            self._pending[tx_hash] = [transaction, future,
+                                      now + (timeout or self.timeout), now + self.first_poll,
+                                      now]
+            self._cond.notify()
+        return future
+
+    def wait(self, transaction, timeout=None):
+        """
+        Block until the final status, raising StatusTimeout after the
+        resolver's timeout (or `timeout` seconds)
+        """
+        return self.watch(transaction, timeout).result()
+
+    def resolve_block(self, block):
+        """
+        Resolve the watched transactions of a committed block, for use as
+        an EventHub on_block callback
+        """
+        payload = block.block_v1.payload
+        for transaction in payload.transactions:
+            self._resolve(tx_hash_hex(transaction),
+                          ('COMMITTED', endpoint_pb2.COMMITTED, 0), block=True)
+        for tx_hash in payload.rejected_transactions_hashes:
+            self._resolve(tx_hash, ('REJECTED', endpoint_pb2.REJECTED, 0), block=True)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'pending': len(self._pending),
+                'polls': self.polls,
+                'poll_errors': self.poll_errors,
+                'resolved_by_poll': self.by_poll,
+                'resolved_by_block': self.by_block,
+                'timeouts': self.timeouts,
+            }
+
+    def _seen(self, tx_hash):
+        with self._cond:
+            entry = self._pending.get(tx_hash)
+            if entry is None or entry[4] is None:
+                return
+            seconds = time.monotonic() - entry[4]
+            entry[4] = None
+        for callback in self.on_first_status:
+            callback(entry[0], seconds)
+
+    def _resolve(self, tx_hash, status, block=False):
+        self._seen(tx_hash)
+        with self._cond:
+            entry = self._pending.pop(tx_hash, None)
+            if entry is None:
+                return
+            if block:
+                self.by_block += 1
+            else:
+                self.by_poll += 1
+        entry[1].set_result(status)
+
+    def _poll(self, item):
+        tx_hash, transaction = item
+        try:
+            return tx_hash, self.net.tx_status(transaction)
+        except Exception:
+            return tx_hash, None
+
+    def _run(self):
+        while True:
+            expired = []
+            due = []
+            with self._cond:
+                if not self._pending:
+                    self._cond.wait()
+                now = time.monotonic()
+                for tx_hash, entry in self._pending.items():
+                    if entry[2] <= now:
+                        expired.append(tx_hash)
+                    elif entry[3] <= now and len(due) < self.max_round:
+                        due.append((tx_hash, entry[0]))
+                        entry[3] = now + self.poll_interval
+                futures = [self._pending.pop(tx_hash)[1] for tx_hash in expired]
+                self.timeouts += len(expired)
+            for future in futures:
+                future.set_exception(StatusTimeout('no final status within the timeout'))
+            errors = 0
+            for tx_hash, status in self._pool.map(self._poll, due):
+                if status is None:
+                    errors += 1
+                elif status[1] in FINAL:
+                    self._resolve(tx_hash, status)
+                else:
+                    self._seen(tx_hash)
+            with self._cond:
+                self.polls += len(due)
+                self.poll_errors += errors
+            if not due:
+                with self._cond:
+                    self._cond.wait(min(self.poll_interval, self.first_poll))
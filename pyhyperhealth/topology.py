@@ -0,0 +1,464 @@
+#!/usr/bin/env python3
+#
+# Generates the node folders of an Iroha network (config.docker,
+# genesis.block, key pair and node.env for network.sh) from a topology
+# spec, instead of hand-copying Network-Files/node1, node2 and node3plus.
+#
+# A spec is JSON:
+#   {"profile": "dev",
+#    "peers": [{"name": "node1", "host": "128.163.181.53"},
+#              {"name": "node2", "host": "128.163.181.54", "genesis": false}]}
+# or {"count": 4, "host": "127.0.0.1"} for node1 .. node4 on one host, with
+# their torii, internal and postgres ports shifted by one per peer. Peers
+# are in the genesis block unless "genesis" is false; those join later
+# through /addpeer and list every peer in initial_peers. The accounts,
+# roles and domains come from a template genesis block, by default the
+# one in Network-Files/node1. "overrides" in the spec replace profile
+# values, e.g. {"max_proposal_size": 500}.
+#
+# Profiles set the consensus timings and the postgres settings:
+# max_proposal_size, proposal_delay, vote_delay, max_rounds_delay,
+# proposal_creation_timeout, and postgres max_connections,
+# max_prepared_transactions and shared_buffers.
+#
+# python3 topology.py generate spec.json --out Network-Files/generated
+# python3 topology.py generate spec.json --dry-run      builds and validates, writes nothing
+# python3 topology.py validate Network-Files/generated
+# python3 topology.py wait 127.0.0.1:5432 127.0.0.1:50051 --timeout 60
+#
+import argparse
+import copy
+import json
+import os
+import re
+import socket
+import sys
+import time
+
+TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'Network-Files', 'node1', 'genesis.block')
+
+# Consensus and database settings per profile. 'default' is what
+# Network-Files shipped with.
+PROFILES = {
+    'default': {
+        'max_proposal_size': 10, 'proposal_delay': 5000, 'vote_delay': 5000,
+        'max_rounds_delay': 3000, 'proposal_creation_timeout': 3000,
+        'stale_stream_max_rounds': 2,
+        'postgres': {'max_connections': 100, 'max_prepared_transactions': 100,
+                     'shared_buffers': '128MB'},
+    },
+    # one machine, answers in well under a second
+    'dev': {
+        'max_proposal_size': 100, 'proposal_delay': 100, 'vote_delay': 100,
+        'max_rounds_delay': 100, 'proposal_creation_timeout': 100,
+        'stale_stream_max_rounds': 2,
+        'postgres': {'max_connections': 100, 'max_prepared_transactions': 100,
+                     'shared_buffers': '128MB'},
+    },
+    # interactive clinical use across a LAN
+    'low-latency': {
+        'max_proposal_size': 200, 'proposal_delay': 300, 'vote_delay': 300,
+        'max_rounds_delay': 300, 'proposal_creation_timeout': 300,
+        'stale_stream_max_rounds': 2,
+        'postgres': {'max_connections': 200, 'max_prepared_transactions': 200,
+                     'shared_buffers': '256MB'},
+    },
+    # bulk imports, large blocks at a slower pace
+    'throughput': {
+        'max_proposal_size': 5000, 'proposal_delay': 1000, 'vote_delay': 1000,
+        'max_rounds_delay': 1000, 'proposal_creation_timeout': 1000,
+        'stale_stream_max_rounds': 4,
+        'postgres': {'max_connections': 300, 'max_prepared_transactions': 500,
+                     'shared_buffers': '1GB'},
+    },
+}
+CONSENSUS_KEYS = ('max_proposal_size', 'proposal_delay', 'vote_delay', 'max_rounds_delay',
+                  'proposal_creation_timeout', 'stale_stream_max_rounds')
+POSTGRES_IMAGE = 'postgres:9.5'
+IROHA_IMAGE = 'hyperledger/iroha:latest'
+TORII_PORT = 50051
+INTERNAL_PORT = 10001
+POSTGRES_PORT = 5432
+HEX_KEY = re.compile('^[0-9a-f]{64}$')
+
+
+class TopologyError(Exception):
+    """
+    A spec or generated network that cannot work
+    """
+
+
+def profile(name, overrides=None):
+    """
+    Settings of a named profile with the overrides applied
+    """
+    if name not in PROFILES:
+        raise TopologyError('profile must be one of {}'.format(sorted(PROFILES)))
+    settings = copy.deepcopy(PROFILES[name])
+    for key, value in (overrides or {}).items():
+        if key == 'postgres':
+            settings['postgres'].update(value)
+        elif key in CONSENSUS_KEYS:
+            settings[key] = value
+        else:
+            raise TopologyError('unknown setting {}'.format(key))
+    return settings
+
+
+def peers(spec):
+    """
+    The peers of a spec with names, hosts and ports filled in
+    """
+    listed = spec.get('peers')
+    if listed is None:
+        listed = [{'name': 'node{}'.format(i + 1), 'host': spec.get('host', '127.0.0.1')}
+                  for i in range(int(spec.get('count', 1)))]
+    result = []
+    per_host = {}
+    for peer in listed:
+        peer = dict(peer)
+        if 'name' not in peer or not re.match(r'^[A-Za-z0-9_.-]+$', peer['name']):
+            raise TopologyError('each peer needs a name usable as a folder name')
+        peer.setdefault('host', '127.0.0.1')
+        # peers sharing a host get ports of their own
+        offset = per_host.get(peer['host'], 0)
+        per_host[peer['host']] = offset + 1
+        peer.setdefault('torii_port', TORII_PORT + offset)
+        peer.setdefault('internal_port', INTERNAL_PORT + offset)
+        peer.setdefault('postgres_port', POSTGRES_PORT + offset)
+        peer.setdefault('genesis', True)
+        result.append(peer)
+    if len({peer['name'] for peer in result}) != len(result):
+        raise TopologyError('peer names must be unique')
+    if not any(peer['genesis'] for peer in result):
+        raise TopologyError('at least one peer must be in the genesis block')
+    return result
+
+
+def genesis_block(template, genesis_peers):
+    """
+    The template genesis block with its AddPeer commands replaced by one
+    per genesis peer, given as (address, public key)
+    """
+    block = copy.deepcopy(template)
+    reduced = block['block_v1']['payload']['transactions'][0]['payload']['reducedPayload']
+    commands = [c for c in reduced['commands'] if 'addPeer' not in c]
+    reduced['commands'] = [{'addPeer': {'peer': {'address': address, 'peerKey': key}}}
+                           for address, key in genesis_peers] + commands
+    return block
+
+
+def node_config(peer, all_peers, settings):
+    """
+    config.docker of one peer
+    """
+    config = {
+        'block_store_path': '/tmp/block_store/',
+        'torii_port': peer['torii_port'],
+        'internal_port': peer['internal_port'],
+        'database': {
+            'type': 'postgres',
+            'host': 'localhost',
+            'port': peer['postgres_port'],
+            'user': 'postgres',
+            'password': 'mysecretpassword',
+            'working database': 'iroha_default',
+            'maintenance database': 'postgres',
+        },
+    }
+    config.update({key: settings[key] for key in CONSENSUS_KEYS})
+    config['mst_enable'] = True
+    config['mst_expiration_time'] = 1440
+    if not peer['genesis']:
+        config['initial_peers'] = [{'address': '{}:{}'.format(p['host'], p['internal_port']),
+                                    'public_key': p['public_key']} for p in all_peers]
+    return config
+
+
+def node_env(peer, settings):
+    """
+    node.env read by `network.sh up <folder>`
+    """
+    postgres = settings['postgres']
+    args = ' '.join('-c {}={}'.format(key, value) for key, value in
+                    [('port', peer['postgres_port'])] + sorted(postgres.items()))
+    values = [
+        ('KEY', peer['name']),
+        ('PEER_ADDRESS', '{}:{}'.format(peer['host'], peer['internal_port'])),
+        ('TORII_PORT', peer['torii_port']),
+        ('POSTGRES_PORT', peer['postgres_port']),
+        ('POSTGRES_IMAGE', POSTGRES_IMAGE),
+        ('POSTGRES_ARGS', args),
+        ('POSTGRES_CONTAINER', 'postgres-' + peer['name']),
+        ('IROHA_CONTAINER', 'iroha-' + peer['name']),
+        ('IROHA_IMAGE', IROHA_IMAGE),
+        ('BLOCKSTORE_VOLUME', 'blockstore-' + peer['name']),
+    ]
+    return ''.join('{}="{}"\n'.format(key, value) for key, value in values)
+
+
+def _keypair(peer, out):
+    # an existing key pair in the output folder is kept, so generating
+    # again does not change the peers' identities
+    folder = os.path.join(out, peer['name']) if out else None
+    if folder and os.path.exists(os.path.join(folder, peer['name'] + '.pub')):
+        with open(os.path.join(folder, peer['name'] + '.pub')) as f:
+            return None, f.read().strip()
+    if peer.get('public_key'):
+        # the private key is kept on the peer's own machine
+        return None, peer['public_key']
+    from iroha import IrohaCrypto
+    private_key = IrohaCrypto.private_key()
+    return private_key.decode('ascii'), IrohaCrypto.derive_public_key(private_key).decode('ascii')
+
+
+def build(spec, out=None, template=None):
+    """
+    {peer name: {file name: contents}} for every peer of the spec
+    """
+    with open(template or spec.get('template') or TEMPLATE) as f:
+        template = json.load(f)
+    settings = profile(spec.get('profile', 'default'), spec.get('overrides'))
+    all_peers = peers(spec)
+    private_keys = {}
+    for peer in all_peers:
+        private_keys[peer['name']], peer['public_key'] = _keypair(peer, out)
+    genesis = genesis_block(template, [('{}:{}'.format(p['host'], p['internal_port']),
+                                        p['public_key'])
+                                       for p in all_peers if p['genesis']])
+    files = {}
+    for peer in all_peers:
+        node = {
+            'config.docker': json.dumps(node_config(peer, all_peers, settings), indent=2) + '\n',
+            'genesis.block': json.dumps(genesis, indent=3) + '\n',
+            'node.env': node_env(peer, settings),
+            peer['name'] + '.pub': peer['public_key'],
+        }
+        if private_keys[peer['name']]:
+            node[peer['name'] + '.priv'] = private_keys[peer['name']]
+        files[peer['name']] = node
+    return files
+
+
+def write(files, out):
+    for name, node in files.items():
+        folder = os.path.join(out, name)
+        os.makedirs(folder, exist_ok=True)
+        for file_name, contents in node.items():
+            path = os.path.join(folder, file_name)
+            if file_name.endswith('.priv'):
+                with os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600),
+                               'w') as f:
+                    f.write(contents)
+            else:
+                with open(path, 'w') as f:
+                    f.write(contents)
+
+
+def _parse_env(text):
+    values = {}
+    for line in text.splitlines():
+        if '=' in line and not line.startswith('#'):
+            key, value = line.split('=', 1)
+            values[key.strip()] = value.strip().strip('"')
+    return values
+
+
+def _check_genesis(name, block, problems):
+    try:
+        reduced = block['block_v1']['payload']['transactions'][0]['payload']['reducedPayload']
+        commands = reduced['commands']
+    except (KeyError, IndexError, TypeError):
+        problems.append('{}: genesis.block has no transaction'.format(name))
+        return set()
+    try:
+        from iroha import primitive_pb2
+        known_permissions = set(primitive_pb2.RolePermission.keys())
+    except ImportError:
+        known_permissions = None
+    roles, domains, accounts, peer_keys = set(), set(), set(), set()
+    for command in commands:
+        kind, body = next(iter(command.items()))
+        if kind == 'addPeer':
+            key = body['peer'].get('peerKey', '')
+            if not HEX_KEY.match(key):
+                problems.append('{}: peer {} has a malformed key'.format(name, body['peer']))
+            peer_keys.add(key)
+        elif kind == 'createRole':
+            roles.add(body['roleName'])
+            unknown = set(body.get('permissions', ())) - (known_permissions or set())
+            if known_permissions is not None and unknown:
+                problems.append('{}: role {} has unknown permissions {}'.format(
+                    name, body['roleName'], sorted(unknown)))
+        elif kind == 'createDomain':
+            if body['defaultRole'] not in roles:
+                problems.append('{}: domain {} uses role {} before it is created'.format(
+                    name, body['domainId'], body['defaultRole']))
+            domains.add(body['domainId'])
+        elif kind in ('createAccount', 'createAsset'):
+            if body['domainId'] not in domains:
+                problems.append('{}: {} in unknown domain {}'.format(name, kind, body['domainId']))
+            if kind == 'createAccount':
+                account_id = '{}@{}'.format(body['accountName'], body['domainId'])
+                if account_id in accounts:
+                    problems.append('{}: account {} is created twice'.format(name, account_id))
+                accounts.add(account_id)
+        elif kind == 'appendRole':
+            if body['roleName'] not in roles or body['accountId'] not in accounts:
+                problems.append('{}: appendRole {} to {} before both exist'.format(
+                    name, body['roleName'], body['accountId']))
+    if not peer_keys:
+        problems.append('{}: genesis.block adds no peer'.format(name))
+    return peer_keys
+
+
+def validate(files):
+    """
+    Problems found in the output of build() or read_folders(), without
+    docker: configs, ports, keys, and one genesis block shared by all
+    """
+    problems = []
+    geneses = {}
+    endpoints = {}
+    for name, node in sorted(files.items()):
+        missing = [f for f in ('config.docker', 'genesis.block', name + '.pub') if f not in node]
+        if missing:
+            problems.append('{}: missing {}'.format(name, ', '.join(missing)))
+            continue
+        try:
+            config = json.loads(node['config.docker'])
+            block = json.loads(node['genesis.block'])
+        except ValueError as e:
+            problems.append('{}: invalid JSON: {}'.format(name, e))
+            continue
+        for key in CONSENSUS_KEYS + ('torii_port', 'internal_port'):
+            if not isinstance(config.get(key), int) or config[key] <= 0:
+                problems.append('{}: {} must be a positive number'.format(name, key))
+        geneses[name] = json.dumps(block, sort_keys=True)
+        peer_keys = _check_genesis(name, block, problems)
+        public_key = node[name + '.pub'].strip()
+        if public_key not in peer_keys and not config.get('initial_peers'):
+            # a peer added later finds the network through initial_peers
+            problems.append('{}: its key is not in the genesis block and it has no '
+                            'initial_peers'.format(name))
+        if name + '.priv' in node:
+            try:
+                from iroha import IrohaCrypto
+            except ImportError:
+                IrohaCrypto = None
+            if IrohaCrypto is not None and IrohaCrypto.derive_public_key(
+                    node[name + '.priv'].strip()).decode('ascii') != public_key:
+                problems.append('{}: {}.priv does not match {}.pub'.format(name, name, name))
+        env = _parse_env(node.get('node.env', ''))
+        host = env.get('PEER_ADDRESS', name).rsplit(':', 1)[0]
+        for port in (config.get('torii_port'), config.get('internal_port'),
+                     config.get('database', {}).get('port')):
+            if (host, port) in endpoints:
+                problems.append('{}: port {} on {} is also used by {}'.format(
+                    name, port, host, endpoints[(host, port)]))
+            endpoints[(host, port)] = name
+    if len(set(geneses.values())) > 1:
+        problems.append('the genesis blocks differ between {}'.format(', '.join(sorted(geneses))))
+    return problems
+
+
+def read_folders(path):
+    """
+    {folder name: {file name: contents}} of the node folders under path,
+    e.g. Network-Files
+    """
+    files = {}
+    for name in sorted(os.listdir(path)):
+        folder = os.path.join(path, name)
+        if not os.path.isfile(os.path.join(folder, 'config.docker')):
+            continue
+        node = {}
+        for file_name in os.listdir(folder):
+            with open(os.path.join(folder, file_name)) as f:
+                node[file_name] = f.read()
+        files[name] = node
+    return files
+
+
+def probe(address, timeout=1.0):
+    """
+    True if a TCP connection to host:port succeeds
+    """
+    host, port = address.rsplit(':', 1)
+    try:
+        with socket.create_connection((host, int(port)), timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+
+def wait_ready(addresses, timeout=60.0, interval=0.5):
+    """
+    Wait until every address accepts connections, returning the ones
+    that did not within `timeout` seconds
+    """
+    deadline = time.monotonic() + timeout
+    waiting = list(addresses)
+    while waiting and time.monotonic() < deadline:
+        waiting = [address for address in waiting if not probe(address)]
+        if waiting:
+            time.sleep(interval)
+    return waiting
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate and check Iroha network folders')
+    commands = parser.add_subparsers(dest='action')
+    generate = commands.add_parser('generate', help='build node folders from a topology spec')
+    generate.add_argument('spec', help='topology spec (JSON)')
+    generate.add_argument('--out', default='network', help='output directory (default network)')
+    generate.add_argument('--template', help='genesis.block with the accounts and roles')
+    generate.add_argument('--profile', help='profile to use instead of the spec one: {}'.format(
+        ', '.join(sorted(PROFILES))))
+    generate.add_argument('--dry-run', action='store_true',
+                          help='build and validate only, write nothing')
+    check = commands.add_parser('validate', help='check node folders without docker')
+    check.add_argument('path', help='directory holding one folder per node')
+    wait = commands.add_parser('wait', help='wait until host:port addresses accept connections')
+    wait.add_argument('addresses', nargs='+')
+    wait.add_argument('--timeout', type=float, default=60.0)
+    args = parser.parse_args(argv)
+
+    if args.action == 'wait':
+        waiting = wait_ready(args.addresses, args.timeout)
+        for address in waiting:
+            print('{} is not ready'.format(address), file=sys.stderr)
+        return 1 if waiting else 0
+    if args.action == 'validate':
+        files = read_folders(args.path)
+    elif args.action == 'generate':
+        with open(args.spec) as f:
+            spec = json.load(f)
+        if args.profile:
+            spec['profile'] = args.profile
+        try:
+            files = build(spec, None if args.dry_run else args.out, args.template)
+        except TopologyError as e:
+            print(e, file=sys.stderr)
+            return 1
+    else:
+        parser.print_help()
+        return 2
+    problems = validate(files)
+    for problem in problems:
+        print(problem, file=sys.stderr)
+    if problems:
+        return 1
+    if args.action == 'generate' and not args.dry_run:
+        write(files, args.out)
+    for name, node in sorted(files.items()):
+        config = json.loads(node['config.docker'])
+        print('{}: torii {}, internal {}, proposal size {}, delays {}/{} ms'.format(
+            name, config['torii_port'], config['internal_port'], config['max_proposal_size'],
+            config['proposal_delay'], config['vote_delay']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
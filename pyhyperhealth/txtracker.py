@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+#
+# Background tracking of submitted transactions, so the API can hand the
+# transaction hash back right away instead of holding a worker until the
+# peers finish consensus.
+#
+import binascii
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from iroha import IrohaCrypto, endpoint_pb2
+
+# Iroha does not send anything else for a transaction after these statuses
+FINAL_STATUSES = ('COMMITTED', 'REJECTED', 'STATELESS_VALIDATION_FAILED',
+                  'STATEFUL_VALIDATION_FAILED', 'MST_EXPIRED')
+
+
+def tx_hash_hex(transaction):
+    """
+    Hex encoded hash of a transaction, as used in the status endpoints
+    """
+    return binascii.hexlify(IrohaCrypto.hash(transaction)).decode('ascii')
+
+
+class TxTracker:
+    """
+    Sends transactions and follows their status streams on worker threads.
+    The last `keep` results are held so clients can look them up by hash.
+    on_commit, if given, is called with each transaction that commits.
+    With a StatusResolver only the final status is tracked, and no worker
+    thread is held per transaction. With a TxJournal each transaction is
+    journaled before it is sent and again once final.
+    """
+
+    def __init__(self, net, workers=64, keep=10000, on_commit=None, resolver=None,
+                 journal=None):
+        self.net = net
+        self.keep = keep
+        self.on_commit = on_commit
+        self.resolver = resolver
+        self.journal = journal
+        self._pool = ThreadPoolExecutor(max_workers=workers,
+                                        thread_name_prefix='txtracker')
+        self._cond = threading.Condition()
+        self._entries = OrderedDict()
+        self._on_final = {}
+
+    def submit(self, transaction, on_final=None):
+        """
+        Send the transaction to the peer and return its hash without
+        waiting for the status stream. on_final, if given, is called with
+        a copy of the entry once the transaction is final.
+        """
+        tx_hash = tx_hash_hex(transaction)
+        entry = {
+            'hash': tx_hash,
+            'creator': transaction.payload.reduced_payload.creator_account_id,
+            'status': 'NOT_RECEIVED',
+            'error_code': 0,
+            'final': False,
+            'submitted': time.time(),
+        }
+        with self._cond:
+            self._entries[tx_hash] = entry
+            if on_final is not None:
+                self._on_final[tx_hash] = on_final
+            self._evict()
+        journaled = False
+        try:
+            if self.journal is not None:
+                self.journal.submitted(transaction)
+                journaled = True
+            self.net.send_tx(transaction)
+        except Exception as e:
+            if journaled:
+                # reported as failed, so the next start must not resend it
+                self.journal.resolved(tx_hash, 'SEND_FAILED')
+            self._update(tx_hash, 'SEND_FAILED', 0, True, error=str(e))
+            return tx_hash
+        if self.resolver is not None:
+            self.resolver.watch(transaction).add_done_callback(
+                lambda done: self._resolved(tx_hash, transaction, done))
+        else:
+            self._pool.submit(self._follow, tx_hash, transaction)
+        return tx_hash
+
+    def status(self, tx_hash):
+        """
+        Copy of the current entry for the hash, or None if it is not tracked
+        """
+        with self._cond:
+            entry = self._entries.get(tx_hash)
+            return dict(entry) if entry is not None else None
+
+    def wait(self, tx_hash, timeout):
+        """
+        Long-poll: block until the transaction reaches a final status or
+        the timeout runs out, then return the current entry
+        """
+        with self._cond:
+            if tx_hash not in self._entries:
+                return None
+            self._cond.wait_for(
+                lambda: tx_hash not in self._entries or self._entries[tx_hash]['final'],
+                timeout)
+            entry = self._entries.get(tx_hash)
+            return dict(entry) if entry is not None else None
+
+    def _follow(self, tx_hash, transaction):
+        final = False
+        try:
+            for status in self.net.tx_status_stream(transaction):
+                name, error_code = status[0], status[2]
+                final = name in FINAL_STATUSES
+                if name == 'COMMITTED' and self.on_commit is not None:
+                    self.on_commit(transaction)
+                self._update(tx_hash, name, error_code, final)
+        except Exception as e:
+            self._update(tx_hash, 'STREAM_FAILED', 0, True, error=str(e))
+            return
+        if not final:
+            # the stream closed without a final answer from the peer
+            self._update(tx_hash, None, None, True)
+
+    def _resolved(self, tx_hash, transaction, done):
+        if done.exception() is not None:
+            self._update(tx_hash, 'STATUS_TIMEOUT', 0, True, error=str(done.exception()))
+            return
+        name, code, error_code = done.result()
+        if code == endpoint_pb2.COMMITTED and self.on_commit is not None:
+            self.on_commit(transaction)
+        self._update(tx_hash, name, error_code, True)
+
+    def _update(self, tx_hash, name, error_code, final, error=None):
+        with self._cond:
+            entry = self._entries.get(tx_hash)
+            if entry is None:
+                return
+            if name is not None:
+                entry['status'] = name
+                entry['error_code'] = error_code
+            if error is not None:
+                entry['error'] = error
+            entry['final'] = final
+            entry['updated'] = time.time()
+            self._cond.notify_all()
+            callback = self._on_final.pop(tx_hash, None) if final else None
+            entry = dict(entry)
+        if final and self.journal is not None and entry['status'] in FINAL_STATUSES:
+            self.journal.resolved(tx_hash, entry['status'])
+        if callback is not None:
+            callback(entry)
+
+    def _evict(self):
+        # drop the oldest finished entries first, never the pending ones
+        if len(self._entries) <= self.keep:
+            return
+        for tx_hash in list(self._entries):
+            if len(self._entries) <= self.keep:
+                break
+            if self._entries[tx_hash]['final']:
+                del self._entries[tx_hash]
@@ -11,6 +11,24 @@ setup(
     description='Python Hyperledger Iroha Healthcare Permissions Library',
     install_requires=['iroha',
                      'flask'],
-    include_package_data=True
+    extras_require={
+        'manifest': ['cryptography'],
+        'async': ['uvicorn', 'grpcio>=1.32'],
+        'analytics': ['numpy'],
+        'msgpack': ['msgpack'],
+    },
+    include_package_data=True,
+    entry_points={
+        'console_scripts': [
+            'pyhyperhealth-analytics=pyhyperhealth.analytics:main',
+            'pyhyperhealth-consensusbench=pyhyperhealth.consensusbench:main',
+            'pyhyperhealth-import=pyhyperhealth.bulkimport:main',
+            'pyhyperhealth-indexer=pyhyperhealth.indexer:main',
+            'pyhyperhealth-loadtest=pyhyperhealth.loadtest:main',
+            'pyhyperhealth-provision=pyhyperhealth.provision:main',
+            'pyhyperhealth-snapshot=pyhyperhealth.snapshot:main',
+            'pyhyperhealth-topology=pyhyperhealth.topology:main',
+        ],
+    },
 
 )